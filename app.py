@@ -1,37 +1,87 @@
 # app.py
 import os
 import time
+import base64
 import json
 import uuid
 import datetime
-from flask import request, jsonify, abort
-from openai import APITimeoutError
+import functools
+import itertools
+from flask import Response, g, request, jsonify, abort, stream_with_context
 
 # --- Configuración base y clientes externos ---
-from src.config import app, logger, client, ORCHESTRATOR_ASSISTANT_ID, ASISTENTE_ID
+from src.config import app, logger, client, chat_client, bq_client, LazyClient, warm_clients, ORCHESTRATOR_ASSISTANT_ID, ASISTENTE_ID
 
 # Persistencia / OpenAI / BigQuery (tuyos)
 from src.persistence_service import persist_conversation_turn
-from src.openai_service import (
-    execute_invoke_sustainability_expert,
-    process_assistant_message_without_citations,
+from src.openai_service import execute_orchestrator_tool_call
+from src.chat_service import TurnBudget, run_assistant_turn
+from src.run_poller import timeout_errors
+from src.chat_jobs import (
+    CHAT_JOB_DEADLINE_SECONDS,
+    CHAT_JOB_MAX_WAIT_SECONDS,
+    CHAT_JOB_SSE_RETRY_MS,
+    CHAT_JOB_SSE_WINDOW_SECONDS,
+    TERMINAL_STATUSES,
+    ChatJobError,
+    chat_jobs,
+    job_payload,
 )
+from src.streaming_service import (
+    SSE_HEARTBEAT_SECONDS,
+    format_sse,
+    format_sse_comment,
+    format_sse_retry,
+    stream_assistant_run,
+)
+from src.history_store import HISTORY_STORE, history_store
+from src.auth_cache import token_cache
+from src.rate_limit import (
+    ASSISTANT_RATE_LIMIT,
+    AUDITOR_RATE_LIMIT,
+    RATE_LIMIT_DEFAULT,
+    RATE_LIMIT_KEY_PREFIX,
+    RATE_LIMIT_STORAGE_URI,
+    RATE_LIMIT_STRATEGY,
+    flask_rate_limit_key,
+)
+from src.thread_ownership import owner_document, owner_from_snapshot, register_new_thread, thread_owners
+from src.thread_lease import ThreadBusy, ThreadLease, thread_leases
+from src.timing import SERVER_TIMING_ENABLED, configure_tracing, end_request, span, start_request, timed
+from src import metrics
+from src.idempotency import (
+    IDEMPOTENCY_MAX_KEY_LENGTH,
+    IdempotencyInProgress,
+    IdempotencyMismatch,
+    idempotency_store,
+    request_fingerprint,
+)
+from src.semantic_cache import (
+    SEMANTIC_CACHE_ASSISTANT_NAME,
+    SEMANTIC_CACHE_ENABLED,
+    semantic_cache,
+    thread_messages_for_cached_answer,
+)
+from src.bigquery_schema import BIGQUERY_MANAGE_TABLE, start_table_check
+from src.bigquery_writer import bigquery_writer
 from src.bigquery_service import (
+    DISABLE_BIGQUERY,
     fetch_recent_conversations_for_user,
-    fetch_conversation_thread,
+    iter_conversation_turns,
+    turn_messages,
 )
 
 # --- Firebase Admin / Firestore ---
 import firebase_admin
-from firebase_admin import credentials, auth as fb_auth, firestore
+from firebase_admin import credentials, firestore
 
 # Firestore server timestamps y decoradores transaccionales
 from google.cloud.firestore_v1 import SERVER_TIMESTAMP
+from werkzeug.exceptions import HTTPException
 
 # --- CORS (opcional) y Rate Limiting ---
 from flask_cors import CORS
 from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
 
 
 # =============================================================================
@@ -50,7 +100,52 @@ if not firebase_admin._apps:
             cred = credentials.ApplicationDefault()
             firebase_admin.initialize_app(cred)
 
-firestore_db = firestore.client()
+# Se crea en el primer uso (o en `start_worker`), no al importar: ver LazyClient en src/config.py
+firestore_db = LazyClient("Firestore", firestore.client)
+
+# "import": las tareas de arranque se lanzan al importar la app (un worker por import).
+# "post_fork": las lanza el hook post_fork de gunicorn.conf.py en cada worker (--preload).
+# "none": no se lanzan (scripts y scripts/check_import_time.py, que solo miden el import).
+APP_STARTUP = os.getenv("APP_STARTUP", "import")
+
+
+def preload_sdks():
+    """
+    Importa en el master de gunicorn los SDK que la app carga en diferido (openai,
+    google.cloud.bigquery) para que los workers los hereden ya importados. Solo módulos:
+    los clientes se siguen creando en cada worker.
+    """
+    import openai  # noqa: F401
+
+    if not DISABLE_BIGQUERY:
+        from google.cloud import bigquery  # noqa: F401
+
+
+def start_worker():
+    """Arranque de cada worker: hilos de fondo y clientes creados en paralelo sin bloquear /health."""
+    # Exportación de spans a OpenTelemetry (solo si hay colector configurado)
+    configure_tracing()
+
+    # La caché semántica (opcional) se siembra con el historial en segundo plano
+    if SEMANTIC_CACHE_ENABLED:
+        semantic_cache.start_seeding()
+
+    # Crea o pone al día la tabla de historial (partición y clustering), sin bloquear el arranque
+    if BIGQUERY_MANAGE_TABLE and not DISABLE_BIGQUERY:
+        start_table_check()
+
+    # Reenvía los turnos que quedaron en el spool de BigQuery (BIGQUERY_SPOOL_DIR) en una
+    # ejecución anterior. Aquí y no al importar: con --preload el import ocurre en el master
+    if not DISABLE_BIGQUERY:
+        bigquery_writer.replay_pending()
+
+    warm_clients(client, firestore_db, *(() if DISABLE_BIGQUERY else (bq_client,)))
+
+
+if APP_STARTUP == "import":
+    start_worker()
+elif APP_STARTUP == "post_fork":
+    preload_sdks()
 
 # =============================================================================
 # 1) CORS y Rate Limiting
@@ -78,14 +173,25 @@ CORS(
     methods=["GET", "POST", "OPTIONS"],
     allow_headers=["Authorization", "Content-Type", "Idempotency-Key"],
     # Headers que el frontend podrá leer
-    expose_headers=["X-Request-Id"],
+    expose_headers=["X-Request-Id", "Retry-After", "Location"],
     # Tiempo que el navegador puede cachear la respuesta OPTIONS (preflight)
     max_age=86400 # 1 día
 )
 logger.info(f"CORS configured for origins: {_allowed_origins}")
 
-# Rate Limiting (sin cambios)
-limiter = Limiter(get_remote_address, app=app, default_limits=["120/minute"])
+# Rate Limiting por uid sobre almacenamiento compartido (ver src/rate_limit.py). Si el
+# almacenamiento falla se aplican los mismos límites en memoria y, si también eso falla,
+# la petición pasa (fail open). Se engancha a la app tras los hooks de logging (más abajo)
+# para que su comprobación entre ya en los tiempos de la petición.
+limiter = Limiter(
+    flask_rate_limit_key,
+    default_limits=[RATE_LIMIT_DEFAULT],
+    storage_uri=RATE_LIMIT_STORAGE_URI,
+    strategy=RATE_LIMIT_STRATEGY,
+    key_prefix=RATE_LIMIT_KEY_PREFIX,
+    in_memory_fallback_enabled=True,
+    swallow_errors=True,
+)
 
 
 # =============================================================================
@@ -106,6 +212,8 @@ def fail(message, status=400, **details):
 def _req_start():
     request._id = uuid.uuid4().hex[:12]
     request._t0 = time.time()
+    request._timing = start_request(f"{request.method} {request.path}", request_id=request._id)
+    metrics.request_started()
     # No logueamos el cuerpo (datos sensibles); solo metadatos
     logger.info(
         json.dumps(
@@ -122,10 +230,25 @@ def _req_end(resp):
     resp.headers["X-Content-Type-Options"] = "nosniff"
     resp.headers["X-Frame-Options"] = "DENY"
     resp.headers["Referrer-Policy"] = "no-referrer"
-    logger.info(json.dumps({"evt": "request_end", "id": request._id, "status": resp.status_code, "ms": dur_ms}))
+    timing = getattr(request, "_timing", None)
+    stages = timing.totals() if timing else {}
+    if timing and SERVER_TIMING_ENABLED:
+        resp.headers["Server-Timing"] = timing.server_timing()
+    end_request(timing, resp.status_code)
+    # La ruta (plantilla) y no el path: los ids de hilo o de job no multiplican las series
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.request_finished(route, request.method, resp.status_code, time.time() - request._t0)
+    logger.info(
+        json.dumps(
+            {"evt": "request_end", "id": request._id, "status": resp.status_code, "ms": dur_ms, "stages": stages}
+        )
+    )
     return resp
 
 
+limiter.init_app(app)
+
+
 # =============================================================================
 # 3) Autenticación y helpers
 # =============================================================================
@@ -136,7 +259,8 @@ def require_firebase_user_or_403():
         abort(401, description="Falta Authorization Bearer token")
     id_token = auth_header.split(" ", 1)[1]
     try:
-        decoded = fb_auth.verify_id_token(id_token)
+        with span("auth"):
+            decoded = token_cache.verify(id_token)
     except Exception as e:
         logger.warning(f"Auth: token inválido: {e}")
         abort(401, description="Token inválido")
@@ -177,6 +301,40 @@ def _iso_utc(ts):
         return str(ts)
 
 
+def validate_chat_payload(data: dict):
+    """Valida el cuerpo de los endpoints de chat. Devuelve (message, thread_id, (error, status) | None)."""
+    user_message = (data.get("message") or "").strip()
+    thread_id = data.get("thread_id")
+    if not user_message:
+        return None, None, ("message is required", 400)
+    if len(user_message) > 4000:
+        return None, None, ("message too long", 413)
+    return user_message, thread_id, None
+
+
+def _authenticated_chat_request():
+    """
+    (usuario, message, thread_id, error_response) de una petición de chat. Se calculan una
+    vez por petición y quedan en `g`: el decorador de idempotencia los lee antes que la vista.
+    """
+    if "chat_request" not in g:
+        decoded_user = require_firebase_user_or_403()
+        g.chat_request = (decoded_user, *_read_chat_request())
+    return g.chat_request
+
+
+def _read_chat_request():
+    """Valida el cuerpo JSON de los endpoints de chat. Devuelve (message, thread_id, error_response)."""
+    if request.content_type != "application/json":
+        return None, None, fail("Content-Type must be application/json", 415)
+    data = request.get_json(silent=True) or {}
+
+    user_message, thread_id, error = validate_chat_payload(data)
+    if error:
+        return None, None, fail(*error)
+    return user_message, thread_id, None
+
+
 # =============================================================================
 # 4) Bloques y progreso de auditoría
 # =============================================================================
@@ -202,6 +360,28 @@ def _get_audit_progress_doc(thread_id: str):
     return firestore_db.collection("audit_progress").document(thread_id)
 
 
+def _get_thread_doc(thread_id: str):
+    return firestore_db.collection("threads").document(thread_id)
+
+
+@timed("progress_read", "firestore")
+def _read_thread_and_progress(thread_id: str, transaction=None):
+    """Lee el documento del hilo y el de su progreso en un solo `get_all`.
+
+    Si el dueño del hilo ya está en la caché solo se lee el progreso y el hilo vuelve
+    como None (`ensure_thread_ownership` lo resuelve desde la caché).
+    """
+    progress_ref = _get_audit_progress_doc(thread_id)
+    if thread_owners.get(thread_id) is not None:
+        return None, progress_ref.get(transaction=transaction)
+    thread_ref = _get_thread_doc(thread_id)
+    refs = [thread_ref, progress_ref]
+    snaps = transaction.get_all(refs) if transaction is not None else firestore_db.get_all(refs)
+    # get_all no garantiza el orden; los dos documentos comparten id
+    by_path = {snap.reference.path: snap for snap in snaps}
+    return by_path.get(thread_ref.path), by_path.get(progress_ref.path)
+
+
 def _build_audit_progress_payload(thread_id, uid, doc_data):
     data = doc_data or {}
     blocks_state = data.get("blocks") or {}
@@ -252,17 +432,118 @@ def _build_audit_progress_payload(thread_id, uid, doc_data):
 # =============================================================================
 # 5) Propiedad de hilos (security)
 # =============================================================================
-def ensure_thread_ownership(thread_id: str, uid: str):
-    """Registra o valida que el thread pertenece al uid dado."""
-    doc_ref = firestore_db.collection("threads").document(thread_id)
-    snap = doc_ref.get()
-    if snap.exists:
-        data = snap.to_dict() or {}
-        owner = data.get("uid")
-        if owner and owner != uid:
-            abort(403, description="No tienes acceso a este hilo.")
-    else:
-        doc_ref.set({"uid": uid, "created_at": SERVER_TIMESTAMP}, merge=True)
+@timed("ownership")
+def ensure_thread_ownership(thread_id: str, uid: str, snap=None):
+    """Registra o valida que el thread pertenece al uid dado.
+
+    El dueño se busca antes en la caché del worker; `snap` es el documento del hilo si
+    ya se ha leído (p. ej. en un `get_all`).
+    """
+    owner = thread_owners.get(thread_id)
+    if owner is None:
+        doc_ref = _get_thread_doc(thread_id)
+        if snap is None:
+            snap = doc_ref.get()
+        if snap.exists:
+            owner = owner_from_snapshot(snap)
+        else:
+            doc_ref.set(owner_document(uid), merge=True)
+            owner = uid
+        if owner:
+            thread_owners.put(thread_id, owner)
+    if owner and owner != uid:
+        abort(403, description="No tienes acceso a este hilo.")
+
+
+@timed("thread_create", "openai")
+def create_owned_thread(openai_client, uid: str, **kwargs) -> str:
+    """Crea un hilo en OpenAI y lo registra a nombre de `uid` sin leer Firestore."""
+    thread_id = openai_client.beta.threads.create(**kwargs).id
+    register_new_thread(thread_id, uid)
+    return thread_id
+
+
+THREAD_BUSY_MESSAGE = "Ya hay un mensaje en curso en esta conversación. Espera a que termine."
+IDEMPOTENCY_PENDING_MESSAGE = "Este mensaje todavía se está procesando. Inténtalo de nuevo en unos segundos."
+IDEMPOTENCY_MISMATCH_MESSAGE = "Idempotency-Key already used for a different request"
+# Cabeceras de la respuesta original que se repiten al reenviarla (p. ej. el Location de un job)
+IDEMPOTENT_REPLAY_HEADERS = ("Location",)
+
+
+@timed("lease")
+def take_thread_turn(thread_id: str, uid: str, new_thread: bool, ttl_seconds=None):
+    """Toma el turno del hilo (ver src/thread_lease.py). Devuelve (lease, respuesta 409 | None)."""
+    if new_thread:
+        # El hilo lo acaba de crear esta petición: nadie más puede estar escribiendo en él
+        return ThreadLease.unguarded(), None
+    try:
+        return thread_leases.acquire(thread_id, uid, ttl_seconds=ttl_seconds), None
+    except ThreadBusy as exc:
+        return None, _retry_later(THREAD_BUSY_MESSAGE, exc.retry_after, thread_id=thread_id)
+
+
+def _retry_later(message, retry_after, **details):
+    body, status = fail(message, status=409, retry_after=retry_after, **details)
+    body.headers["Retry-After"] = str(retry_after)
+    return body, status
+
+
+def idempotent_chat(scope: str, stream: bool = False):
+    """Aplica la cabecera `Idempotency-Key` (ver src/idempotency.py) a un endpoint de chat.
+
+    `scope` es el mismo para la variante normal y la de streaming de un endpoint: un
+    reintento recibe la respuesta guardada aunque llegue por la otra.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = (request.headers.get("Idempotency-Key") or "").strip()
+            if not key or not idempotency_store.enabled:
+                return view(*args, **kwargs)
+            if len(key) > IDEMPOTENCY_MAX_KEY_LENGTH:
+                return fail("Idempotency-Key too long", 400)
+
+            decoded_user, user_message, thread_id, error = _authenticated_chat_request()
+            if error:
+                return error
+            try:
+                with span("idempotency"):
+                    record = idempotency_store.begin(
+                        decoded_user["uid"], key, scope, request_fingerprint(scope, thread_id, user_message)
+                    )
+            except IdempotencyMismatch:
+                return fail(IDEMPOTENCY_MISMATCH_MESSAGE, 422)
+            except IdempotencyInProgress as exc:
+                return _retry_later(IDEMPOTENCY_PENDING_MESSAGE, exc.retry_after)
+
+            if record.replay is not None:
+                if stream:
+                    return _sse_replay(record.replay["data"])
+                body, _ = ok(record.replay["data"], **record.replay["meta"], replayed=True)
+                body.headers.extend(record.replay.get("headers") or {})
+                return body, record.replay.get("status", 200)
+
+            g.idempotent_request = record
+            try:
+                resp = app.make_response(view(*args, **kwargs))
+            except Exception:
+                idempotency_store.settle(record)
+                raise
+            if resp.is_streamed:
+                # El stream apunta la respuesta al emitir "done"; se guarda al cerrarse
+                resp.call_on_close(lambda: idempotency_store.settle(record))
+                return resp
+            if resp.status_code in (200, 202):
+                body = resp.get_json(silent=True) or {}
+                headers = {name: resp.headers[name] for name in IDEMPOTENT_REPLAY_HEADERS if name in resp.headers}
+                record.complete(body.get("data"), body.get("meta"), status=resp.status_code, headers=headers)
+            idempotency_store.settle(record)
+            return resp
+
+        return wrapper
+
+    return decorator
 
 
 # =============================================================================
@@ -274,30 +555,23 @@ def audit_blocks():
     return ok({"blocks": AUDIT_BLOCKS})
 
 
-@limiter.limit("12/minute; 2/second")
 @app.route("/chat_auditor", methods=["POST"])
+@limiter.limit(AUDITOR_RATE_LIMIT)
+@idempotent_chat("/chat_auditor")
 def chat_with_main_audit_orchestrator():
-    decoded_user = require_firebase_user_or_403()
+    decoded_user, user_message, thread_id, error = _authenticated_chat_request()
+    if error:
+        return error
     persistence_metadata = _build_user_metadata(decoded_user)
 
-    if request.content_type != "application/json":
-        return fail("Content-Type must be application/json", 415)
-    data = request.get_json(silent=True) or {}
-
-    user_message = (data.get("message") or "").strip()
-    thread_id = data.get("thread_id")
-    if not user_message:
-        return fail("message is required", 400)
-    if len(user_message) > 4000:
-        return fail("message too long", 413)
-
     endpoint_name = "/chat_auditor"
-    openai_client = client.with_options(timeout=60.0)
+    openai_client = chat_client
 
-    if not thread_id:
+    new_thread = not thread_id
+    if new_thread:
         try:
-            thread_id = openai_client.beta.threads.create().id
-        except APITimeoutError as exc:
+            thread_id = create_owned_thread(openai_client, decoded_user["uid"])
+        except timeout_errors() as exc:
             logger.warning("%s: timeout creando thread en OpenAI: %s", endpoint_name, exc)
             return fail(
                 "El orquestador tardó demasiado en iniciar la conversación.",
@@ -309,50 +583,28 @@ def chat_with_main_audit_orchestrator():
     # Verifica/Registra propiedad del hilo
     ensure_thread_ownership(thread_id, decoded_user["uid"])
 
-    run = None
+    # Un solo turno a la vez por hilo
+    lease, busy = take_thread_turn(thread_id, decoded_user["uid"], new_thread)
+    if busy is not None:
+        return busy
+    turn = {}
 
     try:
         logger.info(
             f"{endpoint_name}: uid={decoded_user.get('uid')} email={decoded_user.get('email')} thread_id={thread_id}"
         )
 
-        openai_client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=user_message,
-        )
-
-        # Ejecuta orquestador
-        run = openai_client.beta.threads.runs.create_and_poll(
-            thread_id=thread_id,
-            assistant_id=ORCHESTRATOR_ASSISTANT_ID,
-            timeout=180.0,
+        # Ejecuta orquestador (con soporte de herramientas)
+        response_text = run_assistant_turn(
+            openai_client,
+            thread_id,
+            user_message,
+            ORCHESTRATOR_ASSISTANT_ID,
+            endpoint_name,
+            tool_handler=execute_orchestrator_tool_call,
+            turn=turn,
         )
-
-        # Soporte de herramientas si requiere acción
-        if run.status == "requires_action":
-            tool_outputs = []
-            ra = run.required_action
-            for tc in ra.submit_tool_outputs.tool_calls:
-                if tc.function.name == "invoke_sustainability_expert":
-                    args = json.loads(tc.function.arguments or "{}")
-                    query = args.get("query")
-                    output = execute_invoke_sustainability_expert(query, thread_id)
-                    tool_outputs.append({"tool_call_id": tc.id, "output": output})
-
-            if tool_outputs:
-                run = openai_client.beta.threads.runs.submit_tool_outputs_and_poll(
-                    thread_id=thread_id,
-                    run_id=run.id,
-                    tool_outputs=tool_outputs,
-                    timeout=180.0,
-                )
-
-        if run.status != "completed":
-            raise Exception(f"Run ended with status={run.status}. Details: {getattr(run, 'last_error', None)}")
-
-        messages = openai_client.beta.threads.messages.list(thread_id=thread_id, run_id=run.id, order="desc")
-        response_text = process_assistant_message_without_citations(messages.data, run.id, endpoint_name)
+        run = turn["run"]
 
         persist_conversation_turn(
             thread_id,
@@ -370,17 +622,19 @@ def chat_with_main_audit_orchestrator():
                 "thread_id": thread_id,
                 "run_id": run.id,
                 "run_status": run.status,
-            }
+            },
+            polling=turn["polling"],
+            tools=turn["tools"],
         )
 
-    except APITimeoutError as exc:
+    except timeout_errors() as exc:
         logger.warning("%s: timeout esperando respuesta de OpenAI: %s", endpoint_name, exc)
         persist_conversation_turn(
             thread_id,
             user_message,
             "API Timeout: OpenAI no respondió a tiempo.",
             endpoint_name,
-            run_id=getattr(run, "id", None),
+            run_id=getattr(turn.get("run"), "id", None),
             assistant_name="Timeout",
             **persistence_metadata,
         )
@@ -397,37 +651,42 @@ def chat_with_main_audit_orchestrator():
             user_message,
             f"API Error: {e}",
             endpoint_name,
-            run_id=getattr(run, "id", None),
+            run_id=getattr(turn.get("run"), "id", None),
             assistant_name="Exception",
             **persistence_metadata,
         )
         return fail("Internal server error", status=500, details=str(e))
+    finally:
+        thread_leases.release(lease)
 
 
-@limiter.limit("20/minute; 3/second")
 @app.route("/chat_assistant", methods=["POST"])
+@limiter.limit(ASSISTANT_RATE_LIMIT)
+@idempotent_chat("/chat_assistant")
 def chat_with_sustainability_expert():
-    decoded_user = require_firebase_user_or_403()
+    decoded_user, user_message, thread_id, error = _authenticated_chat_request()
+    if error:
+        return error
     persistence_metadata = _build_user_metadata(decoded_user)
 
-    if request.content_type != "application/json":
-        return fail("Content-Type must be application/json", 415)
-    data = request.get_json(silent=True) or {}
-
-    user_message = (data.get("message") or "").strip()
-    thread_id = data.get("thread_id")
-    if not user_message:
-        return fail("message is required", 400)
-    if len(user_message) > 4000:
-        return fail("message too long", 413)
-
     endpoint_name = "/chat_assistant"
-    openai_client = client.with_options(timeout=60.0)
+    openai_client = chat_client
+
+    # Primer mensaje de una conversación: se prueba antes la caché semántica
+    cache_lookup = None
+    if not thread_id and SEMANTIC_CACHE_ENABLED:
+        with span("semantic_cache"):
+            cache_lookup = semantic_cache.lookup(user_message, openai_client)
+        if cache_lookup and cache_lookup["answer"]:
+            return _serve_cached_answer(
+                openai_client, endpoint_name, decoded_user, persistence_metadata, user_message, cache_lookup
+            )
 
-    if not thread_id:
+    new_thread = not thread_id
+    if new_thread:
         try:
-            thread_id = openai_client.beta.threads.create().id
-        except APITimeoutError as exc:
+            thread_id = create_owned_thread(openai_client, decoded_user["uid"])
+        except timeout_errors() as exc:
             logger.warning("%s: timeout creando thread en OpenAI: %s", endpoint_name, exc)
             return fail(
                 "El asistente tardó demasiado en iniciar la conversación.",
@@ -438,30 +697,20 @@ def chat_with_sustainability_expert():
 
     ensure_thread_ownership(thread_id, decoded_user["uid"])
 
-    run = None
+    lease, busy = take_thread_turn(thread_id, decoded_user["uid"], new_thread)
+    if busy is not None:
+        return busy
+    turn = {}
 
     try:
         logger.info(
             f"{endpoint_name}: uid={decoded_user.get('uid')} email={decoded_user.get('email')} thread_id={thread_id}"
         )
 
-        openai_client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=user_message,
-        )
-
-        run = openai_client.beta.threads.runs.create_and_poll(
-            thread_id=thread_id,
-            assistant_id=ASISTENTE_ID,
-            timeout=180.0,
+        response_text = run_assistant_turn(
+            openai_client, thread_id, user_message, ASISTENTE_ID, endpoint_name, turn=turn
         )
-
-        if run.status != "completed":
-            raise Exception(f"Run ended with status={run.status}. Details: {getattr(run, 'last_error', None)}")
-
-        messages = openai_client.beta.threads.messages.list(thread_id=thread_id, run_id=run.id, order="desc")
-        response_text = process_assistant_message_without_citations(messages.data, run.id, endpoint_name)
+        run = turn["run"]
 
         persist_conversation_turn(
             thread_id,
@@ -472,6 +721,8 @@ def chat_with_sustainability_expert():
             assistant_name="SustainabilityExpert",
             **persistence_metadata,
         )
+        if cache_lookup:
+            semantic_cache.remember(user_message, response_text, cache_lookup["embedding"])
 
         return ok(
             {
@@ -479,17 +730,19 @@ def chat_with_sustainability_expert():
                 "thread_id": thread_id,
                 "run_id": run.id,
                 "run_status": run.status,
-            }
+            },
+            polling=turn["polling"],
+            tools=turn["tools"],
         )
 
-    except APITimeoutError as exc:
+    except timeout_errors() as exc:
         logger.warning("%s: timeout esperando respuesta de OpenAI: %s", endpoint_name, exc)
         persist_conversation_turn(
             thread_id,
             user_message,
             "API Timeout: OpenAI no respondió a tiempo.",
             endpoint_name,
-            run_id=getattr(run, "id", None),
+            run_id=getattr(turn.get("run"), "id", None),
             assistant_name="Timeout",
             **persistence_metadata,
         )
@@ -506,11 +759,393 @@ def chat_with_sustainability_expert():
             user_message,
             f"API Error: {e}",
             endpoint_name,
-            run_id=getattr(run, "id", None),
+            run_id=getattr(turn.get("run"), "id", None),
             assistant_name="Exception",
             **persistence_metadata,
         )
         return fail("Internal server error", status=500, details=str(e))
+    finally:
+        thread_leases.release(lease)
+
+
+def _serve_cached_answer(openai_client, endpoint_name, decoded_user, persistence_metadata, user_message, cache_lookup):
+    """Responde desde la caché semántica sin lanzar un run.
+
+    El hilo se crea con la pregunta y la respuesta cacheada para que los mensajes
+    siguientes de la conversación tengan el mismo contexto que si hubiera habido run.
+    """
+    response_text = cache_lookup["answer"]
+    try:
+        thread_id = create_owned_thread(
+            openai_client,
+            decoded_user["uid"],
+            messages=thread_messages_for_cached_answer(user_message, response_text),
+        )
+    except timeout_errors() as exc:
+        logger.warning("%s: timeout creando thread en OpenAI: %s", endpoint_name, exc)
+        return fail(
+            "El asistente tardó demasiado en iniciar la conversación.",
+            status=504,
+            upstream="openai",
+            detail=str(exc),
+        )
+
+    ensure_thread_ownership(thread_id, decoded_user["uid"])
+    logger.info(
+        f"{endpoint_name}: semantic cache hit score={cache_lookup['score']} uid={decoded_user.get('uid')} thread_id={thread_id}"
+    )
+    persist_conversation_turn(
+        thread_id,
+        user_message,
+        response_text,
+        endpoint_name,
+        run_id=None,
+        assistant_name=SEMANTIC_CACHE_ASSISTANT_NAME,
+        **persistence_metadata,
+    )
+    return ok(
+        {
+            "response": response_text,
+            "thread_id": thread_id,
+            "run_id": None,
+            "run_status": "cached",
+        },
+        semantic_cache={"score": cache_lookup["score"], "ms": cache_lookup["ms"]},
+    )
+
+
+def _sse_chat_response(
+    endpoint_name,
+    thread_id,
+    user_message,
+    assistant_id,
+    assistant_name,
+    persistence_metadata,
+    openai_client,
+    tool_handler=None,
+    idempotent_request=None,
+):
+    """Ejecuta el run en streaming y reenvía deltas, estado de herramientas y run_id como SSE."""
+
+    def generate():
+        run_id = None
+        yield format_sse("thread", {"thread_id": thread_id})
+        try:
+            openai_client.beta.threads.messages.create(
+                thread_id=thread_id,
+                role="user",
+                content=user_message,
+            )
+            for event, payload in stream_assistant_run(
+                openai_client, thread_id, assistant_id, tool_handler=tool_handler
+            ):
+                if event == "heartbeat":
+                    yield format_sse_comment()
+                    continue
+                if event == "run":
+                    run_id = payload["run_id"]
+                if event == "done":
+                    persist_conversation_turn(
+                        thread_id,
+                        user_message,
+                        payload["response"],
+                        endpoint_name,
+                        run_id=run_id,
+                        assistant_name=assistant_name,
+                        **persistence_metadata,
+                    )
+                    if idempotent_request is not None:
+                        idempotent_request.complete(payload)
+                yield format_sse(event, payload)
+        except timeout_errors() as exc:
+            logger.warning("%s: timeout en streaming de OpenAI: %s", endpoint_name, exc)
+            persist_conversation_turn(
+                thread_id,
+                user_message,
+                "API Timeout: OpenAI no respondió a tiempo.",
+                endpoint_name,
+                run_id=run_id,
+                assistant_name="Timeout",
+                **persistence_metadata,
+            )
+            yield format_sse(
+                "error",
+                {"message": "OpenAI no respondió a tiempo.", "status": 504, "upstream": "openai", "run_id": run_id},
+            )
+        except Exception as e:
+            logger.error(f"{endpoint_name}: error en streaming: {e}", exc_info=True)
+            persist_conversation_turn(
+                thread_id,
+                user_message,
+                f"API Error: {e}",
+                endpoint_name,
+                run_id=run_id,
+                assistant_name="Exception",
+                **persistence_metadata,
+            )
+            yield format_sse("error", {"message": "Internal server error", "status": 500, "run_id": run_id})
+
+    resp = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    # Evita que proxies intermedios acumulen el stream antes de reenviarlo
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+def _sse_replay(data):
+    """Stream con la respuesta guardada de un reintento con la misma Idempotency-Key."""
+
+    def generate():
+        yield format_sse("thread", {"thread_id": data["thread_id"]})
+        yield format_sse("done", dict(data, replayed=True))
+
+    return Response(generate(), mimetype="text/event-stream")
+
+
+def _start_streaming_chat(endpoint_name, assistant_id, assistant_name, tool_handler=None):
+    decoded_user, user_message, thread_id, error = _authenticated_chat_request()
+    if error:
+        return error
+    persistence_metadata = _build_user_metadata(decoded_user)
+
+    openai_client = chat_client
+
+    new_thread = not thread_id
+    if new_thread:
+        try:
+            thread_id = create_owned_thread(openai_client, decoded_user["uid"])
+        except timeout_errors() as exc:
+            logger.warning("%s: timeout creando thread en OpenAI: %s", endpoint_name, exc)
+            return fail(
+                "OpenAI tardó demasiado en iniciar la conversación.",
+                status=504,
+                upstream="openai",
+                detail=str(exc),
+            )
+
+    ensure_thread_ownership(thread_id, decoded_user["uid"])
+
+    lease, busy = take_thread_turn(thread_id, decoded_user["uid"], new_thread)
+    if busy is not None:
+        return busy
+    logger.info(
+        f"{endpoint_name}: uid={decoded_user.get('uid')} email={decoded_user.get('email')} thread_id={thread_id}"
+    )
+
+    resp = _sse_chat_response(
+        endpoint_name,
+        thread_id,
+        user_message,
+        assistant_id,
+        assistant_name,
+        persistence_metadata,
+        openai_client,
+        tool_handler=tool_handler,
+        idempotent_request=g.get("idempotent_request"),
+    )
+    # Se libera al cerrar la respuesta: también si el cliente corta antes de que empiece el stream
+    resp.call_on_close(lambda: thread_leases.release(lease))
+    return resp
+
+
+@app.route("/chat_auditor/stream", methods=["POST"])
+@limiter.limit(AUDITOR_RATE_LIMIT)
+@idempotent_chat("/chat_auditor", stream=True)
+def chat_with_main_audit_orchestrator_stream():
+    """Igual que /chat_auditor pero devuelve la respuesta como text/event-stream."""
+    return _start_streaming_chat(
+        "/chat_auditor/stream",
+        ORCHESTRATOR_ASSISTANT_ID,
+        "MainAuditOrchestrator",
+        tool_handler=execute_orchestrator_tool_call,
+    )
+
+
+@app.route("/chat_assistant/stream", methods=["POST"])
+@limiter.limit(ASSISTANT_RATE_LIMIT)
+@idempotent_chat("/chat_assistant", stream=True)
+def chat_with_sustainability_expert_stream():
+    """Igual que /chat_assistant pero devuelve la respuesta como text/event-stream."""
+    return _start_streaming_chat("/chat_assistant/stream", ASISTENTE_ID, "SustainabilityExpert")
+
+
+@app.route("/chat_auditor/jobs", methods=["POST"])
+@limiter.limit(AUDITOR_RATE_LIMIT)
+@idempotent_chat("/chat_auditor/jobs")
+def submit_main_audit_orchestrator_job():
+    """Como /chat_auditor, pero responde 202 con un job_id y el run sigue en segundo plano."""
+    decoded_user, user_message, thread_id, error = _authenticated_chat_request()
+    if error:
+        return error
+    persistence_metadata = _build_user_metadata(decoded_user)
+
+    endpoint_name = "/chat_auditor/jobs"
+    openai_client = chat_client
+
+    new_thread = not thread_id
+    if new_thread:
+        try:
+            thread_id = create_owned_thread(openai_client, decoded_user["uid"])
+        except timeout_errors() as exc:
+            logger.warning("%s: timeout creando thread en OpenAI: %s", endpoint_name, exc)
+            return fail(
+                "El orquestador tardó demasiado en iniciar la conversación.",
+                status=504,
+                upstream="openai",
+                detail=str(exc),
+            )
+
+    ensure_thread_ownership(thread_id, decoded_user["uid"])
+
+    # El hilo queda tomado hasta que termine el job (con el plazo de los jobs, no el de un
+    # turno). También si es nuevo: el run sigue después de responder con su thread_id.
+    lease, busy = take_thread_turn(thread_id, decoded_user["uid"], False, ttl_seconds=CHAT_JOB_DEADLINE_SECONDS + 60)
+    if busy is not None:
+        return busy
+
+    try:
+        job_id = chat_jobs.submit(
+            decoded_user["uid"],
+            thread_id,
+            endpoint_name,
+            functools.partial(
+                _run_orchestrator_job, openai_client, thread_id, user_message, endpoint_name, persistence_metadata, lease
+            ),
+        )
+    except Exception as e:
+        thread_leases.release(lease)
+        logger.error(f"{endpoint_name}: no se pudo crear el job: {e}", exc_info=True)
+        return fail("Internal server error", status=500, details=str(e))
+
+    logger.info(
+        f"{endpoint_name}: uid={decoded_user.get('uid')} email={decoded_user.get('email')} thread_id={thread_id} job_id={job_id}"
+    )
+    body, _ = ok(
+        {"job_id": job_id, "thread_id": thread_id, "status": "queued"},
+        poll=f"/jobs/{job_id}",
+        events=f"/jobs/{job_id}/events",
+    )
+    body.headers["Location"] = f"/jobs/{job_id}"
+    return body, 202
+
+
+def _run_orchestrator_job(openai_client, thread_id, user_message, endpoint_name, persistence_metadata, lease):
+    """Turno del orquestador dentro de un job (ver src/chat_jobs.py). Devuelve (data, meta)."""
+    turn = {}
+    try:
+        response_text = run_assistant_turn(
+            openai_client,
+            thread_id,
+            user_message,
+            ORCHESTRATOR_ASSISTANT_ID,
+            endpoint_name,
+            tool_handler=execute_orchestrator_tool_call,
+            turn=turn,
+            budget=TurnBudget(CHAT_JOB_DEADLINE_SECONDS),
+        )
+        run = turn["run"]
+        persist_conversation_turn(
+            thread_id,
+            user_message,
+            response_text,
+            endpoint_name,
+            run_id=run.id,
+            assistant_name="MainAuditOrchestrator",
+            **persistence_metadata,
+        )
+        return (
+            {"response": response_text, "thread_id": thread_id, "run_id": run.id, "run_status": run.status},
+            {"polling": turn.get("polling"), "tools": turn.get("tools")},
+        )
+    except timeout_errors() as exc:
+        logger.warning("%s: timeout esperando respuesta de OpenAI: %s", endpoint_name, exc)
+        persist_conversation_turn(
+            thread_id,
+            user_message,
+            "API Timeout: OpenAI no respondió a tiempo.",
+            endpoint_name,
+            run_id=getattr(turn.get("run"), "id", None),
+            assistant_name="Timeout",
+            **persistence_metadata,
+        )
+        raise ChatJobError("El orquestador no respondió a tiempo.", status=504, upstream="openai", detail=str(exc))
+    except Exception as e:
+        logger.error(f"{endpoint_name}: error: {e}", exc_info=True)
+        persist_conversation_turn(
+            thread_id,
+            user_message,
+            f"API Error: {e}",
+            endpoint_name,
+            run_id=getattr(turn.get("run"), "id", None),
+            assistant_name="Exception",
+            **persistence_metadata,
+        )
+        raise ChatJobError("Internal server error", status=500, details=str(e))
+    finally:
+        thread_leases.release(lease)
+
+
+def _read_owned_job(job_id: str, uid: str):
+    """Documento del job si pertenece al usuario; si no, None (se responde 404 en ambos casos)."""
+    doc = chat_jobs.get(job_id)
+    if doc is None or doc.get("uid") != uid:
+        return None
+    return doc
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_chat_job(job_id: str):
+    """Estado de un job. Con `?wait=N` espera hasta N segundos (máx. CHAT_JOB_MAX_WAIT_SECONDS) a que termine."""
+    decoded_user = require_firebase_user_or_403()
+    try:
+        wait = min(float(request.args.get("wait", 0)), CHAT_JOB_MAX_WAIT_SECONDS)
+    except ValueError:
+        return fail("wait must be a number", 400)
+
+    doc = _read_owned_job(job_id, decoded_user["uid"])
+    if doc is None:
+        return fail("Job not found", 404)
+    if wait > 0 and doc.get("status") not in TERMINAL_STATUSES:
+        doc = chat_jobs.wait(job_id, wait) or doc
+    return ok(job_payload(job_id, doc))
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def stream_chat_job(job_id: str):
+    """
+    Estado de un job como text/event-stream: `status` en cada cambio y `done`/`error` al
+    terminar. La conexión dura como mucho CHAT_JOB_SSE_WINDOW_SECONDS: si el job sigue en
+    curso se cierra con un evento `reconnect` y EventSource vuelve a abrirla tras `retry:`.
+    """
+    decoded_user = require_firebase_user_or_403()
+    doc = _read_owned_job(job_id, decoded_user["uid"])
+    if doc is None:
+        return fail("Job not found", 404)
+
+    def generate():
+        current, last_status = doc, None
+        window_ends = time.monotonic() + CHAT_JOB_SSE_WINDOW_SECONDS
+        yield format_sse_retry(CHAT_JOB_SSE_RETRY_MS)
+        while True:
+            if current is None:
+                yield format_sse("error", {"message": "Job not found", "status": 404})
+                return
+            status = current.get("status")
+            if status != last_status:
+                last_status = status
+                yield format_sse("status", {"job_id": job_id, "status": status})
+            if status in TERMINAL_STATUSES:
+                yield format_sse("done" if status == "done" else "error", job_payload(job_id, current))
+                return
+            remaining = window_ends - time.monotonic()
+            if remaining <= 0:
+                yield format_sse("reconnect", {"job_id": job_id, "status": status, "retry_ms": CHAT_JOB_SSE_RETRY_MS})
+                return
+            yield format_sse_comment()
+            current = chat_jobs.wait(job_id, min(SSE_HEARTBEAT_SECONDS, remaining))
+
+    resp = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
 
 
 @app.route("/chat_history/recents", methods=["GET"])
@@ -524,7 +1159,14 @@ def get_recent_chat_history():
         limit = 5
 
     try:
-        conversations = fetch_recent_conversations_for_user(uid=uid, limit=limit)
+        conversations = None
+        if HISTORY_STORE == "firestore":
+            try:
+                conversations = history_store.recent_threads(uid, max(1, min(limit, 20)))
+            except Exception as exc:
+                logger.warning("HistoryStore: recents for uid=%s failed, falling back to BigQuery: %s", uid, exc)
+        if conversations is None:
+            conversations = fetch_recent_conversations_for_user(uid=uid, limit=limit)
         return ok({"conversations": conversations})
     except ValueError as err:
         return fail(str(err), status=400)
@@ -533,9 +1175,94 @@ def get_recent_chat_history():
         return fail("No se pudo obtener el historial reciente.", status=500)
 
 
+# Máximo de turnos por página en /chat_history/thread
+HISTORY_PAGE_MAX_TURNS = 200
+
+
+def _encode_history_cursor(timestamp_iso: str, turn_key: str) -> str:
+    """Cursor opaco de `meta.page`: timestamp y turn_key del turno (ver TurnCursor)."""
+    raw = f"{timestamp_iso}|{turn_key}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _parse_cursor_timestamp(raw: str) -> datetime.datetime:
+    # Un "+00:00" sin codificar en la URL llega como espacio
+    value = datetime.datetime.fromisoformat(raw.strip().replace(" ", "+").replace("Z", "+00:00"))
+    return value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+
+
+def _read_history_cursor(name: str):
+    """
+    Cursor de paginación (timestamp, turn_key) de la query string; None si no viene. Acepta
+    el cursor opaco de `meta.page` o, como antes, un timestamp ISO 8601 (sin desempate).
+    """
+    raw = (request.args.get(name) or "").strip()
+    if not raw:
+        return None
+    try:
+        return _parse_cursor_timestamp(raw), None
+    except ValueError:
+        pass
+    try:
+        decoded = base64.urlsafe_b64decode(raw + "=" * (-len(raw) % 4)).decode("utf-8")
+        timestamp_iso, turn_key = decoded.split("|", 1)
+        return _parse_cursor_timestamp(timestamp_iso), turn_key
+    except ValueError:
+        raise ValueError(f"'{name}' must be a page cursor or an ISO 8601 timestamp")
+
+
+def _page_cursor(turn, requested):
+    """Cursor de `meta.page` en un extremo de la página; sin turnos, el que se pidió."""
+    if turn is not None:
+        return _encode_history_cursor(turn["timestamp"], turn["turn_key"])
+    if requested is None:
+        return None
+    timestamp, turn_key = requested
+    # Un timestamp ISO se devuelve tal cual para no cambiar su semántica
+    return timestamp.isoformat() if turn_key is None else _encode_history_cursor(timestamp.isoformat(), turn_key)
+
+
+def _thread_turns(uid, thread_id, before=None, after=None, limit=None):
+    """Iterador de turnos del hilo y su endpoint_source: Firestore si lo tiene, si no BigQuery."""
+    if HISTORY_STORE == "firestore":
+        try:
+            summary = history_store.thread_summary(uid, thread_id)
+            if summary is not None:
+                return history_store.iter_turns(thread_id, before, after, limit), summary.get("endpoint_source")
+        except Exception as exc:
+            logger.warning("HistoryStore: thread %s failed, falling back to BigQuery: %s", thread_id, exc)
+    # Hilos anteriores al almacén (sin backfill) se leen de BigQuery
+    return iter_conversation_turns(uid, thread_id, before, after, limit), None
+
+
+def _stream_thread_json(thread_id, turns, endpoint_source):
+    """Serializa la conversación completa a medida que llegan los turnos."""
+    yield '{"ok": true, "data": {"thread_id": %s, "messages": [' % json.dumps(thread_id)
+    count = 0
+    try:
+        for turn in turns:
+            endpoint_source = endpoint_source or turn["endpoint_source"]
+            for message in turn_messages(turn["timestamp"], turn["user_message"], turn["assistant_response"]):
+                yield ("," if count else "") + json.dumps(message)
+                count += 1
+    except Exception as exc:
+        # Las cabeceras ya se enviaron: solo se puede cortar la respuesta
+        logger.error("Failed while streaming chat thread %s: %s", thread_id, exc, exc_info=True)
+        raise
+    yield '], "endpoint_source": %s, "total_messages": %d}}' % (json.dumps(endpoint_source), count)
+
+
 @app.route("/chat_history/thread/<thread_id>", methods=["GET"])
 def get_chat_history_thread(thread_id: str):
-    """Devuelve todos los mensajes de una conversación concreta si pertenece al usuario."""
+    """
+    Devuelve los mensajes de una conversación concreta si pertenece al usuario.
+
+    Sin parámetros devuelve la conversación completa (serializada en streaming). Para
+    paginar por turnos: `limit` con `before=<cursor>` (turnos anteriores; sin cursor, los
+    más recientes) o `after=<cursor>` (turnos siguientes). `since=<cursor>` devuelve solo
+    los turnos nuevos desde el último que tiene el cliente. `meta.page` incluye `has_more`
+    y los cursores opacos `before`/`after` de la página; también se acepta un timestamp.
+    """
     decoded_user = require_firebase_user_or_403()
     uid = decoded_user.get("uid")
 
@@ -543,8 +1270,56 @@ def get_chat_history_thread(thread_id: str):
     ensure_thread_ownership(thread_id, uid)
 
     try:
-        conversation = fetch_conversation_thread(uid=uid, thread_id=thread_id)
-        return ok(conversation)
+        before = _read_history_cursor("before")
+        after = _read_history_cursor("after") or _read_history_cursor("since")
+        limit = request.args.get("limit", type=int)
+    except ValueError as err:
+        return fail(str(err), status=400)
+    if before and after:
+        return fail("use either 'before' or 'after'/'since', not both", status=400)
+    if request.args.get("since") and limit is None:
+        limit = HISTORY_PAGE_MAX_TURNS
+    if limit is not None:
+        limit = max(1, min(limit, HISTORY_PAGE_MAX_TURNS))
+
+    try:
+        if limit is None:
+            turns, endpoint_source = _thread_turns(uid, thread_id)
+            # El primer turno se lee antes de responder para que un fallo de la consulta sea un 500
+            first = next(turns, None)
+            pending = itertools.chain([first], turns) if first is not None else iter(())
+            return Response(
+                stream_with_context(_stream_thread_json(thread_id, pending, endpoint_source)),
+                mimetype="application/json",
+            )
+
+        # Se pide un turno de más para saber si hay más páginas
+        turns, endpoint_source = _thread_turns(uid, thread_id, before, after, limit + 1)
+        turns = list(turns)
+        has_more = len(turns) > limit
+        if has_more:
+            turns = turns[:limit] if after else turns[1:]
+
+        messages = []
+        for turn in turns:
+            endpoint_source = endpoint_source or turn["endpoint_source"]
+            messages.extend(turn_messages(turn["timestamp"], turn["user_message"], turn["assistant_response"]))
+
+        page = {
+            "limit": limit,
+            "has_more": has_more,
+            "before": _page_cursor(turns[0] if turns else None, before),
+            "after": _page_cursor(turns[-1] if turns else None, after),
+        }
+        return ok(
+            {
+                "thread_id": thread_id,
+                "endpoint_source": endpoint_source,
+                "messages": messages,
+                "total_messages": len(messages),
+            },
+            page=page,
+        )
     except ValueError as err:
         return fail(str(err), status=400)
     except Exception as exc:
@@ -558,22 +1333,23 @@ def get_audit_progress(thread_id: str):
     decoded_user = require_firebase_user_or_403()
     uid = decoded_user.get("uid")
 
-    # Seguridad: el hilo debe pertenecer al usuario
-    ensure_thread_ownership(thread_id, uid)
-
     try:
-        doc = _get_audit_progress_doc(thread_id).get()
-        if doc.exists:
-            data = doc.to_dict() or {}
-            stored_uid = data.get("uid")
-            if stored_uid and stored_uid != uid:
-                abort(403, description="No tienes acceso a este progreso de auditoria.")
-        else:
-            data = _default_audit_progress_state(uid=uid)
+        thread_snap, doc = _read_thread_and_progress(thread_id)
     except Exception as exc:
         logger.error("Failed to fetch audit progress for thread=%s: %s", thread_id, exc, exc_info=True)
         return fail("No se pudo obtener el progreso de auditoria.", status=500)
 
+    # Seguridad: el hilo debe pertenecer al usuario
+    ensure_thread_ownership(thread_id, uid, snap=thread_snap)
+
+    if doc is not None and doc.exists:
+        data = doc.to_dict() or {}
+        stored_uid = data.get("uid")
+        if stored_uid and stored_uid != uid:
+            abort(403, description="No tienes acceso a este progreso de auditoria.")
+    else:
+        data = _default_audit_progress_state(uid=uid)
+
     payload = _build_audit_progress_payload(thread_id, uid, data)
     return ok(payload)
 
@@ -584,9 +1360,6 @@ def update_audit_progress(thread_id: str):
     decoded_user = require_firebase_user_or_403()
     uid = decoded_user.get("uid")
 
-    # Seguridad: el hilo debe pertenecer al usuario
-    ensure_thread_ownership(thread_id, uid)
-
     body = request.get_json(silent=True) or {}
     block_id = body.get("block_id")
     status = (body.get("status") or "completed").strip().lower()
@@ -603,8 +1376,11 @@ def update_audit_progress(thread_id: str):
 
     @firestore.transactional
     def _tx_update_progress(tx, ref, _uid, _block_id, _status, _summary):
-        snap = ref.get(transaction=tx)
-        if snap.exists:
+        # Propiedad del hilo y progreso en la misma lectura de la transacción
+        thread_snap, snap = _read_thread_and_progress(thread_id, transaction=tx)
+        # Seguridad: el hilo debe pertenecer al usuario
+        ensure_thread_ownership(thread_id, _uid, snap=thread_snap)
+        if snap is not None and snap.exists:
             data = snap.to_dict() or {}
             stored_uid = data.get("uid")
             if stored_uid and stored_uid != _uid:
@@ -628,7 +1404,10 @@ def update_audit_progress(thread_id: str):
 
     try:
         tx = firestore_db.transaction()
-        data = _tx_update_progress(tx, doc_ref, uid, block_id, status, summary)
+        with span("progress_write", "firestore"):
+            data = _tx_update_progress(tx, doc_ref, uid, block_id, status, summary)
+    except HTTPException:
+        raise
     except Exception as exc:
         logger.error(
             "Failed to update audit progress thread=%s block=%s: %s", thread_id, block_id, exc, exc_info=True
@@ -645,6 +1424,18 @@ def health_check():
     return ok({"status": "healthy"})
 
 
+@app.route("/metrics", methods=["GET"])
+@limiter.exempt
+def prometheus_metrics():
+    """Métricas de Prometheus de todos los workers (ver src/metrics.py)."""
+    if not metrics.METRICS_ENABLED:
+        abort(404)
+    if not metrics.authorized(request.headers.get("Authorization")):
+        return fail("Unauthorized", status=401)
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
 @app.route("/readyz", methods=["GET"])
 def readyz():
     """Comprobación de dependencias: Firestore (y opcional OpenAI si quieres añadir)."""
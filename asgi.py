@@ -0,0 +1,494 @@
+# asgi.py
+"""
+Modo de servicio asyncio (SERVER_MODE=asgi).
+
+Los endpoints de chat (/chat_auditor y /chat_assistant) se sirven de forma nativa con
+`openai.AsyncOpenAI` y Firestore asíncrono: mientras un run está en OpenAI el worker no
+queda bloqueado, así que la concurrencia la limita la memoria y no el número de workers.
+El resto de rutas se delegan tal cual en la app Flask de `app.py`.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+"""
+import asyncio
+import contextlib
+import json
+import time
+import uuid
+
+from a2wsgi import WSGIMiddleware
+from firebase_admin import firestore_async
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+from app import (
+    IDEMPOTENCY_MISMATCH_MESSAGE,
+    IDEMPOTENCY_PENDING_MESSAGE,
+    THREAD_BUSY_MESSAGE,
+    app as flask_app,
+    _allowed_origins,
+    _build_user_metadata,
+    validate_chat_payload,
+)
+from src.auth_cache import token_cache
+from src.config import (
+    logger,
+    aprewarm_openai,
+    async_chat_client,
+    async_client,
+    LazyClient,
+    warm_clients,
+    ORCHESTRATOR_ASSISTANT_ID,
+    ASISTENTE_ID,
+)
+from src.chat_service import arun_assistant_turn
+from src.run_poller import timeout_errors
+from src.openai_service import aexecute_orchestrator_tool_call
+from src.persistence_service import persist_conversation_turn
+from src.rate_limit import ASSISTANT_RATE_LIMIT, AUDITOR_RATE_LIMIT, shared_rate_limiter
+from src.thread_ownership import owner_document, owner_from_snapshot, register_new_thread, thread_owners
+from src.thread_lease import ThreadBusy, ThreadLease, thread_leases
+from src.timing import SERVER_TIMING_ENABLED, end_request, span, start_request
+from src import metrics
+from src.idempotency import (
+    IDEMPOTENCY_MAX_KEY_LENGTH,
+    IdempotencyInProgress,
+    IdempotencyMismatch,
+    idempotency_store,
+    request_fingerprint,
+)
+from src.semantic_cache import (
+    SEMANTIC_CACHE_ASSISTANT_NAME,
+    SEMANTIC_CACHE_ENABLED,
+    semantic_cache,
+    thread_messages_for_cached_answer,
+)
+
+# `app.py` ya ha inicializado Firebase Admin al importarse. El cliente asyncio se crea en su
+# primer uso, ya dentro del event loop del worker.
+firestore_db_async = LazyClient("Firestore async", firestore_async.client)
+
+# Los clientes síncronos los precalienta `app.start_worker`
+warm_clients(async_client)
+
+_SECURITY_HEADERS = {
+    "Cache-Control": "no-store",
+    "X-Content-Type-Options": "nosniff",
+    "X-Frame-Options": "DENY",
+    "Referrer-Policy": "no-referrer",
+}
+
+
+# =============================================================================
+# Utilidades de respuesta (mismo formato que ok()/fail() en app.py)
+# =============================================================================
+def ok(data, **meta):
+    resp = {"ok": True, "data": data}
+    if meta:
+        resp["meta"] = meta
+    return JSONResponse(resp, status_code=200)
+
+
+def fail(message, status=400, **details):
+    return JSONResponse({"ok": False, "error": {"message": message, **details}}, status_code=status)
+
+
+# =============================================================================
+# Autenticación y propiedad de hilos
+# =============================================================================
+async def require_firebase_user_or_403(request: Request) -> dict:
+    """Versión asyncio de la verificación de ID token de `app.py`."""
+    auth_header = request.headers.get("Authorization", "")
+    if not auth_header.startswith("Bearer "):
+        raise HTTPException(401, detail="Falta Authorization Bearer token")
+    id_token = auth_header.split(" ", 1)[1]
+    try:
+        # Un acierto de la caché no necesita salir del bucle de eventos
+        with span("auth"):
+            decoded = token_cache.lookup(id_token) or await asyncio.to_thread(token_cache.verify, id_token)
+    except Exception as e:
+        logger.warning(f"Auth: token inválido: {e}")
+        raise HTTPException(401, detail="Token inválido")
+    if not decoded.get("email_verified", False):
+        raise HTTPException(403, detail="Email no verificado")
+    return decoded
+
+
+async def ensure_thread_ownership(thread_id: str, uid: str):
+    """Registra o valida que el thread pertenece al uid dado (caché del worker y Firestore asíncrono)."""
+    owner = thread_owners.get(thread_id)
+    if owner is None:
+        with span("ownership"):
+            doc_ref = firestore_db_async.collection("threads").document(thread_id)
+            snap = await doc_ref.get()
+            if snap.exists:
+                owner = owner_from_snapshot(snap)
+            else:
+                await doc_ref.set(owner_document(uid), merge=True)
+                owner = uid
+        if owner:
+            thread_owners.put(thread_id, owner)
+    if owner and owner != uid:
+        raise HTTPException(403, detail="No tienes acceso a este hilo.")
+
+
+async def create_owned_thread(openai_client, uid: str, **kwargs) -> str:
+    """Crea un hilo en OpenAI y lo registra a nombre de `uid` sin leer Firestore."""
+    with span("thread_create", "openai"):
+        thread = await openai_client.beta.threads.create(**kwargs)
+    register_new_thread(thread.id, uid)
+    return thread.id
+
+
+async def take_thread_turn(thread_id: str, uid: str, new_thread: bool):
+    """Versión asyncio de `take_thread_turn` de app.py: la espera no bloquea el bucle de eventos."""
+    if new_thread:
+        return ThreadLease.unguarded(), None
+    try:
+        with span("lease"):
+            return await thread_leases.aacquire(thread_id, uid), None
+    except ThreadBusy as exc:
+        return None, _retry_later(THREAD_BUSY_MESSAGE, exc.retry_after, thread_id=thread_id)
+
+
+def _retry_later(message, retry_after, **details):
+    resp = fail(message, status=409, retry_after=retry_after, **details)
+    resp.headers["Retry-After"] = str(retry_after)
+    return resp
+
+
+async def idempotent_chat(request: Request, scope: str, uid: str, user_message: str, thread_id, answer):
+    """Versión asyncio de `idempotent_chat` de app.py. `answer` atiende la petición si no hay respuesta guardada."""
+    key = (request.headers.get("Idempotency-Key") or "").strip()
+    if not key or not idempotency_store.enabled:
+        return await answer()
+    if len(key) > IDEMPOTENCY_MAX_KEY_LENGTH:
+        return fail("Idempotency-Key too long", 400)
+    try:
+        with span("idempotency"):
+            record = await idempotency_store.abegin(uid, key, scope, request_fingerprint(scope, thread_id, user_message))
+    except IdempotencyMismatch:
+        return fail(IDEMPOTENCY_MISMATCH_MESSAGE, 422)
+    except IdempotencyInProgress as exc:
+        return _retry_later(IDEMPOTENCY_PENDING_MESSAGE, exc.retry_after)
+    if record.replay is not None:
+        return ok(record.replay["data"], **record.replay["meta"], replayed=True)
+
+    try:
+        resp = await answer()
+        if resp.status_code == 200:
+            body = json.loads(resp.body)
+            record.complete(body.get("data"), body.get("meta"))
+        return resp
+    finally:
+        await asyncio.to_thread(idempotency_store.settle, record)
+
+
+# =============================================================================
+# Endpoints de chat
+# =============================================================================
+async def _chat_turn(
+    request: Request,
+    endpoint_name: str,
+    assistant_id: str,
+    assistant_name: str,
+    agent_label: str,
+    rate_limit: str,
+    tool_handler=None,
+    use_semantic_cache: bool = False,
+):
+    decoded_user = await require_firebase_user_or_403(request)
+    persistence_metadata = _build_user_metadata(decoded_user)
+
+    # Mismos límites por uid que Flask-Limiter en app.py, sobre el mismo almacenamiento
+    with span("rate_limit"):
+        allowed, retry_after = await asyncio.to_thread(
+            shared_rate_limiter().hit, rate_limit, "uid:" + decoded_user["uid"], endpoint_name
+        )
+    if not allowed:
+        resp = fail("Demasiadas peticiones. Inténtalo de nuevo en unos segundos.", status=429, retry_after=retry_after)
+        resp.headers["Retry-After"] = str(retry_after)
+        return resp
+
+    if request.headers.get("content-type") != "application/json":
+        return fail("Content-Type must be application/json", 415)
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    user_message, thread_id, error = validate_chat_payload(data if isinstance(data, dict) else {})
+    if error:
+        return fail(*error)
+
+    async def answer():
+        return await _answer_chat_turn(
+            endpoint_name,
+            assistant_id,
+            assistant_name,
+            agent_label,
+            decoded_user,
+            persistence_metadata,
+            user_message,
+            thread_id,
+            tool_handler=tool_handler,
+            use_semantic_cache=use_semantic_cache,
+        )
+
+    # Los reintentos con la misma Idempotency-Key reciben la respuesta del primero
+    return await idempotent_chat(request, endpoint_name, decoded_user["uid"], user_message, thread_id, answer)
+
+
+async def _answer_chat_turn(
+    endpoint_name: str,
+    assistant_id: str,
+    assistant_name: str,
+    agent_label: str,
+    decoded_user: dict,
+    persistence_metadata: dict,
+    user_message: str,
+    thread_id,
+    tool_handler=None,
+    use_semantic_cache: bool = False,
+):
+    openai_client = async_chat_client
+
+    # Primer mensaje de una conversación: se prueba antes la caché semántica
+    cache_lookup = None
+    if not thread_id and use_semantic_cache and SEMANTIC_CACHE_ENABLED:
+        with span("semantic_cache"):
+            cache_lookup = await asyncio.to_thread(semantic_cache.lookup, user_message)
+        if cache_lookup and cache_lookup["answer"]:
+            return await _serve_cached_answer(
+                openai_client, endpoint_name, agent_label, decoded_user, persistence_metadata, user_message, cache_lookup
+            )
+
+    new_thread = not thread_id
+    if new_thread:
+        try:
+            thread_id = await create_owned_thread(openai_client, decoded_user["uid"])
+        except timeout_errors() as exc:
+            logger.warning("%s: timeout creando thread en OpenAI: %s", endpoint_name, exc)
+            return fail(
+                f"El {agent_label} tardó demasiado en iniciar la conversación.",
+                status=504,
+                upstream="openai",
+                detail=str(exc),
+            )
+
+    await ensure_thread_ownership(thread_id, decoded_user["uid"])
+
+    # Un solo turno a la vez por hilo
+    lease, busy = await take_thread_turn(thread_id, decoded_user["uid"], new_thread)
+    if busy is not None:
+        return busy
+
+    turn = {}
+
+    try:
+        logger.info(
+            f"{endpoint_name}: uid={decoded_user.get('uid')} email={decoded_user.get('email')} thread_id={thread_id}"
+        )
+
+        response_text = await arun_assistant_turn(
+            openai_client,
+            thread_id,
+            user_message,
+            assistant_id,
+            endpoint_name,
+            tool_handler=tool_handler,
+            turn=turn,
+        )
+        run = turn["run"]
+
+        await asyncio.to_thread(
+            persist_conversation_turn,
+            thread_id,
+            user_message,
+            response_text,
+            endpoint_name,
+            run_id=run.id,
+            assistant_name=assistant_name,
+            **persistence_metadata,
+        )
+        if cache_lookup:
+            semantic_cache.remember(user_message, response_text, cache_lookup["embedding"])
+
+        return ok(
+            {
+                "response": response_text,
+                "thread_id": thread_id,
+                "run_id": run.id,
+                "run_status": run.status,
+            },
+            polling=turn["polling"],
+            tools=turn["tools"],
+        )
+
+    except timeout_errors() as exc:
+        logger.warning("%s: timeout esperando respuesta de OpenAI: %s", endpoint_name, exc)
+        await asyncio.to_thread(
+            persist_conversation_turn,
+            thread_id,
+            user_message,
+            "API Timeout: OpenAI no respondió a tiempo.",
+            endpoint_name,
+            run_id=getattr(turn.get("run"), "id", None),
+            assistant_name="Timeout",
+            **persistence_metadata,
+        )
+        return fail(
+            f"El {agent_label} no respondió a tiempo. Inténtalo de nuevo en unos segundos.",
+            status=504,
+            upstream="openai",
+            detail=str(exc),
+        )
+    except Exception as e:
+        logger.error(f"{endpoint_name}: error: {e}", exc_info=True)
+        await asyncio.to_thread(
+            persist_conversation_turn,
+            thread_id,
+            user_message,
+            f"API Error: {e}",
+            endpoint_name,
+            run_id=getattr(turn.get("run"), "id", None),
+            assistant_name="Exception",
+            **persistence_metadata,
+        )
+        return fail("Internal server error", status=500, details=str(e))
+    finally:
+        await asyncio.to_thread(thread_leases.release, lease)
+
+
+async def _serve_cached_answer(
+    openai_client, endpoint_name, agent_label, decoded_user, persistence_metadata, user_message, cache_lookup
+):
+    """Responde desde la caché semántica sin lanzar un run (ver `_serve_cached_answer` en app.py)."""
+    response_text = cache_lookup["answer"]
+    try:
+        thread_id = await create_owned_thread(
+            openai_client,
+            decoded_user["uid"],
+            messages=thread_messages_for_cached_answer(user_message, response_text),
+        )
+    except timeout_errors() as exc:
+        logger.warning("%s: timeout creando thread en OpenAI: %s", endpoint_name, exc)
+        return fail(
+            f"El {agent_label} tardó demasiado en iniciar la conversación.",
+            status=504,
+            upstream="openai",
+            detail=str(exc),
+        )
+
+    await ensure_thread_ownership(thread_id, decoded_user["uid"])
+    logger.info(
+        f"{endpoint_name}: semantic cache hit score={cache_lookup['score']} uid={decoded_user.get('uid')} thread_id={thread_id}"
+    )
+    await asyncio.to_thread(
+        persist_conversation_turn,
+        thread_id,
+        user_message,
+        response_text,
+        endpoint_name,
+        run_id=None,
+        assistant_name=SEMANTIC_CACHE_ASSISTANT_NAME,
+        **persistence_metadata,
+    )
+    return ok(
+        {
+            "response": response_text,
+            "thread_id": thread_id,
+            "run_id": None,
+            "run_status": "cached",
+        },
+        semantic_cache={"score": cache_lookup["score"], "ms": cache_lookup["ms"]},
+    )
+
+
+async def chat_with_main_audit_orchestrator(request: Request):
+    return await _chat_turn(
+        request,
+        "/chat_auditor",
+        ORCHESTRATOR_ASSISTANT_ID,
+        "MainAuditOrchestrator",
+        "orquestador",
+        AUDITOR_RATE_LIMIT,
+        tool_handler=aexecute_orchestrator_tool_call,
+    )
+
+
+async def chat_with_sustainability_expert(request: Request):
+    return await _chat_turn(
+        request,
+        "/chat_assistant",
+        ASISTENTE_ID,
+        "SustainabilityExpert",
+        "asistente",
+        ASSISTANT_RATE_LIMIT,
+        use_semantic_cache=True,
+    )
+
+
+# =============================================================================
+# Logging, cabeceras y CORS por petición (equivalente a _req_start/_req_end de app.py)
+# =============================================================================
+def _with_request_log(endpoint):
+    async def wrapper(request: Request):
+        req_id = uuid.uuid4().hex[:12]
+        t0 = time.time()
+        timing = start_request(f"{request.method} {request.url.path}", request_id=req_id)
+        metrics.request_started()
+        logger.info(
+            json.dumps({"evt": "request_start", "id": req_id, "path": request.url.path, "method": request.method})
+        )
+        try:
+            resp = await endpoint(request)
+        except HTTPException as exc:
+            resp = fail(exc.detail, status=exc.status_code)
+        except Exception:
+            # Starlette responderá 500; la petición deja de contar como en curso
+            metrics.request_finished(request.url.path, request.method, 500, time.time() - t0)
+            raise
+        resp.headers["X-Request-Id"] = req_id
+        resp.headers.update(_SECURITY_HEADERS)
+        # Mismas cabeceras CORS que Flask-CORS añade en app.py (el preflight OPTIONS lo sirve Flask)
+        origin = request.headers.get("Origin")
+        if origin and origin in _allowed_origins:
+            resp.headers["Access-Control-Allow-Origin"] = origin
+            resp.headers["Access-Control-Allow-Credentials"] = "true"
+            resp.headers["Access-Control-Expose-Headers"] = "X-Request-Id, Retry-After, Location"
+            resp.headers["Vary"] = "Origin"
+        if SERVER_TIMING_ENABLED:
+            resp.headers["Server-Timing"] = timing.server_timing()
+        end_request(timing, resp.status_code)
+        metrics.request_finished(request.url.path, request.method, resp.status_code, time.time() - t0)
+        dur_ms = int((time.time() - t0) * 1000)
+        logger.info(
+            json.dumps(
+                {"evt": "request_end", "id": req_id, "status": resp.status_code, "ms": dur_ms, "stages": timing.totals()}
+            )
+        )
+        return resp
+
+    return wrapper
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_app):
+    # Las conexiones del pool asyncio quedan ligadas al event loop que las abre: se
+    # precalientan aquí, en el loop del worker, y en segundo plano para no retrasar el arranque
+    prewarm = asyncio.create_task(aprewarm_openai(async_client))
+    yield
+    prewarm.cancel()
+
+
+app = Starlette(
+    lifespan=lifespan,
+    routes=[
+        Route("/chat_auditor", _with_request_log(chat_with_main_audit_orchestrator), methods=["POST"]),
+        Route("/chat_assistant", _with_request_log(chat_with_sustainability_expert), methods=["POST"]),
+        # Todo lo demás (historial, progreso, streaming, health, CORS preflight...) lo sirve Flask
+        Mount("/", app=WSGIMiddleware(flask_app)),
+    ],
+)
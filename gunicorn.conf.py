@@ -0,0 +1,28 @@
+# gunicorn.conf.py
+# Precarga y hooks de gunicorn (el resto de opciones va en la línea de comandos del Dockerfile).
+import os
+
+# GUNICORN_PRELOAD=1: el master importa la app una sola vez y los workers la heredan al
+# hacer fork (arrancan antes y comparten memoria). Los clientes (gRPC de Firestore,
+# BigQuery, OpenAI) y los hilos de fondo no sobreviven al fork, así que en ese caso no se
+# crean al importar sino en cada worker, desde `post_fork`.
+preload_app = os.getenv("GUNICORN_PRELOAD", "0") == "1"
+if preload_app:
+    os.environ.setdefault("APP_STARTUP", "post_fork")
+
+
+def post_fork(server, worker):
+    if os.environ.get("APP_STARTUP") == "post_fork":
+        # Con preload la app ya está importada en el master: esto solo la recupera
+        import app
+
+        app.start_worker()
+
+
+def child_exit(server, worker):
+    # Métricas de Prometheus en modo multiproceso (src/metrics.py): las gauges del worker
+    # que sale dejan de sumar. No se importa src.metrics para no cargar la app en el master.
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
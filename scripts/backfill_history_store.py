@@ -0,0 +1,176 @@
+# scripts/backfill_history_store.py
+"""
+Construye el historial de Firestore que sirve /chat_history (src/history_store.py) a
+partir de la tabla de BigQuery: turnos, resumen de cada hilo e índice de hilos
+recientes por usuario.
+
+Es idempotente: los turnos usan el run_id como id de documento (o un hash estable si no
+hay run), y cada hilo se escribe en transacciones que solo crean los turnos que faltan
+y los suman a `turn_count`, así que se puede relanzar o solapar con el tráfico en vivo
+sin duplicar turnos ni descuadrar el contador.
+Las filas se leen en streaming ordenadas por hilo, sin cargar la tabla en memoria.
+
+Requiere las variables de entorno habituales de la app (ver src/config.py).
+
+    python scripts/backfill_history_store.py                       # toda la tabla
+    python scripts/backfill_history_store.py --uid abc123 --dry-run
+    python scripts/backfill_history_store.py --since 2025-01-01  # hilos con actividad desde esa fecha
+
+Sin --since, cada usuario copiado queda marcado (`users/{uid}.history_complete`) y sus
+recientes pasan a leerse de Firestore. Con --since no se marca a nadie: sus hilos sin
+actividad reciente siguen solo en BigQuery.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Límite de operaciones por batch de Firestore: 500
+_BATCH_OPS = 450
+
+
+def _rows(uid, since):
+    from google.cloud import bigquery
+
+    from src.bigquery_service import _build_table_fqn
+    from src.config import bq_client
+
+    filters = ["uid IS NOT NULL", "thread_id IS NOT NULL"]
+    params = []
+    if uid:
+        filters.append("uid = @uid")
+        params.append(bigquery.ScalarQueryParameter("uid", "STRING", uid))
+    if since:
+        # Hilos completos (resumen y número de turnos correctos) con actividad desde `since`
+        filters.append(f"thread_id IN (SELECT thread_id FROM {_build_table_fqn()} WHERE timestamp >= @since)")
+        params.append(bigquery.ScalarQueryParameter("since", "TIMESTAMP", since))
+    query = f"""
+        SELECT thread_id, uid, timestamp, user_message, assistant_response, endpoint_source, run_id, assistant_name
+        FROM {_build_table_fqn()}
+        WHERE {" AND ".join(filters)}
+        ORDER BY thread_id, timestamp
+    """
+    job = bq_client.query(query, job_config=bigquery.QueryJobConfig(query_parameters=params))
+    for row in job.result(page_size=5000):
+        yield dict(row.items())
+
+
+class _Batcher:
+    """Agrupa operaciones en batches de Firestore y los confirma al llenarse."""
+
+    def __init__(self, db, dry_run):
+        self.db = db
+        self.dry_run = dry_run
+        self.batch = db.batch()
+        self.ops = 0
+        self.commits = 0
+
+    def reserve(self, ops):
+        if self.ops + ops > _BATCH_OPS:
+            self.commit()
+
+    def commit(self):
+        if self.ops and not self.dry_run:
+            self.batch.commit()
+            self.commits += 1
+        self.batch = self.db.batch()
+        self.ops = 0
+
+
+def _write_thread(store, batcher, thread_rows):
+    """
+    Copia un hilo en transacciones de hasta _BATCH_OPS escrituras. Cada una solo crea los
+    turnos que aún no existen y suma su número a `turn_count` con Increment, como las
+    escrituras en vivo: un turno escrito en vivo durante el backfill no se cuenta dos
+    veces ni se pierde al pisar el contador con un valor absoluto.
+    """
+    from firebase_admin import firestore
+    from google.cloud.firestore_v1 import Increment
+
+    from src.history_store import _as_datetime, summarize
+
+    first, last = thread_rows[0], thread_rows[-1]
+    uid, thread_id = last["uid"], last["thread_id"]
+    summary = summarize(first.get("user_message") or first.get("assistant_response"))
+    chunk_size = _BATCH_OPS - 2
+    chunks = [thread_rows[i : i + chunk_size] for i in range(0, len(thread_rows), chunk_size)]
+
+    for index, chunk in enumerate(chunks):
+        documents = [store.turn_document(row) for row in chunk]
+        # El hilo se copia entero (también con --since): a partir de aquí se sirve desde Firestore
+        complete = index == len(chunks) - 1
+
+        @firestore.transactional
+        def copy(transaction):
+            refs = [ref for ref, _ in documents]
+            existing = {snap.reference.path for snap in transaction.get_all(refs) if snap.exists}
+            current = store.thread_ref(thread_id).get(transaction=transaction)
+            last_row = chunk[-1]
+            live_last = (current.to_dict() or {}).get("last_timestamp") if current.exists else None
+            if live_last is not None and live_last > _as_datetime(last_row["timestamp"]):
+                # Un turno en vivo más reciente que la tabla: no se retrasa el último timestamp
+                last_row = dict(last_row, timestamp=live_last)
+            created = 0
+            for ref, data in documents:
+                if ref.path not in existing:
+                    transaction.set(ref, data)
+                    created += 1
+            store.set_thread_summary(transaction, uid, thread_id, last_row, summary, Increment(created), complete)
+            return created
+
+        if batcher.dry_run:
+            continue
+        copy(batcher.db.transaction())
+        batcher.commits += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uid", help="solo los hilos de este usuario")
+    parser.add_argument("--since", help="solo hilos con actividad desde esta fecha (ISO 8601)")
+    parser.add_argument("--dry-run", action="store_true", help="lee y cuenta sin escribir en Firestore")
+    args = parser.parse_args()
+
+    from src.history_store import HISTORY_COMPLETE_FIELD, history_store
+
+    started = time.monotonic()
+    batcher = _Batcher(history_store.db(), args.dry_run)
+    threads = turns = 0
+    current, thread_rows = None, []
+    uids = set()
+    for row in _rows(args.uid, args.since):
+        if row["thread_id"] != current and thread_rows:
+            _write_thread(history_store, batcher, thread_rows)
+            threads += 1
+            thread_rows = []
+        current = row["thread_id"]
+        thread_rows.append(row)
+        uids.add(row["uid"])
+        turns += 1
+        if turns % 5000 == 0:
+            print(f"... {turns} turnos, {threads} hilos")
+    if thread_rows:
+        _write_thread(history_store, batcher, thread_rows)
+        threads += 1
+    batcher.commit()
+
+    users = 0
+    if not args.since:
+        for uid in sorted(uids):
+            batcher.reserve(1)
+            batcher.batch.set(history_store.user_ref(uid), {HISTORY_COMPLETE_FIELD: True}, merge=True)
+            batcher.ops += 1
+            users += 1
+        batcher.commit()
+
+    mode = " (dry run)" if args.dry_run else ""
+    print(
+        f"{turns} turnos en {threads} hilos, {users} usuarios marcados, {batcher.commits} commits a Firestore"
+        f" en {time.monotonic() - started:.1f}s{mode}"
+    )
+
+
+if __name__ == "__main__":
+    main()
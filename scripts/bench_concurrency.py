@@ -0,0 +1,134 @@
+# scripts/bench_concurrency.py
+"""
+Benchmark de chats concurrentes por instancia: modo Flask/gunicorn síncrono frente a
+modo ASGI (asyncio) contra un OpenAI falso local (scripts/fake_openai_server.py).
+
+- "sync":  `run_assistant_turn` en un pool de N hilos, igual que N workers síncronos
+           de gunicorn (el Dockerfile usa 4).
+- "async": `arun_assistant_turn` con todas las peticiones lanzadas a la vez en un único
+           event loop, como un worker de uvicorn.
+
+Requiere las variables de entorno habituales de la app (ver src/config.py); las de
+OpenAI se sobreescriben para apuntar al servidor falso.
+
+    DISABLE_BIGQUERY=1 python scripts/bench_concurrency.py --chats 200 --run-seconds 2
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+class InFlight:
+    """Cuenta las conversaciones en vuelo y su máximo."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def __enter__(self):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *exc):
+        with self._lock:
+            self.current -= 1
+
+
+def _report(label, latencies, wall, in_flight, errors):
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies) if latencies else 0.0
+    p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0.0
+    print(
+        f"{label:<6} chats={len(latencies):<5} errores={errors:<4} wall={wall:7.2f}s "
+        f"chats/s={len(latencies) / wall:7.2f} en_vuelo_max={in_flight.peak:<5} "
+        f"p50={p50:6.2f}s p99={p99:6.2f}s"
+    )
+
+
+def bench_sync(chats, workers, assistant_id):
+    from src.chat_service import run_assistant_turn
+    from src.config import client
+
+    in_flight = InFlight()
+    latencies, errors = [], 0
+
+    def one_chat(i):
+        t0 = time.perf_counter()
+        with in_flight:
+            thread_id = client.beta.threads.create().id
+            run_assistant_turn(client, thread_id, f"hola {i}", assistant_id, "bench")
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for fut in [pool.submit(one_chat, i) for i in range(chats)]:
+            try:
+                latencies.append(fut.result())
+            except Exception as exc:
+                errors += 1
+                print(f"sync error: {exc}", file=sys.stderr)
+    _report("sync", latencies, time.perf_counter() - t0, in_flight, errors)
+
+
+async def bench_async(chats, assistant_id):
+    from src.chat_service import arun_assistant_turn
+    from src.config import async_client
+
+    in_flight = InFlight()
+
+    async def one_chat(i):
+        t0 = time.perf_counter()
+        with in_flight:
+            thread_id = (await async_client.beta.threads.create()).id
+            await arun_assistant_turn(async_client, thread_id, f"hola {i}", assistant_id, "bench")
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*[one_chat(i) for i in range(chats)], return_exceptions=True)
+    latencies = [r for r in results if not isinstance(r, BaseException)]
+    for r in results:
+        if isinstance(r, BaseException):
+            print(f"async error: {r}", file=sys.stderr)
+    _report("async", latencies, time.perf_counter() - t0, in_flight, len(results) - len(latencies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=200, help="conversaciones a lanzar en cada modo")
+    parser.add_argument("--workers", type=int, default=4, help="workers síncronos a simular (gunicorn)")
+    parser.add_argument("--run-seconds", type=float, default=2.0, help="duración simulada de cada run")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--mode", choices=["sync", "async", "both"], default="both")
+    args = parser.parse_args()
+
+    os.environ["FAKE_OPENAI_RUN_SECONDS"] = str(args.run_seconds)
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.port}/v1"
+    os.environ["OPENAI_API_KEY"] = "sk-bench"
+    os.environ.setdefault("ASISTENTE_ID", "asst_bench")
+    os.environ.setdefault("ORCHESTRATOR_ASSISTANT_ID", "orch_bench")
+
+    import fake_openai_server
+
+    server = fake_openai_server.serve(port=args.port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    assistant_id = os.environ["ASISTENTE_ID"]
+    print(f"{args.chats} chats, run simulado de {args.run_seconds}s, {args.workers} workers síncronos")
+    if args.mode in ("sync", "both"):
+        bench_sync(args.chats, args.workers, assistant_id)
+    if args.mode in ("async", "both"):
+        asyncio.run(bench_async(args.chats, assistant_id))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
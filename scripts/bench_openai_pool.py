@@ -0,0 +1,180 @@
+# scripts/bench_openai_pool.py
+"""
+Benchmark del transporte HTTP de OpenAI contra un servidor local que imita la API (la
+consulta de estado de un run, GET /v1/threads/{thread}/runs/{run}, y GET /v1/models).
+Lanza --requests consultas desde --concurrency hilos y compara:
+
+- "sdk": cliente con el transporte por defecto del SDK y `with_options(timeout=60.0)` en
+  cada petición (la configuración anterior);
+- "pooled": `chat_client` de src/config.py (pool httpx con los límites OPENAI_*, copia con
+  el timeout creada una vez y, salvo --no-prewarm, conexiones precalentadas).
+
+Para cada uno muestra la latencia p50/p99/max, la de la primera consulta, peticiones por
+segundo y las conexiones TCP que aceptó el servidor (reutilización = peticiones /
+conexiones). --think-ms añade una pausa entre consultas de cada hilo, como el intervalo de
+polling o el tiempo entre turnos: si supera el keepalive_expiry del pool, cada consulta
+abre una conexión nueva.
+
+El servidor local no usa TLS. En producción cada conexión nueva paga además el handshake
+TLS (varios RTT con la API), así que el ahorro real por reutilizar conexiones es mayor que
+el medido aquí. Por lo mismo HTTP/2 (OPENAI_HTTP2=1) no se puede comparar en local: httpx
+solo lo negocia sobre TLS.
+
+No necesita credenciales: apunta OPENAI_BASE_URL al servidor local y rellena con valores
+de prueba las variables obligatorias de src/config.py que falten.
+
+    python scripts/bench_openai_pool.py --requests 2000 --concurrency 16
+    python scripts/bench_openai_pool.py --requests 48 --concurrency 8 --think-ms 6000
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+
+class _FakeOpenAI(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, como la API
+    latency_s = 0.0
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        time.sleep(self.latency_s)
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts[-2:-1] == ["runs"]:
+            body = {
+                "id": parts[-1],
+                "object": "thread.run",
+                "thread_id": parts[-3],
+                "assistant_id": "asst_bench",
+                "status": "in_progress",
+                "created_at": int(time.time()),
+            }
+        else:
+            body = {"object": "list", "data": []}
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(latency_ms: float) -> ThreadingHTTPServer:
+    _FakeOpenAI.latency_s = latency_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeOpenAI)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connections = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _warm_python():
+    """
+    Una consulta sin medir con un cliente desechable: el primer parseo de un Run (modelos
+    del SDK) cuesta cientos de ms y no debe cargarse al primer modo medido.
+    """
+    import openai
+
+    with openai.OpenAI(api_key=os.environ["OPENAI_API_KEY"], max_retries=0) as throwaway:
+        throwaway.beta.threads.runs.retrieve("run_bench", thread_id="thread_bench")
+
+
+def _sdk_call():
+    """Configuración anterior: transporte por defecto y copia del cliente en cada petición."""
+    import openai
+    from httpx import Timeout
+
+    base = openai.OpenAI(
+        api_key=os.environ["OPENAI_API_KEY"],
+        timeout=Timeout(60.0, read=60.0, write=60.0, connect=10.0),
+        max_retries=3,
+    )
+    return lambda: base.with_options(timeout=60.0).beta.threads.runs.retrieve("run_bench", thread_id="thread_bench")
+
+
+def _pooled_call(prewarm: bool):
+    from src.config import chat_client, client, prewarm_openai
+
+    if prewarm:
+        prewarm_openai(client.get())
+    return lambda: chat_client.beta.threads.runs.retrieve("run_bench", thread_id="thread_bench")
+
+
+def _measure(call, requests: int, concurrency: int, think_s: float):
+    latencies = [0.0] * requests
+
+    def worker(index: int):
+        if think_s and index >= concurrency:
+            time.sleep(think_s)
+        started = time.perf_counter()
+        call()
+        latencies[index] = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    # Las primeras `concurrency` consultas salen a la vez; cada hilo encadena las suyas
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(requests)))
+    return latencies, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--server-ms", type=float, default=20.0, help="latencia simulada de la API por petición")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="pausa entre consultas de cada hilo")
+    parser.add_argument("--mode", choices=["sdk", "pooled", "both"], default="both")
+    parser.add_argument("--no-prewarm", action="store_true", help="pooled sin precalentar conexiones")
+    args = parser.parse_args()
+
+    server = _serve(args.server_ms)
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    for name, value in {
+        "OPENAI_API_KEY": "sk-bench",
+        "ORCHESTRATOR_ASSISTANT_ID": "asst_bench",
+        "ASISTENTE_ID": "asst_bench",
+        "BIGQUERY_DATASET_ID": "bench",
+        "BIGQUERY_TABLE_ID": "bench",
+    }.items():
+        os.environ.setdefault(name, value)
+
+    # El SDK marca como obsoleta la API de Assistants en cada llamada
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+    _warm_python()
+
+    modes = ["sdk", "pooled"] if args.mode == "both" else [args.mode]
+    for mode in modes:
+        call = _sdk_call() if mode == "sdk" else _pooled_call(not args.no_prewarm)
+        with server.lock:
+            server.connections = 0
+        latencies, elapsed = _measure(call, args.requests, args.concurrency, args.think_ms / 1000)
+        first = latencies[0]
+        cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+        connections = server.connections
+        print(
+            f"{mode:7s} p50={cuts[49]:.1f}ms p99={cuts[98]:.1f}ms max={max(latencies):.1f}ms "
+            f"primera={first:.1f}ms rps={args.requests / elapsed:.0f} "
+            f"conexiones={connections} peticiones/conexión={args.requests / max(connections, 1):.1f}"
+        )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
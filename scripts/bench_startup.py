@@ -0,0 +1,151 @@
+# scripts/bench_startup.py
+"""
+Benchmark de arranque en frío: cuánto tarda un proceso nuevo en importar la app y en
+responder a sus primeras peticiones (lo que paga la primera petición tras un cold start de
+Cloud Run).
+
+- "import" (por defecto): en cada ronda un intérprete nuevo importa `app` (o `asgi`) y
+  lanza con el cliente de pruebas de Flask la primera petición a `--path` (por defecto
+  /health) y después a `--ready-path` (por defecto /readyz, la primera que usa Firestore).
+- "gunicorn": arranca gunicorn con `--workers` y mide desde el lanzamiento hasta el primer
+  200 de `--path` y la primera respuesta de `--ready-path`, como en el contenedor. Con
+  `--preload` activa GUNICORN_PRELOAD=1 (ver gunicorn.conf.py).
+
+Requiere las variables de entorno habituales de la app (ver src/config.py) y acceso a
+Firestore (o a su emulador con FIRESTORE_EMULATOR_HOST) para `--ready-path`.
+
+    python scripts/bench_startup.py --rounds 5
+    python scripts/bench_startup.py --mode gunicorn --workers 4 --preload
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+# Se ejecuta en un intérprete nuevo en cada ronda (módulos sin cachear, como un worker nuevo)
+_CHILD = """
+import json, sys, time
+started = time.perf_counter()
+module = __import__(sys.argv[1])
+imported = time.perf_counter()
+test_client = module.flask_app.test_client() if sys.argv[1] == "asgi" else module.app.test_client()
+status = test_client.get(sys.argv[2]).status_code
+first = time.perf_counter()
+ready_status = test_client.get(sys.argv[3]).status_code
+ready = time.perf_counter()
+print(json.dumps({
+    "import_s": imported - started,
+    "first_ms": (first - imported) * 1000, "first_status": status,
+    "ready_ms": (ready - first) * 1000, "ready_status": ready_status,
+}))
+"""
+
+
+def _run_import(args):
+    output = subprocess.run(
+        [sys.executable, "-c", _CHILD, args.module, args.path, args.ready_path],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _get(url: str, timeout: float = 5.0):
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as resp:
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def _run_gunicorn(args):
+    port = _free_port()
+    env = dict(os.environ, GUNICORN_PRELOAD="1" if args.preload else "0")
+    command = [
+        sys.executable, "-m", "gunicorn", "app:app",
+        "--config", "gunicorn.conf.py",
+        "--bind", f"127.0.0.1:{port}",
+        "--workers", str(args.workers),
+        "--timeout", "120",
+    ]
+    started = time.perf_counter()
+    proc = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        base = f"http://127.0.0.1:{port}"
+        deadline = started + args.timeout
+        status = None
+        while time.perf_counter() < deadline:
+            try:
+                status = _get(base + args.path, timeout=1.0)
+                if status == 200:
+                    break
+            except (urllib.error.URLError, ConnectionError, socket.timeout):
+                pass
+            time.sleep(0.01)
+        if status != 200:
+            raise RuntimeError(f"gunicorn no respondió 200 en {args.path} tras {args.timeout}s")
+        first = time.perf_counter()
+        ready_status = _get(base + args.ready_path, timeout=args.timeout)
+        ready = time.perf_counter()
+        return {
+            "first_s": first - started,
+            "ready_ms": (ready - first) * 1000,
+            "first_status": status,
+            "ready_status": ready_status,
+        }
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+
+def _summary(label, values, unit):
+    return f"{label}: mediana={statistics.median(values):.3f}{unit} max={max(values):.3f}{unit}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["import", "gunicorn"], default="import")
+    parser.add_argument("--module", choices=["app", "asgi"], default="app", help="módulo a importar (modo import)")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--path", default="/health")
+    parser.add_argument("--ready-path", default="/readyz")
+    parser.add_argument("--workers", type=int, default=4, help="workers de gunicorn (modo gunicorn)")
+    parser.add_argument("--preload", action="store_true", help="gunicorn con GUNICORN_PRELOAD=1")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    results = []
+    for round_number in range(1, args.rounds + 1):
+        result = _run_import(args) if args.mode == "import" else _run_gunicorn(args)
+        results.append(result)
+        print(f"ronda {round_number}: " + " ".join(
+            f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}" for key, value in result.items()
+        ))
+
+    if args.mode == "import":
+        print(_summary("import", [r["import_s"] for r in results], "s"))
+        print(_summary(f"primera petición {args.path}", [r["first_ms"] for r in results], "ms"))
+    else:
+        print(_summary(f"arranque hasta el primer 200 de {args.path}", [r["first_s"] for r in results], "s"))
+    print(_summary(f"primera petición {args.ready_path}", [r["ready_ms"] for r in results], "ms"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# scripts/check_import_time.py
+"""
+Presupuesto de tiempo de importación: mide con `python -X importtime` lo que cuesta
+importar la app en un intérprete nuevo (lo que paga cada worker y cada cold start de Cloud
+Run antes de atender la primera petición) y falla si se pasa del presupuesto o si vuelve a
+cargarse al importar algún SDK que la app carga en diferido.
+
+Cada ronda importa `app` (o `asgi`) con APP_STARTUP=none, así que solo se mide el import:
+sin hilos de fondo ni clientes. Se informa de la mediana y de los módulos más pesados
+(tiempo acumulado, incluidos sus imports) de la ronda mediana.
+
+Requiere las variables de entorno habituales de la app (ver src/config.py).
+
+    python scripts/check_import_time.py --rounds 5
+    python scripts/check_import_time.py --budget-ms 800 --output importtime.txt
+    python scripts/check_import_time.py --module asgi --forbid openai --forbid google.cloud.bigquery
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+# "import time:  self [us] | cumulative | imported package" (la sangría marca el anidamiento)
+_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+
+# SDKs que solo se importan al crear su cliente o en la primera llamada (ver src/config.py)
+DEFAULT_FORBIDDEN = ["openai", "google.cloud.bigquery"]
+
+
+def _run(module: str) -> str:
+    env = dict(os.environ, APP_STARTUP="none")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr[-2000:])
+        raise SystemExit(f"No se pudo importar {module} (código {result.returncode}).")
+    return result.stderr
+
+
+def _parse(output: str):
+    """{módulo: µs acumulados} de la salida de -X importtime."""
+    modules = {}
+    for line in output.splitlines():
+        match = _LINE.match(line)
+        if match:
+            modules[match.group(4)] = int(match.group(2))
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", choices=["app", "asgi"], default="app")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="módulos más pesados a mostrar")
+    parser.add_argument("--budget-ms", type=float, help="falla (código 1) si la mediana lo supera")
+    parser.add_argument(
+        "--forbid",
+        action="append",
+        help=f"módulo que no debe importarse con la app (repetible; por defecto {', '.join(DEFAULT_FORBIDDEN)})",
+    )
+    parser.add_argument("--output", help="guarda la salida de -X importtime de la ronda mediana")
+    args = parser.parse_args()
+
+    rounds = []
+    for round_number in range(1, args.rounds + 1):
+        output = _run(args.module)
+        modules = _parse(output)
+        total_ms = modules.get(args.module, 0) / 1000
+        rounds.append((total_ms, output, modules))
+        print(f"ronda {round_number}: import {args.module} = {total_ms:.1f}ms")
+
+    rounds.sort(key=lambda item: item[0])
+    median_ms = statistics.median(item[0] for item in rounds)
+    _, output, modules = rounds[len(rounds) // 2]
+    print(f"mediana: {median_ms:.1f}ms  min: {rounds[0][0]:.1f}ms  max: {rounds[-1][0]:.1f}ms")
+
+    print("\nmódulos más pesados (acumulado, ronda mediana):")
+    heavy = sorted(((us, name) for name, us in modules.items() if name != args.module), reverse=True)
+    for us, name in heavy[: args.top]:
+        print(f"  {us / 1000:8.1f}ms  {name}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+        print(f"\nsalida de -X importtime guardada en {args.output}")
+
+    failures = []
+    forbidden = args.forbid or DEFAULT_FORBIDDEN
+    loaded = [name for name in forbidden if name in modules]
+    if loaded:
+        failures.append(f"se importan al cargar la app: {', '.join(loaded)}")
+    if args.budget_ms is not None and median_ms > args.budget_ms:
+        failures.append(f"la mediana ({median_ms:.1f}ms) supera el presupuesto de {args.budget_ms:.0f}ms")
+    for failure in failures:
+        print(f"\nFALLO: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
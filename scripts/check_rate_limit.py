@@ -0,0 +1,106 @@
+# scripts/check_rate_limit.py
+"""
+Comprueba el rate limiting compartido (src/rate_limit.py) contra un Redis local o, si no
+se indica ninguno, contra fakeredis (`pip install fakeredis lupa`).
+
+1. `--workers` limitadores independientes (como los workers de varias instancias) lanzan
+   peticiones del mismo uid a la vez: entre todos solo deben pasar las del límite, no
+   N veces el límite.
+2. Otro uid no comparte cuota.
+3. Con el almacenamiento caído el limitador no falla: aplica el límite en memoria
+   (fail open con respaldo local).
+
+Requiere las variables de entorno habituales de la app (ver src/config.py).
+
+    python scripts/check_rate_limit.py
+    python scripts/check_rate_limit.py --redis-url redis://localhost:6379/0 --workers 8
+"""
+import argparse
+import os
+import sys
+import threading
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+LIMIT = "12/minute"
+ALLOWED = 12
+
+
+def _limiters(args):
+    from src.rate_limit import SharedRateLimiter
+
+    if args.redis_url:
+        return [SharedRateLimiter(args.redis_url, args.strategy) for _ in range(args.workers)]
+    import fakeredis
+
+    server = fakeredis.FakeServer()
+    # Cada limitador con su propia conexión al mismo servidor, como procesos distintos
+    return [
+        SharedRateLimiter(
+            "redis://fakeredis", args.strategy, connection_pool=fakeredis.FakeRedis(server=server).connection_pool
+        )
+        for _ in range(args.workers)
+    ]
+
+
+def _burst(limiters, uid, requests_per_worker):
+    allowed = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(len(limiters))
+
+    def worker(limiter):
+        barrier.wait()
+        for _ in range(requests_per_worker):
+            ok, _ = limiter.hit(LIMIT, "uid:" + uid, "/chat_auditor")
+            if ok:
+                with lock:
+                    allowed.append(1)
+
+    threads = [threading.Thread(target=worker, args=(limiter,)) for limiter in limiters]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(allowed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", help="Redis real (por defecto fakeredis)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=10, help="peticiones por worker")
+    parser.add_argument("--strategy", default="sliding-window-counter")
+    args = parser.parse_args()
+
+    from src.rate_limit import SharedRateLimiter
+
+    failures = []
+    limiters = _limiters(args)
+    uid = uuid.uuid4().hex
+    allowed = _burst(limiters, uid, args.requests)
+    print(f"{args.workers} workers x {args.requests} peticiones del mismo uid: {allowed} permitidas (límite {ALLOWED})")
+    if allowed != ALLOWED:
+        failures.append(f"se esperaban {ALLOWED} permitidas y pasaron {allowed}")
+
+    other, _ = limiters[0].hit(LIMIT, "uid:" + uuid.uuid4().hex, "/chat_auditor")
+    print(f"otro uid tras la ráfaga: {'permitido' if other else 'limitado'}")
+    if not other:
+        failures.append("un uid distinto no debería compartir cuota")
+
+    # Puerto sin servidor: el almacenamiento compartido está caído
+    down = SharedRateLimiter("redis://127.0.0.1:1/0", args.strategy, socket_connect_timeout=0.2)
+    results = [down.hit(LIMIT, "uid:" + uid, "/chat_auditor")[0] for _ in range(ALLOWED + 3)]
+    print(f"almacenamiento caído: {sum(results)} de {len(results)} permitidas en local · stats: {down.stats()}")
+    if sum(results) != ALLOWED or not down.stats()["degraded"]:
+        failures.append("con el almacenamiento caído se debe aplicar el límite en memoria")
+
+    if failures:
+        for failure in failures:
+            print("FALLO:", failure)
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# scripts/check_turn_spool.py
+"""
+Comprueba que el spool de turnos (src/turn_spool.py + src/bigquery_writer.py) no pierde
+turnos cuando BigQuery falla, contra un BigQuery falso local que falla a propósito.
+
+1. Un proceso hijo escribe `--turns` turnos con BigQuery caído y muere sin vaciar nada
+   (os._exit, como un worker al que matan).
+2. El proceso principal abre el mismo spool con un BigQuery intermitente (falla lotes
+   enteros y filas sueltas con `--failure-rate`), escribe otros `--turns` turnos y espera
+   a que el spool quede vacío.
+3. Verifica que BigQuery ha recibido todos los run_id (entrega al menos una vez) e
+   informa de cuántos reenvíos habrían quedado deduplicados por `insertId`.
+
+Requiere las variables de entorno habituales de la app (ver src/config.py).
+
+    python scripts/check_turn_spool.py --turns 500 --failure-rate 0.3
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+class FakeBigQuery:
+    """Imita `insert_rows_json`: puede fallar el lote entero o filas sueltas."""
+
+    def __init__(self, failure_rate: float, down: bool = False):
+        self.failure_rate = failure_rate
+        self.down = down
+        self.received = {}
+        self.deliveries = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def dataset(self, dataset_id):
+        return types.SimpleNamespace(table=lambda table_id: f"{dataset_id}.{table_id}")
+
+    def insert_rows_json(self, table, rows, row_ids=None):
+        with self._lock:
+            self.calls += 1
+            if self.down or random.random() < self.failure_rate:
+                raise ConnectionError("503 Service Unavailable (fake)")
+            errors = []
+            for index, (insert_id, row) in enumerate(zip(row_ids, rows)):
+                if random.random() < self.failure_rate:
+                    errors.append({"index": index, "errors": [{"reason": "backendError"}]})
+                    continue
+                self.deliveries += 1
+                self.received[insert_id] = row
+            return errors
+
+
+def _make_writer(spool_dir, fake):
+    from src.bigquery_writer import BigQueryBatchWriter
+    from src.turn_spool import TurnSpool
+
+    return BigQueryBatchWriter(batch_size=50, flush_seconds=0.2, spool=TurnSpool(spool_dir, lease_seconds=5), client=fake)
+
+
+def _submit(writer, prefix, count):
+    for i in range(count):
+        run_id = f"run_{prefix}_{i}"
+        writer.submit({"thread_id": f"thread_{prefix}", "run_id": run_id, "user_message": str(i)}, insert_id=run_id)
+
+
+def child(spool_dir, turns):
+    writer = _make_writer(spool_dir, FakeBigQuery(0.0, down=True))
+    _submit(writer, "crashed", turns)
+    time.sleep(0.5)
+    os._exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=500)
+    parser.add_argument("--failure-rate", type=float, default=0.3)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.turns)
+
+    # Reintentos rápidos para que la comprobación no tarde minutos
+    os.environ.setdefault("BIGQUERY_RETRY_MAX_SECONDS", "0.5")
+    spool_dir = tempfile.mkdtemp(prefix="turn-spool-")
+
+    started = time.monotonic()
+    subprocess.run([sys.executable, __file__, "--child", spool_dir, "--turns", str(args.turns)], check=False)
+    print(f"hijo: {args.turns} turnos escritos con BigQuery caído en {time.monotonic() - started:.1f}s")
+
+    fake = FakeBigQuery(args.failure_rate)
+    writer = _make_writer(spool_dir, fake)
+    left = writer.spool.pending()
+    print(f"spool al reabrir: {left} turnos pendientes")
+
+    started = time.monotonic()
+    _submit(writer, "live", args.turns)
+    submit_ms = (time.monotonic() - started) * 1000 / args.turns
+    writer._ensure_worker()
+
+    deadline = time.monotonic() + args.timeout
+    while writer.spool.pending() and time.monotonic() < deadline:
+        time.sleep(0.2)
+    writer.flush(timeout=5)
+
+    expected = {f"run_crashed_{i}" for i in range(args.turns)} | {f"run_live_{i}" for i in range(args.turns)}
+    missing = expected - set(fake.received)
+    print(
+        f"submit: {submit_ms:.3f} ms/turno · llamadas a BigQuery: {fake.calls} · "
+        f"filas entregadas: {fake.deliveries} (únicas {len(fake.received)}, "
+        f"reenvíos deduplicables {fake.deliveries - len(fake.received)}) · stats: {writer.stats()}"
+    )
+    if missing:
+        print(f"FALLO: {len(missing)} turnos perdidos, p. ej. {sorted(missing)[:5]}")
+        sys.exit(1)
+    print(f"OK: los {len(expected)} turnos llegaron a BigQuery.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# scripts/eval_semantic_cache.py
+"""
+Evalúa la caché semántica de /chat_assistant (src/semantic_cache.py) con el historial real.
+
+Reproduce en orden cronológico los primeros turnos de conversación guardados en BigQuery
+(o en un JSONL con `user_message`, `assistant_response` y `timestamp`): cada pregunta se
+busca entre las anteriores que habrían quedado cacheadas (las que fallaron) y, para cada
+umbral, informa de la tasa de aciertos y del tiempo que se habría ahorrado. Con
+`--examples` muestra los pares aceptados con menor similitud, útiles para elegir el
+umbral: si esos pares no son realmente la misma pregunta, el umbral es demasiado bajo.
+
+Requiere las variables de entorno habituales de la app (ver src/config.py).
+
+    python scripts/eval_semantic_cache.py --limit 2000 --thresholds 0.88,0.9,0.92,0.94
+    python scripts/eval_semantic_cache.py --from-jsonl turns.jsonl --turn-seconds 12 --examples 10
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def _load_turns(args):
+    if args.from_jsonl:
+        with open(args.from_jsonl, encoding="utf-8") as fh:
+            rows = [json.loads(line) for line in fh if line.strip()]
+    else:
+        from src.bigquery_service import fetch_first_turns_for_endpoint
+
+        rows = fetch_first_turns_for_endpoint("/chat_assistant", "SustainabilityExpert", limit=args.limit)
+    rows = [row for row in rows if row.get("user_message") and row.get("assistant_response")]
+    return sorted(rows, key=lambda row: row.get("timestamp") or "")
+
+
+def _replay(similarity, threshold):
+    """Simula la caché en orden: solo las preguntas que fallan se añaden al índice."""
+    import numpy as np
+
+    stored = np.zeros(similarity.shape[0], dtype=bool)
+    hits = []
+    for i in range(similarity.shape[0]):
+        if stored.any():
+            candidates = np.where(stored, similarity[i], -1.0)
+            best = int(candidates.argmax())
+            if candidates[best] >= threshold:
+                hits.append((i, best, float(candidates[best])))
+                continue
+        stored[i] = True
+    return hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--limit", type=int, default=2000, help="primeros turnos a leer de BigQuery")
+    parser.add_argument("--from-jsonl", help="leer los turnos de un JSONL en lugar de BigQuery")
+    parser.add_argument("--thresholds", default="0.88,0.90,0.92,0.93,0.94,0.96")
+    parser.add_argument("--turn-seconds", type=float, default=10.0, help="duración media de un turno sin caché")
+    parser.add_argument("--latency-samples", type=int, default=20, help="embeddings individuales a cronometrar")
+    parser.add_argument("--examples", type=int, default=0, help="pares aceptados a mostrar por umbral")
+    args = parser.parse_args()
+
+    from src.semantic_cache import SEMANTIC_CACHE_MODEL, SemanticCache, embed_texts
+
+    turns = _load_turns(args)
+    if len(turns) < 2:
+        print("No hay suficientes turnos para evaluar.")
+        return
+    questions = [row["user_message"] for row in turns]
+    print(f"{len(turns)} primeros turnos, modelo {SEMANTIC_CACHE_MODEL}")
+
+    started = time.monotonic()
+    embeddings = embed_texts(questions)
+    print(f"embeddings en lote: {time.monotonic() - started:.1f}s")
+
+    # Latencia de una consulta real: embedding individual + búsqueda en el índice completo
+    cache = SemanticCache(threshold=1.0, max_entries=len(turns))
+    cache.add_many(questions, [row["assistant_response"] for row in turns], embeddings)
+    embed_ms, search_ms = [], []
+    for question in questions[: args.latency_samples]:
+        t0 = time.monotonic()
+        vector = embed_texts([question])[0]
+        t1 = time.monotonic()
+        cache.search(vector)
+        embed_ms.append((t1 - t0) * 1000)
+        search_ms.append((time.monotonic() - t1) * 1000)
+    lookup_s = (statistics.median(embed_ms) + statistics.median(search_ms)) / 1000
+    print(
+        f"lookup p50: embedding {statistics.median(embed_ms):.0f} ms, "
+        f"búsqueda {statistics.median(search_ms):.2f} ms ({len(turns)} entradas)"
+    )
+
+    similarity = embeddings @ embeddings.T
+    print(f"\n{'umbral':>7} {'aciertos':>9} {'tasa':>7} {'ahorro neto':>12}")
+    for threshold in [float(t) for t in args.thresholds.split(",")]:
+        hits = _replay(similarity, threshold)
+        # Cada acierto evita un turno; todas las consultas pagan el lookup
+        saved_s = len(hits) * args.turn_seconds - len(turns) * lookup_s
+        print(f"{threshold:>7.2f} {len(hits):>9} {len(hits) / len(turns):>7.1%} {saved_s / 60:>9.1f} min")
+        for i, j, score in sorted(hits, key=lambda hit: hit[2])[: args.examples]:
+            print(f"    {score:.3f}  {questions[i][:70]!r}\n           ~ {questions[j][:70]!r}")
+
+
+if __name__ == "__main__":
+    main()
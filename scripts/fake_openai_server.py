@@ -0,0 +1,395 @@
+# scripts/fake_openai_server.py
+"""
+Servidor local que imita la API de Assistants de OpenAI (threads/messages/runs) para
+benchmarks y pruebas manuales. Los runs pasan a `completed` tras FAKE_OPENAI_RUN_SECONDS;
+los del orquestador (assistant_id que empieza por FAKE_OPENAI_TOOL_ASSISTANT) piden antes
+FAKE_OPENAI_TOOL_ROUNDS rondas de `invoke_sustainability_expert`. `/embeddings` devuelve
+vectores de bolsa de palabras (hash de cada palabra), así que dos textos con las mismas
+palabras tienen similitud alta.
+
+    python scripts/fake_openai_server.py --port 8765
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 ...
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+RUN_SECONDS = float(os.getenv("FAKE_OPENAI_RUN_SECONDS", "1.0"))
+TOOL_ROUNDS = int(os.getenv("FAKE_OPENAI_TOOL_ROUNDS", "1"))
+TOOL_CALLS_PER_ROUND = int(os.getenv("FAKE_OPENAI_TOOL_CALLS", "1"))
+TOOL_ASSISTANT_PREFIX = os.getenv("FAKE_OPENAI_TOOL_ASSISTANT", "orch")
+POLL_AFTER_MS = os.getenv("FAKE_OPENAI_POLL_AFTER_MS")
+EMBEDDING_DIM = 256
+
+_lock = threading.Lock()
+_threads = {}
+_runs = {}
+_stats = {"requests": 0, "connections": 0, "run_retrievals": 0}
+
+
+def _now():
+    return int(time.time())
+
+
+def _new_id(prefix):
+    return f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+
+def _message(thread_id, role, text, run_id=None, assistant_id=None):
+    return {
+        "id": _new_id("msg"),
+        "object": "thread.message",
+        "created_at": _now(),
+        "thread_id": thread_id,
+        "role": role,
+        "content": [{"type": "text", "text": {"value": text, "annotations": []}}],
+        "assistant_id": assistant_id,
+        "run_id": run_id,
+        "attachments": [],
+        "metadata": {},
+        "status": "completed",
+    }
+
+
+def _embedding(text, dim=EMBEDDING_DIM):
+    vector = [0.0] * dim
+    for word in text.lower().split():
+        word = word.strip(".,;:¿?¡!\"'()")
+        if word:
+            vector[int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16) % dim] += 1.0
+    return vector
+
+
+def _run_payload(run):
+    payload = {
+        "id": run["id"],
+        "object": "thread.run",
+        "created_at": run["created_at"],
+        "thread_id": run["thread_id"],
+        "assistant_id": run["assistant_id"],
+        "status": run["status"],
+        "required_action": None,
+        "last_error": None,
+        "model": "fake",
+        "instructions": "",
+        "tools": [],
+        "metadata": {},
+        "parallel_tool_calls": True,
+        "response_format": "auto",
+        "tool_choice": "auto",
+        "truncation_strategy": {"type": "auto"},
+    }
+    if run["status"] == "requires_action":
+        payload["required_action"] = {
+            "type": "submit_tool_outputs",
+            "submit_tool_outputs": {"tool_calls": run["tool_calls"]},
+        }
+    return payload
+
+
+def _advance(run):
+    """Avanza la máquina de estados del run según el tiempo transcurrido."""
+    if run["status"] in ("queued", "in_progress") and time.time() >= run["ready_at"]:
+        rounds_left = run["tool_rounds_left"]
+        if rounds_left > 0:
+            run["status"] = "requires_action"
+            run["tool_calls"] = [
+                {
+                    "id": _new_id("call"),
+                    "type": "function",
+                    "function": {
+                        "name": "invoke_sustainability_expert",
+                        "arguments": json.dumps({"query": f"pregunta {i}"}),
+                    },
+                }
+                for i in range(TOOL_CALLS_PER_ROUND)
+            ]
+        else:
+            run["status"] = "completed"
+            text = f"Respuesta simulada para {run['thread_id']}"
+            _threads[run["thread_id"]]["messages"].append(
+                _message(run["thread_id"], "assistant", text, run_id=run["id"], assistant_id=run["assistant_id"])
+            )
+    elif run["status"] == "queued":
+        run["status"] = "in_progress"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with _lock:
+            _stats["connections"] += 1
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        return json.loads(raw or b"{}")
+
+    def _send(self, status, payload, headers=None):
+        raw = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _stream(self, run):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        def emit(event, data):
+            self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+            self.wfile.flush()
+
+        emit("thread.run.created", _run_payload(run))
+        time.sleep(max(0.0, run["ready_at"] - time.time()))
+        with _lock:
+            _advance(run)
+        if run["status"] == "completed":
+            msg = _threads[run["thread_id"]]["messages"][-1]
+            text = msg["content"][0]["text"]["value"]
+            emit("thread.message.created", dict(msg, content=[], status="in_progress"))
+            for i, word in enumerate(text.split(" ")):
+                emit(
+                    "thread.message.delta",
+                    {
+                        "id": msg["id"],
+                        "object": "thread.message.delta",
+                        "delta": {"content": [{"index": 0, "type": "text", "text": {"value": word + " "}}]},
+                    },
+                )
+            emit("thread.message.completed", msg)
+            emit("thread.run.completed", _run_payload(run))
+        else:
+            emit("thread.run.requires_action", _run_payload(run))
+        self.wfile.write(b"event: done\ndata: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def _new_run(self, thread_id, body):
+        assistant_id = body.get("assistant_id", "")
+        run = {
+            "id": _new_id("run"),
+            "created_at": _now(),
+            "thread_id": thread_id,
+            "assistant_id": assistant_id,
+            "status": "queued",
+            "ready_at": time.time() + RUN_SECONDS,
+            "tool_rounds_left": TOOL_ROUNDS if assistant_id.startswith(TOOL_ASSISTANT_PREFIX) else 0,
+            "tool_calls": [],
+        }
+        _runs[run["id"]] = run
+        return run
+
+    def do_POST(self):
+        with _lock:
+            _stats["requests"] += 1
+        path = urlparse(self.path).path.removeprefix("/v1")
+        parts = [p for p in path.split("/") if p]
+        body = self._body()
+
+        if parts == ["embeddings"]:
+            inputs = body.get("input")
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            data = [{"object": "embedding", "index": i, "embedding": _embedding(t)} for i, t in enumerate(inputs)]
+            return self._send(
+                200,
+                {
+                    "object": "list",
+                    "data": data,
+                    "model": body.get("model"),
+                    "usage": {"prompt_tokens": 0, "total_tokens": 0},
+                },
+            )
+
+        if parts == ["threads"]:
+            thread_id = _new_id("thread")
+            with _lock:
+                _threads[thread_id] = {"messages": []}
+                for m in body.get("messages") or []:
+                    _threads[thread_id]["messages"].append(_message(thread_id, m["role"], m["content"]))
+            return self._send(200, {"id": thread_id, "object": "thread", "created_at": _now(), "metadata": {}})
+
+        if parts == ["threads", "runs"]:
+            thread_id = _new_id("thread")
+            with _lock:
+                _threads[thread_id] = {"messages": []}
+                for m in (body.get("thread") or {}).get("messages") or []:
+                    _threads[thread_id]["messages"].append(_message(thread_id, m["role"], m["content"]))
+                run = self._new_run(thread_id, body)
+            return self._send(200, _run_payload(run))
+
+        if len(parts) == 3 and parts[0] == "threads" and parts[2] == "messages":
+            thread_id = parts[1]
+            with _lock:
+                if thread_id not in _threads:
+                    return self._send(404, {"error": {"message": "thread not found"}})
+                msg = _message(thread_id, body.get("role", "user"), body.get("content", ""))
+                _threads[thread_id]["messages"].append(msg)
+            return self._send(200, msg)
+
+        if len(parts) == 3 and parts[0] == "threads" and parts[2] == "runs":
+            thread_id = parts[1]
+            with _lock:
+                if thread_id not in _threads:
+                    return self._send(404, {"error": {"message": "thread not found"}})
+                run = self._new_run(thread_id, body)
+            if body.get("stream"):
+                return self._stream(run)
+            return self._send(200, _run_payload(run))
+
+        if len(parts) == 5 and parts[2] == "runs" and parts[4] == "cancel":
+            with _lock:
+                run = _runs.get(parts[3])
+                if run is None:
+                    return self._send(404, {"error": {"message": "run not found"}})
+                run["status"] = "cancelled"
+                payload = _run_payload(run)
+            return self._send(200, payload)
+
+        if len(parts) == 5 and parts[2] == "runs" and parts[4] == "submit_tool_outputs":
+            with _lock:
+                run = _runs.get(parts[3])
+                if run is None or run["status"] != "requires_action":
+                    return self._send(400, {"error": {"message": "run is not awaiting tool outputs"}})
+                run["tool_rounds_left"] -= 1
+                run["tool_calls"] = []
+                run["status"] = "queued"
+                run["ready_at"] = time.time() + RUN_SECONDS
+            if body.get("stream"):
+                return self._stream(run)
+            return self._send(200, _run_payload(run))
+
+        return self._send(404, {"error": {"message": f"unknown route {path}"}})
+
+    def do_GET(self):
+        with _lock:
+            _stats["requests"] += 1
+        parsed = urlparse(self.path)
+        path = parsed.path.removeprefix("/v1")
+        parts = [p for p in path.split("/") if p]
+
+        if parts == ["_stats"]:
+            with _lock:
+                return self._send(200, dict(_stats, threads=len(_threads), runs=len(_runs)))
+
+        if len(parts) == 4 and parts[0] == "threads" and parts[2] == "runs":
+            with _lock:
+                _stats["run_retrievals"] += 1
+                run = _runs.get(parts[3])
+                if run is None:
+                    return self._send(404, {"error": {"message": "run not found"}})
+                _advance(run)
+                payload = _run_payload(run)
+            headers = {"openai-poll-after-ms": POLL_AFTER_MS} if POLL_AFTER_MS else None
+            return self._send(200, payload, headers)
+
+        if len(parts) == 3 and parts[0] == "threads" and parts[2] == "messages":
+            query = parse_qs(parsed.query)
+            with _lock:
+                thread = _threads.get(parts[1])
+                if thread is None:
+                    return self._send(404, {"error": {"message": "thread not found"}})
+                data = list(thread["messages"])
+            run_id = (query.get("run_id") or [None])[0]
+            if run_id:
+                data = [m for m in data if m["run_id"] == run_id]
+            if (query.get("order") or ["desc"])[0] == "desc":
+                data.reverse()
+            limit = int((query.get("limit") or ["20"])[0])
+            data = data[:limit]
+            return self._send(
+                200,
+                {
+                    "object": "list",
+                    "data": data,
+                    "first_id": data[0]["id"] if data else None,
+                    "last_id": data[-1]["id"] if data else None,
+                    "has_more": False,
+                },
+            )
+
+        if len(parts) == 2 and parts[0] == "assistants":
+            return self._send(
+                200,
+                {
+                    "id": parts[1],
+                    "object": "assistant",
+                    "created_at": 0,
+                    "model": "fake",
+                    "instructions": os.getenv("FAKE_OPENAI_INSTRUCTIONS", ""),
+                    "name": parts[1],
+                    "description": None,
+                    "metadata": {},
+                    "tools": [{"type": "file_search"}],
+                    "tool_resources": {"file_search": {"vector_store_ids": ["vs_fake"]}},
+                },
+            )
+
+        if len(parts) == 2 and parts[0] == "vector_stores":
+            return self._send(
+                200,
+                {
+                    "id": parts[1],
+                    "object": "vector_store",
+                    "created_at": 0,
+                    "name": parts[1],
+                    "status": "completed",
+                    "usage_bytes": 1024,
+                    "last_active_at": _now(),
+                    "metadata": {},
+                    "file_counts": {"in_progress": 0, "completed": 1, "failed": 0, "cancelled": 0, "total": 1},
+                },
+            )
+
+        if parts == ["models"]:
+            return self._send(200, {"object": "list", "data": []})
+
+        return self._send(404, {"error": {"message": f"unknown route {path}"}})
+
+    def do_DELETE(self):
+        with _lock:
+            _stats["requests"] += 1
+        path = urlparse(self.path).path.removeprefix("/v1")
+        parts = [p for p in path.split("/") if p]
+        if len(parts) == 2 and parts[0] == "threads":
+            with _lock:
+                _threads.pop(parts[1], None)
+            return self._send(200, {"id": parts[1], "object": "thread.deleted", "deleted": True})
+        return self._send(404, {"error": {"message": f"unknown route {path}"}})
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Los benchmarks abren cientos de conexiones a la vez; el backlog por defecto (5) no basta
+    request_queue_size = 1024
+
+
+def serve(host="127.0.0.1", port=8765):
+    """Crea el servidor (sin arrancarlo). Uso: `threading.Thread(target=srv.serve_forever).start()`."""
+    return _Server((host, port), Handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    srv = serve(args.host, args.port)
+    print(f"Fake OpenAI listening on http://{args.host}:{args.port}/v1")
+    srv.serve_forever()
@@ -0,0 +1,104 @@
+# scripts/migrate_chat_history_table.py
+"""
+Copia la tabla de historial de chat a una tabla nueva particionada por día de `timestamp`
+y agrupada por `uid, thread_id` (src/bigquery_schema.py). La partición de una tabla
+existente no se puede cambiar en sitio, así que la migración es:
+
+1. `python scripts/migrate_chat_history_table.py`
+   Crea `<BIGQUERY_TABLE_ID>_partitioned` y copia todas las filas.
+2. Apuntar el secreto BIGQUERY_TABLE_ID a la tabla nueva y desplegar.
+3. Volver a ejecutar el script con el BIGQUERY_TABLE_ID antiguo.
+   Como la tabla destino ya existe, solo copia las filas que la revisión anterior siguió
+   escribiendo en la tabla antigua (ventana `--overlap-hours`, sin duplicar).
+
+Requiere las variables de entorno habituales de la app (ver src/config.py).
+
+    python scripts/migrate_chat_history_table.py --dry-run
+    python scripts/migrate_chat_history_table.py --target chat_history_v2
+"""
+import argparse
+import datetime
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def _copy_query(source_fqn, target_fqn, columns, incremental):
+    column_list = ", ".join(columns)
+    select = f"SELECT {', '.join('s.' + column for column in columns)} FROM {source_fqn} AS s"
+    if not incremental:
+        return f"INSERT INTO {target_fqn} ({column_list}) {select}"
+    # Solo las filas recientes que aún no estén en el destino
+    return f"""
+        INSERT INTO {target_fqn} ({column_list})
+        {select}
+        WHERE s.timestamp >= @since
+          AND NOT EXISTS (
+            SELECT 1 FROM {target_fqn} AS t
+            WHERE t.timestamp >= @since
+              AND t.thread_id = s.thread_id
+              AND t.timestamp = s.timestamp
+              AND IFNULL(t.run_id, '') = IFNULL(s.run_id, '')
+          )
+    """
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", help="tabla destino (por defecto <BIGQUERY_TABLE_ID>_partitioned)")
+    parser.add_argument("--overlap-hours", type=float, default=24.0, help="ventana de la copia incremental")
+    parser.add_argument("--dry-run", action="store_true", help="estima los bytes a leer sin crear ni copiar nada")
+    args = parser.parse_args()
+
+    from google.api_core.exceptions import NotFound
+    from google.cloud import bigquery
+
+    from src.bigquery_schema import build_chat_history_table, chat_history_schema, chat_history_table_id, is_partitioned
+    from src.config import bq_client, BIGQUERY_TABLE_ID
+
+    source_id = chat_history_table_id()
+    target_id = chat_history_table_id(args.target or f"{BIGQUERY_TABLE_ID}_partitioned")
+    source = bq_client.get_table(source_id)
+    if is_partitioned(source) and not args.target:
+        print(f"{source_id} ya está particionada por timestamp; no hay nada que migrar.")
+        return
+
+    try:
+        target = bq_client.get_table(target_id)
+        incremental = True
+    except NotFound:
+        target = build_chat_history_table(target_id)
+        incremental = False
+
+    # Columnas de la tabla origen que también existen en el esquema del servicio
+    known = {field.name for field in chat_history_schema()}
+    columns = [field.name for field in source.schema if field.name in known]
+    since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=args.overlap_hours)
+    params = [bigquery.ScalarQueryParameter("since", "TIMESTAMP", since)] if incremental else []
+    query = _copy_query(f"`{source_id}`", f"`{target_id}`", columns, incremental)
+    mode = f"incremental desde {since.isoformat()}" if incremental else "completa"
+
+    if args.dry_run:
+        if not incremental:
+            # El INSERT de la copia completa no se puede validar sin la tabla destino
+            query = f"SELECT {', '.join(columns)} FROM `{source_id}`"
+        job = bq_client.query(query, job_config=bigquery.QueryJobConfig(query_parameters=params, dry_run=True))
+        print(f"copia {mode} {source_id} -> {target_id}: leería {job.total_bytes_processed} bytes (dry run)")
+        return
+
+    if not incremental:
+        bq_client.create_table(target)
+        print(f"creada {target_id} (partición diaria por timestamp, clustering uid, thread_id)")
+    job = bq_client.query(query, job_config=bigquery.QueryJobConfig(query_parameters=params))
+    job.result()
+    print(
+        f"copia {mode} {source_id} -> {target_id}: {job.num_dml_affected_rows} filas, "
+        f"{job.total_bytes_processed} bytes procesados"
+    )
+    if not incremental:
+        print(f"Siguiente paso: BIGQUERY_TABLE_ID={target_id.split('.')[-1]} y volver a ejecutar con la tabla antigua.")
+
+
+if __name__ == "__main__":
+    main()
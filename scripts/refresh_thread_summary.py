@@ -0,0 +1,44 @@
+# scripts/refresh_thread_summary.py
+"""
+Refresca la tabla de resumen por hilo de BigQuery (src/thread_summary.py) que lee
+/chat_history/recents. Pensado para ejecutarse de forma programada, p. ej. como Cloud Run
+Job disparado por Cloud Scheduler cada 5-15 minutos (siempre por debajo de
+THREAD_SUMMARY_MAX_STALENESS_SECONDS), y con `--full` una vez al día para recontar los
+turnos que llegaron con mucho retraso.
+
+El primer refresco (tabla nueva o sin la etiqueta `refreshed_at`) siempre es completo.
+
+Requiere las variables de entorno habituales de la app (ver src/config.py).
+
+    python scripts/refresh_thread_summary.py
+    python scripts/refresh_thread_summary.py --full
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--full", action="store_true", help="reconstruye el resumen con todos los turnos")
+    parser.add_argument(
+        "--overlap-hours",
+        type=float,
+        default=24.0,
+        help="turnos a releer antes del refresco anterior (cubre turnos que llegan tarde)",
+    )
+    args = parser.parse_args()
+
+    from src.thread_summary import refresh_thread_summaries
+
+    result = refresh_thread_summaries(full=args.full, overlap_hours=args.overlap_hours)
+    print(
+        f"resumen {result['mode']} en {result['table']}: {result['bytes_processed']} bytes procesados"
+        f" en {result['seconds']}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+# scripts/report_history_scans.py
+"""
+Bytes que procesan las lecturas del historial en BigQuery (recientes y detalle de un
+hilo) para un usuario, con la caché de consultas desactivada. Sirve para comparar la
+tabla antigua con la particionada y agrupada (scripts/migrate_chat_history_table.py).
+
+Requiere las variables de entorno habituales de la app (ver src/config.py).
+
+    python scripts/report_history_scans.py --uid abc123 --table chat_history --table chat_history_partitioned
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Una consulta servida desde la caché de resultados no procesa bytes
+os.environ["BIGQUERY_USE_QUERY_CACHE"] = "0"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uid", required=True)
+    parser.add_argument("--thread-id", help="hilo a leer (por defecto el más reciente del usuario)")
+    parser.add_argument("--table", action="append", help="tabla a medir (repetible; por defecto BIGQUERY_TABLE_ID)")
+    args = parser.parse_args()
+
+    from src import bigquery_service
+    from src.config import BIGQUERY_TABLE_ID
+
+    for table_id in args.table or [BIGQUERY_TABLE_ID]:
+        # _build_table_fqn lee el id de tabla del módulo
+        bigquery_service.BIGQUERY_TABLE_ID = table_id
+        bigquery_service._query_stats.clear()
+        recents = bigquery_service.fetch_recent_conversations_for_user(args.uid, limit=5)
+        thread_id = args.thread_id or (recents[0]["thread_id"] if recents else None)
+        if thread_id:
+            list(bigquery_service.iter_conversation_turns(args.uid, thread_id))
+        print(f"{table_id}:")
+        for name, stats in bigquery_service.query_stats().items():
+            print(f"  {name:<22} {stats['bytes_processed']:>14,} bytes procesados  ({stats['bytes_billed']:,} facturados)")
+
+
+if __name__ == "__main__":
+    main()
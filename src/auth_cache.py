@@ -0,0 +1,202 @@
+# src/auth_cache.py
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from firebase_admin import auth as fb_auth
+
+from src.config import logger
+from src.metrics import register_stats
+
+# Caché por proceso de ID tokens de Firebase ya verificados. El frontend envía el mismo
+# token (válido 1 h) en cada petición, incluido el polling de progreso, y cada
+# `verify_id_token` es una verificación RSA y a veces una descarga de los certificados
+# públicos de Google. La clave es el SHA-256 del token (el token no se guarda) y cada
+# entrada caduca en el `exp` del propio token.
+#
+# AUTH_CHECK_REVOKED=1 activa el modo con revocación: se verifica con
+# `check_revoked=True` (una llamada a la API de Auth) y las entradas cacheadas se vuelven a
+# comprobar cada AUTH_REVOCATION_RECHECK_SECONDS, que es el retraso máximo con el que se
+# aplica una revocación o la desactivación de un usuario.
+#
+# Los certificados se renuevan en segundo plano antes de que caduquen en la caché HTTP
+# de firebase_admin, para que ninguna petición pague su descarga.
+
+AUTH_TOKEN_CACHE_ENABLED = os.getenv("AUTH_TOKEN_CACHE_ENABLED", "1") == "1"
+AUTH_TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_TOKEN_CACHE_MAX_ENTRIES", "10000"))
+AUTH_CHECK_REVOKED = os.getenv("AUTH_CHECK_REVOKED", "0") == "1"
+AUTH_REVOCATION_RECHECK_SECONDS = float(os.getenv("AUTH_REVOCATION_RECHECK_SECONDS", "300"))
+AUTH_CERT_REFRESH = os.getenv("AUTH_CERT_REFRESH", "1") == "1"
+
+# Fracción del max-age de los certificados tras la que se renuevan
+_CERT_REFRESH_AT = 0.8
+_CERT_REFRESH_MIN_SECONDS = 60.0
+_CERT_REFRESH_RETRY_SECONDS = 30.0
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+
+def _token_key(id_token: str) -> str:
+    return hashlib.sha256(id_token.encode("utf-8")).hexdigest()
+
+
+class TokenCache:
+    """LRU acotada de tokens decodificados, con caducidad en `exp` y renovación de certificados."""
+
+    def __init__(
+        self,
+        max_entries: int = AUTH_TOKEN_CACHE_MAX_ENTRIES,
+        check_revoked: bool = AUTH_CHECK_REVOKED,
+        recheck_seconds: float = AUTH_REVOCATION_RECHECK_SECONDS,
+        enabled: bool = AUTH_TOKEN_CACHE_ENABLED,
+    ):
+        self.max_entries = max_entries
+        self.check_revoked = check_revoked
+        self.recheck_seconds = recheck_seconds
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        # clave -> (claims, exp en epoch, instante de la última verificación)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._refresher: Optional[threading.Thread] = None
+        self._refresher_pid: Optional[int] = None
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evictions": 0,
+            "revocation_checks": 0,
+            "failures": 0,
+            "verifications": 0,
+            "verify_ms_total": 0.0,
+            "verify_ms_max": 0.0,
+            "cert_refreshes": 0,
+            "cert_refresh_errors": 0,
+        }
+
+    # -- API pública --------------------------------------------------------------
+    def lookup(self, id_token: str) -> Optional[Dict[str, Any]]:
+        """Claims cacheados y vigentes del token, sin verificar nada. None si hay que verificar."""
+        if not self.enabled:
+            return None
+        key = _token_key(id_token)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            claims, exp, verified_at = entry
+            if now >= exp:
+                del self._entries[key]
+                self._stats["expired"] += 1
+                return None
+            if self.check_revoked and now - verified_at >= self.recheck_seconds:
+                # Toca volver a preguntar a la API de Auth si el token sigue valiendo
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return dict(claims)
+
+    def verify(self, id_token: str) -> Dict[str, Any]:
+        """Como `fb_auth.verify_id_token`, pero sirviendo desde la caché si es posible."""
+        self._ensure_refresher()
+        cached = self.lookup(id_token)
+        if cached is not None:
+            return cached
+
+        key = _token_key(id_token)
+        started = time.monotonic()
+        try:
+            claims = fb_auth.verify_id_token(id_token, check_revoked=self.check_revoked)
+        except Exception:
+            # Token caducado, revocado o inválido: no puede seguir en la caché
+            with self._lock:
+                self._entries.pop(key, None)
+            self._count("failures")
+            raise
+        finally:
+            self._record_verification((time.monotonic() - started) * 1000)
+
+        self._store(key, claims)
+        return dict(claims)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._entries))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["verify_ms_avg"] = round(stats["verify_ms_total"] / stats["verifications"], 2) if stats["verifications"] else 0.0
+        return stats
+
+    # -- Internos -------------------------------------------------------------------
+    def _store(self, key: str, claims: Dict[str, Any]):
+        exp = claims.get("exp")
+        with self._lock:
+            if self.check_revoked:
+                self._stats["revocation_checks"] += 1
+            # Sin `exp` no se sabe hasta cuándo vale: no se cachea
+            if not self.enabled or not isinstance(exp, (int, float)):
+                return
+            self._entries[key] = (dict(claims), float(exp), time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def _record_verification(self, elapsed_ms: float):
+        with self._lock:
+            self._stats["misses"] += 1
+            self._stats["verifications"] += 1
+            self._stats["verify_ms_total"] += elapsed_ms
+            self._stats["verify_ms_max"] = max(self._stats["verify_ms_max"], elapsed_ms)
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._stats[name] += amount
+
+    # -- Renovación de certificados -------------------------------------------------
+    def _ensure_refresher(self):
+        if not AUTH_CERT_REFRESH or os.getenv("FIREBASE_AUTH_EMULATOR_HOST"):
+            # El emulador no firma los tokens: no hay certificados que descargar
+            return
+        # Tras un fork (gunicorn --preload) el hilo del padre no existe en el hijo
+        with self._lock:
+            if self._refresher is not None and self._refresher.is_alive() and self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+            self._refresher = threading.Thread(target=self._refresh_certs, name="auth-cert-refresh", daemon=True)
+            self._refresher.start()
+
+    def _refresh_certs(self):
+        while True:
+            try:
+                max_age = self._fetch_certs()
+                self._count("cert_refreshes")
+                delay = max(_CERT_REFRESH_MIN_SECONDS, max_age * _CERT_REFRESH_AT)
+            except Exception as e:
+                logger.warning(f"Auth: no se pudieron renovar los certificados de Firebase: {e}")
+                self._count("cert_refresh_errors")
+                delay = _CERT_REFRESH_RETRY_SECONDS
+            time.sleep(delay)
+
+    def _fetch_certs(self) -> float:
+        """Descarga los certificados en la caché HTTP del verificador de firebase_admin. Devuelve su max-age."""
+        from firebase_admin import _token_gen
+
+        verifier = fb_auth._get_client(None)._token_verifier
+        # `no-cache` salta la copia cacheada; la respuesta nueva la reemplaza
+        response = verifier.request(url=_token_gen.ID_TOKEN_CERT_URI, headers={"Cache-Control": "no-cache"})
+        if response.status != 200:
+            raise RuntimeError(f"HTTP {response.status} al descargar {_token_gen.ID_TOKEN_CERT_URI}")
+        match = _MAX_AGE_RE.search(response.headers.get("cache-control", "") or "")
+        return float(match.group(1)) if match else _CERT_REFRESH_MIN_SECONDS
+
+
+token_cache = TokenCache()
+register_stats("token_cache", token_cache.stats)
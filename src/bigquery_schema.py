@@ -0,0 +1,142 @@
+# src/bigquery_schema.py
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Dict, List
+
+from google.api_core.exceptions import NotFound
+
+if TYPE_CHECKING:
+    from google.cloud import bigquery
+
+from src.config import bq_client, logger, BIGQUERY_DATASET_ID, BIGQUERY_TABLE_ID
+
+# Definición de la tabla de historial de chat. El servicio es su dueño: al arrancar la
+# crea si no existe (particionada por día de `timestamp` y agrupada por `uid, thread_id`,
+# que son los filtros de todas las lecturas del historial), añade las columnas que falten
+# y fija el clustering. La partición de una tabla existente no se puede cambiar en sitio:
+# para eso está scripts/migrate_chat_history_table.py.
+#
+# La tabla de resumen por hilo (src/thread_summary.py) también se define aquí.
+
+BIGQUERY_MANAGE_TABLE = os.getenv("BIGQUERY_MANAGE_TABLE", "1") == "1"
+BIGQUERY_SUMMARY_TABLE_ID = os.getenv("BIGQUERY_SUMMARY_TABLE_ID", f"{BIGQUERY_TABLE_ID}_thread_summary")
+
+PARTITION_FIELD = "timestamp"
+CLUSTERING_FIELDS = ["uid", "thread_id"]
+
+
+# Los esquemas se construyen al usarlos: importar google.cloud.bigquery cuesta ~180 ms y
+# la app solo lo necesita al tocar BigQuery (ver "Presupuesto de importación" en el README)
+def chat_history_schema() -> List["bigquery.SchemaField"]:
+    # Todas NULLABLE: las filas antiguas no siempre traen uid/run_id y añadir columnas
+    # REQUIRED a una tabla existente no está permitido
+    from google.cloud import bigquery
+
+    return [
+        bigquery.SchemaField("timestamp", "TIMESTAMP"),
+        bigquery.SchemaField("thread_id", "STRING"),
+        bigquery.SchemaField("user_message", "STRING"),
+        bigquery.SchemaField("assistant_response", "STRING"),
+        bigquery.SchemaField("endpoint_source", "STRING"),
+        bigquery.SchemaField("run_id", "STRING"),
+        bigquery.SchemaField("assistant_name", "STRING"),
+        bigquery.SchemaField("user_id", "STRING"),
+        bigquery.SchemaField("uid", "STRING"),
+        bigquery.SchemaField("email", "STRING"),
+        bigquery.SchemaField("email_verified", "BOOL"),
+    ]
+
+
+def thread_summary_schema() -> List["bigquery.SchemaField"]:
+    # Una fila por hilo; la mantiene scripts/refresh_thread_summary.py con MERGE incrementales
+    from google.cloud import bigquery
+
+    return [
+        bigquery.SchemaField("uid", "STRING", mode="REQUIRED"),
+        bigquery.SchemaField("thread_id", "STRING", mode="REQUIRED"),
+        bigquery.SchemaField("endpoint_source", "STRING"),
+        bigquery.SchemaField("first_message", "STRING"),
+        bigquery.SchemaField("first_timestamp", "TIMESTAMP"),
+        bigquery.SchemaField("last_timestamp", "TIMESTAMP"),
+        bigquery.SchemaField("turn_count", "INT64"),
+        bigquery.SchemaField("updated_at", "TIMESTAMP"),
+    ]
+
+
+def chat_history_table_id(table_id: str = BIGQUERY_TABLE_ID) -> str:
+    return f"{bq_client.project}.{BIGQUERY_DATASET_ID}.{table_id}"
+
+
+def build_chat_history_table(table_id: str) -> "bigquery.Table":
+    """Tabla (sin crear) con el esquema, la partición y el clustering del historial."""
+    from google.cloud import bigquery
+
+    table = bigquery.Table(table_id, schema=chat_history_schema())
+    table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field=PARTITION_FIELD)
+    table.clustering_fields = CLUSTERING_FIELDS
+    return table
+
+
+def thread_summary_table_id() -> str:
+    return chat_history_table_id(BIGQUERY_SUMMARY_TABLE_ID)
+
+
+def build_thread_summary_table(table_id: str) -> "bigquery.Table":
+    from google.cloud import bigquery
+
+    table = bigquery.Table(table_id, schema=thread_summary_schema())
+    table.clustering_fields = CLUSTERING_FIELDS
+    return table
+
+
+def is_partitioned(table: "bigquery.Table") -> bool:
+    partitioning = table.time_partitioning
+    return partitioning is not None and partitioning.field == PARTITION_FIELD
+
+
+def ensure_chat_history_table(client=None) -> Dict[str, Any]:
+    """Crea la tabla si no existe o la pone al día (columnas y clustering). Devuelve qué hizo."""
+    client = client or bq_client
+    table_id = chat_history_table_id()
+    try:
+        table = client.get_table(table_id)
+    except NotFound:
+        client.create_table(build_chat_history_table(table_id), exists_ok=True)
+        logger.info("BigQuery: created table %s partitioned by %s and clustered by %s.", table_id, PARTITION_FIELD, CLUSTERING_FIELDS)
+        return {"table": table_id, "created": True, "updated": [], "partitioned": True}
+
+    updated: List[str] = []
+    existing = {field.name for field in table.schema}
+    missing = [field for field in chat_history_schema() if field.name not in existing]
+    if missing:
+        table.schema = list(table.schema) + missing
+        updated.append("schema")
+    if list(table.clustering_fields or []) != CLUSTERING_FIELDS:
+        # Solo afecta a los datos nuevos; la migración reescribe los anteriores
+        table.clustering_fields = CLUSTERING_FIELDS
+        updated.append("clustering_fields")
+    if updated:
+        client.update_table(table, updated)
+        logger.info("BigQuery: updated %s on table %s.", ", ".join(updated), table_id)
+
+    partitioned = is_partitioned(table)
+    if not partitioned:
+        logger.warning(
+            "BigQuery: table %s is not partitioned by %s; history reads scan the whole table. "
+            "Run scripts/migrate_chat_history_table.py.",
+            table_id,
+            PARTITION_FIELD,
+        )
+    return {"table": table_id, "created": False, "updated": updated, "partitioned": partitioned}
+
+
+def start_table_check():
+    """Comprueba la tabla en segundo plano para no retrasar el arranque."""
+
+    def _check():
+        try:
+            ensure_chat_history_table()
+        except Exception as e:
+            logger.error(f"BigQuery: no se pudo comprobar la tabla de historial: {e}", exc_info=True)
+
+    threading.Thread(target=_check, name="bigquery-table-check", daemon=True).start()
@@ -1,14 +1,26 @@
 # src/bigquery_service.py
 import datetime
 import os
-from typing import Optional, List, Dict, Any
-
-from google.cloud import bigquery
+import threading
+from typing import Optional, Iterator, List, Dict, Any, Tuple
 
 from src.config import bq_client, logger, BIGQUERY_DATASET_ID, BIGQUERY_TABLE_ID
+from src.bigquery_writer import BIGQUERY_ASYNC_WRITES, bigquery_writer
+from src.bigquery_schema import thread_summary_table_id
+from src.metrics import register_stats
+from src.thread_summary import fresh_summary_watermark
+from src.timing import span
 
 # Permite desactivar las escrituras en BigQuery cuando se trabaja en local.
 DISABLE_BIGQUERY = os.getenv("DISABLE_BIGQUERY", "0") == "1"
+# Ventana de /chat_history/recents: acota las particiones (días) que lee la consulta.
+# 0 = sin límite (lee toda la tabla).
+HISTORY_RECENTS_LOOKBACK_DAYS = int(os.getenv("HISTORY_RECENTS_LOOKBACK_DAYS", "90"))
+BIGQUERY_USE_QUERY_CACHE = os.getenv("BIGQUERY_USE_QUERY_CACHE", "1") == "1"
+
+# Bytes procesados por tipo de consulta, para comprobar el efecto de partición y clustering
+_query_stats: Dict[str, Dict[str, int]] = {}
+_query_stats_lock = threading.Lock()
 
 
 def insert_chat_turn_to_bigquery(
@@ -23,7 +35,11 @@ def insert_chat_turn_to_bigquery(
     email: Optional[str] = None,
     email_verified: Optional[bool] = None,
 ):
-    """Inserta una fila en la tabla de historial de chat de BigQuery."""
+    """Inserta una fila en la tabla de historial de chat de BigQuery y la devuelve.
+
+    Con BIGQUERY_ASYNC_WRITES (por defecto) la fila se encola y la escribe en lote
+    `src/bigquery_writer.py`; la función vuelve sin esperar a BigQuery.
+    """
 
     row = {
         "timestamp": datetime.datetime.utcnow().isoformat(),
@@ -48,18 +64,26 @@ def insert_chat_turn_to_bigquery(
 
     if DISABLE_BIGQUERY:
         logger.info("BigQuery disabled via DISABLE_BIGQUERY=1. Skipping insert: %s", row)
-        return
+        return row
+
+    if BIGQUERY_ASYNC_WRITES:
+        # El run_id identifica el turno: reenvíos del mismo turno no crean filas nuevas
+        bigquery_writer.submit(row, insert_id=run_id)
+        logger.info("BigQuery: Queued turn for thread %s.", thread_id)
+        return row
 
     table_ref = bq_client.dataset(BIGQUERY_DATASET_ID).table(BIGQUERY_TABLE_ID)
 
     try:
-        errors = bq_client.insert_rows_json(table_ref, [row])
+        with span("bq_insert", "bigquery"):
+            errors = bq_client.insert_rows_json(table_ref, [row])
         if not errors:
             logger.info("BigQuery: Successfully stored turn for thread %s.", thread_id)
         else:
             logger.error("BigQuery: Encountered errors while inserting rows: %s", errors)
     except Exception:
         logger.error("BigQuery: Failed to stream data for thread %s.", thread_id, exc_info=True)
+    return row
 
 
 def _build_table_fqn() -> str:
@@ -68,6 +92,48 @@ def _build_table_fqn() -> str:
     return f"`{project_id}.{BIGQUERY_DATASET_ID}.{BIGQUERY_TABLE_ID}`"
 
 
+def _param(name: str, type_: str, value: Any):
+    # google.cloud.bigquery se importa en la primera consulta, no al arrancar la app
+    from google.cloud import bigquery
+
+    return bigquery.ScalarQueryParameter(name, type_, value)
+
+
+def _run_query(name: str, query: str, params: List[Any], **result_kwargs):
+    """Lanza una consulta parametrizada y registra los bytes que ha procesado."""
+    from google.cloud import bigquery
+
+    job_config = bigquery.QueryJobConfig(query_parameters=params, use_query_cache=BIGQUERY_USE_QUERY_CACHE)
+    with span("bq_" + name, "bigquery"):
+        job = bq_client.query(query, job_config=job_config)
+        rows = job.result(**result_kwargs)
+    _record_query(name, job)
+    return rows
+
+
+def _record_query(name: str, job):
+    processed = job.total_bytes_processed or 0
+    billed = job.total_bytes_billed or 0
+    cache_hit = bool(job.cache_hit)
+    logger.info(
+        "BigQuery: %s processed %d bytes (billed %d, cache_hit=%s, job %s).", name, processed, billed, cache_hit, job.job_id
+    )
+    with _query_stats_lock:
+        stats = _query_stats.setdefault(name, {"queries": 0, "bytes_processed": 0, "bytes_billed": 0, "cache_hits": 0})
+        stats["queries"] += 1
+        stats["bytes_processed"] += processed
+        stats["bytes_billed"] += billed
+        stats["cache_hits"] += int(cache_hit)
+
+
+def query_stats() -> Dict[str, Dict[str, int]]:
+    with _query_stats_lock:
+        return {name: dict(stats) for name, stats in _query_stats.items()}
+
+
+register_stats("bigquery_queries", query_stats)
+
+
 def _normalize_timestamp(value: Any) -> Optional[str]:
     """Convierte valores de marca de tiempo de BigQuery a ISO 8601 (UTC)."""
     if value is None:
@@ -90,6 +156,98 @@ def fetch_recent_conversations_for_user(uid: str, limit: int = 5) -> List[Dict[s
         logger.info("BigQuery disabled. Returning empty recent conversation list for uid=%s.", uid)
         return []
 
+    rows = None
+    watermark = fresh_summary_watermark()
+    if watermark is not None:
+        try:
+            rows = _recent_threads_from_summary(uid, limit, watermark)
+        except Exception as exc:
+            logger.warning("BigQuery: thread summary lookup failed for uid=%s, using the turns table: %s", uid, exc)
+    if rows is None:
+        rows = _recent_threads_from_turns(uid, limit)
+
+    conversations: List[Dict[str, Any]] = []
+    for row in rows:
+        summary_raw = (row.get("summary_text") or "").strip()
+        summary = " ".join(summary_raw.split())[:160] or "Conversacion previa"
+        conversations.append({
+            "thread_id": row.get("thread_id"),
+            "endpoint_source": row.get("endpoint_source"),
+            "last_timestamp": _normalize_timestamp(row.get("last_timestamp")),
+            "summary": summary,
+        })
+    return conversations
+
+
+def user_has_other_threads(uid: str, thread_id: str) -> bool:
+    """Si el usuario tiene en BigQuery turnos de algún hilo distinto de `thread_id`."""
+    if DISABLE_BIGQUERY:
+        return False
+    query = f"""
+        SELECT 1
+        FROM {_build_table_fqn()}
+        WHERE uid = @uid AND thread_id != @thread_id
+        LIMIT 1
+    """
+    params = [
+        _param("uid", "STRING", uid),
+        _param("thread_id", "STRING", thread_id),
+    ]
+    return any(True for _ in _run_query("user_has_threads", query, params))
+
+
+def _recent_threads_from_summary(uid: str, limit: int, watermark: datetime.datetime) -> List[Any]:
+    """Hilos recientes desde la tabla de resumen, completada con los turnos posteriores a `watermark`."""
+    query = f"""
+        WITH summary AS (
+            SELECT thread_id, endpoint_source, first_message, last_timestamp
+            FROM `{thread_summary_table_id()}`
+            WHERE uid = @uid
+        ),
+        recent AS (
+            SELECT
+                thread_id,
+                ANY_VALUE(endpoint_source) AS endpoint_source,
+                MAX(timestamp) AS last_timestamp,
+                COALESCE(
+                    ARRAY_AGG(user_message IGNORE NULLS ORDER BY timestamp ASC LIMIT 1)[SAFE_OFFSET(0)],
+                    ARRAY_AGG(assistant_response IGNORE NULLS ORDER BY timestamp ASC LIMIT 1)[SAFE_OFFSET(0)]
+                ) AS first_message
+            FROM {_build_table_fqn()}
+            WHERE uid = @uid AND timestamp > @watermark
+            GROUP BY thread_id
+        )
+        SELECT
+            thread_id,
+            COALESCE(s.endpoint_source, r.endpoint_source) AS endpoint_source,
+            GREATEST(IFNULL(s.last_timestamp, r.last_timestamp), IFNULL(r.last_timestamp, s.last_timestamp)) AS last_timestamp,
+            COALESCE(s.first_message, r.first_message, 'Conversacion sin mensajes') AS summary_text
+        FROM summary AS s
+        FULL OUTER JOIN recent AS r USING (thread_id)
+        ORDER BY last_timestamp DESC
+        LIMIT @limit
+    """
+    params = [
+        _param("uid", "STRING", uid),
+        _param("watermark", "TIMESTAMP", watermark),
+        _param("limit", "INT64", limit),
+    ]
+    return list(_run_query("recent_conversations_summary", query, params))
+
+
+def _recent_threads_from_turns(uid: str, limit: int) -> List[Any]:
+    """Hilos recientes agregando los turnos del usuario (consulta original, sin resumen)."""
+    filters = ["uid = @uid"]
+    params = [
+        _param("uid", "STRING", uid),
+        _param("limit", "INT64", limit),
+    ]
+    if HISTORY_RECENTS_LOOKBACK_DAYS > 0:
+        # Filtro sobre la columna de partición: solo se leen los días de la ventana
+        since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=HISTORY_RECENTS_LOOKBACK_DAYS)
+        filters.append("timestamp >= @since")
+        params.append(_param("since", "TIMESTAMP", since))
+
     table_fqn = _build_table_fqn()
     query = f"""
         WITH user_turns AS (
@@ -100,7 +258,7 @@ def fetch_recent_conversations_for_user(uid: str, limit: int = 5) -> List[Dict[s
                 assistant_response,
                 endpoint_source
             FROM {table_fqn}
-            WHERE uid = @uid
+            WHERE {" AND ".join(filters)}
         ),
         thread_stats AS (
             SELECT
@@ -121,34 +279,57 @@ def fetch_recent_conversations_for_user(uid: str, limit: int = 5) -> List[Dict[s
         LIMIT @limit
     """
 
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("uid", "STRING", uid),
-            bigquery.ScalarQueryParameter("limit", "INT64", limit),
-        ]
-    )
-
     try:
-        rows = bq_client.query(query, job_config=job_config).result()
+        return list(_run_query("recent_conversations", query, params))
     except Exception:
         logger.error("BigQuery: Failed to fetch recent conversations for uid=%s.", uid, exc_info=True)
         raise
 
-    conversations: List[Dict[str, Any]] = []
-    for row in rows:
-        summary_raw = (row.get("summary_text") or "").strip()
-        summary = " ".join(summary_raw.split())[:160] or "Conversacion previa"
-        conversations.append({
-            "thread_id": row.get("thread_id"),
-            "endpoint_source": row.get("endpoint_source"),
-            "last_timestamp": _normalize_timestamp(row.get("last_timestamp")),
-            "summary": summary,
+
+# Filas por página al leer un hilo del iterador de BigQuery
+_THREAD_PAGE_SIZE = 500
+
+# Cursor de paginación de un hilo: (timestamp, turn_key). turn_key desempata turnos con el
+# mismo timestamp: es el run_id ("" en filas antiguas sin run), que también identifica el
+# documento del turno en Firestore (src/history_store.py). Con turn_key None el cursor
+# compara solo el timestamp (cursores antiguos).
+TurnCursor = Tuple[datetime.datetime, Optional[str]]
+_TURN_KEY_SQL = "COALESCE(run_id, '')"
+
+
+def turn_messages(timestamp_iso: Optional[str], user_message: Optional[str], assistant_response: Optional[str]) -> List[Dict[str, Any]]:
+    """Mensajes (usuario y asistente) que aporta un turno al detalle de una conversación."""
+    messages: List[Dict[str, Any]] = []
+    if user_message:
+        messages.append({
+            "role": "user",
+            "text": user_message,
+            "timestamp": timestamp_iso,
         })
-    return conversations
+    if assistant_response:
+        messages.append({
+            "role": "assistant",
+            "text": assistant_response,
+            "timestamp": timestamp_iso,
+        })
+    return messages
 
 
-def fetch_conversation_thread(uid: str, thread_id: str) -> Dict[str, Any]:
-    """Recupera el detalle completo de una conversaci��n perteneciente al usuario."""
+def iter_conversation_turns(
+    uid: str,
+    thread_id: str,
+    before: Optional[TurnCursor] = None,
+    after: Optional[TurnCursor] = None,
+    limit: Optional[int] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Genera los turnos de una conversación del usuario en orden cronológico, leyendo el
+    iterador de filas de BigQuery sin materializar el hilo.
+
+    `before`/`after` son cursores exclusivos (timestamp, turn_key) (ver `TurnCursor`). Con
+    `limit`, sin `after`, se devuelven los `limit` turnos más recientes (anteriores a
+    `before` si se indica); con `after`, los `limit` siguientes.
+    """
     if not uid:
         raise ValueError("uid is required to fetch a conversation thread")
     if not thread_id:
@@ -156,50 +337,70 @@ def fetch_conversation_thread(uid: str, thread_id: str) -> Dict[str, Any]:
 
     if DISABLE_BIGQUERY:
         logger.info("BigQuery disabled. Returning empty conversation for uid=%s thread_id=%s.", uid, thread_id)
-        return {"thread_id": thread_id, "endpoint_source": None, "messages": []}
+        return
+
+    filters = ["uid = @uid", "thread_id = @thread_id"]
+    params = [
+        _param("uid", "STRING", uid),
+        _param("thread_id", "STRING", thread_id),
+    ]
+    for name, cursor, op in (("before", before, "<"), ("after", after, ">")):
+        if cursor is None:
+            continue
+        timestamp, key = cursor
+        params.append(_param(name, "TIMESTAMP", timestamp))
+        if key is None:
+            filters.append(f"timestamp {op} @{name}")
+            continue
+        # Desempate por turn_key: una página que acaba a mitad de un grupo de turnos con
+        # el mismo timestamp no se salta el resto del grupo
+        filters.append(f"(timestamp {op} @{name} OR (timestamp = @{name} AND {_TURN_KEY_SQL} {op} @{name}_key))")
+        params.append(_param(f"{name}_key", "STRING", key))
+    newest_first = limit is not None and after is None
+    direction = "DESC" if newest_first else "ASC"
+    limit_clause = ""
+    if limit is not None:
+        limit_clause = "LIMIT @limit"
+        params.append(_param("limit", "INT64", limit))
 
     table_fqn = _build_table_fqn()
     query = f"""
-        SELECT timestamp, user_message, assistant_response, endpoint_source
+        SELECT timestamp, {_TURN_KEY_SQL} AS turn_key, user_message, assistant_response, endpoint_source
         FROM {table_fqn}
-        WHERE uid = @uid AND thread_id = @thread_id
-        ORDER BY timestamp ASC
+        WHERE {" AND ".join(filters)}
+        ORDER BY timestamp {direction}, turn_key {direction}
+        {limit_clause}
     """
 
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("uid", "STRING", uid),
-            bigquery.ScalarQueryParameter("thread_id", "STRING", thread_id),
-        ]
-    )
-
     try:
-        rows = bq_client.query(query, job_config=job_config).result()
+        rows = _run_query("conversation_thread", query, params, page_size=_THREAD_PAGE_SIZE)
     except Exception:
         logger.error("BigQuery: Failed to fetch conversation thread %s for uid=%s.", thread_id, uid, exc_info=True)
         raise
 
+    turns = (
+        {
+            "timestamp": _normalize_timestamp(row.get("timestamp")),
+            "turn_key": row.get("turn_key"),
+            "user_message": row.get("user_message"),
+            "assistant_response": row.get("assistant_response"),
+            "endpoint_source": row.get("endpoint_source"),
+        }
+        for row in rows
+    )
+    if newest_first:
+        # Página acotada por `limit`: se invierte para devolverla en orden cronológico
+        turns = reversed(list(turns))
+    yield from turns
+
+
+def fetch_conversation_thread(uid: str, thread_id: str) -> Dict[str, Any]:
+    """Recupera el detalle completo de una conversación perteneciente al usuario."""
     messages: List[Dict[str, Any]] = []
     endpoint_source = None
-    for row in rows:
-        endpoint_source = endpoint_source or row.get("endpoint_source")
-        timestamp_iso = _normalize_timestamp(row.get("timestamp"))
-
-        user_msg = row.get("user_message")
-        if user_msg:
-            messages.append({
-                "role": "user",
-                "text": user_msg,
-                "timestamp": timestamp_iso,
-            })
-
-        assistant_msg = row.get("assistant_response")
-        if assistant_msg:
-            messages.append({
-                "role": "assistant",
-                "text": assistant_msg,
-                "timestamp": timestamp_iso,
-            })
+    for turn in iter_conversation_turns(uid, thread_id):
+        endpoint_source = endpoint_source or turn["endpoint_source"]
+        messages.extend(turn_messages(turn["timestamp"], turn["user_message"], turn["assistant_response"]))
 
     return {
         "thread_id": thread_id,
@@ -207,3 +408,75 @@ def fetch_conversation_thread(uid: str, thread_id: str) -> Dict[str, Any]:
         "messages": messages,
         "total_messages": len(messages),
     }
+
+
+def fetch_first_turns_for_endpoint(
+    endpoint_source: str, assistant_name: str, limit: int = 2000, lookback_days: int = HISTORY_RECENTS_LOOKBACK_DAYS
+) -> List[Dict[str, Any]]:
+    """Primer turno (pregunta + respuesta) de los hilos más recientes de un endpoint.
+
+    Se usa para sembrar la caché semántica: solo el primer turno de cada hilo es
+    independiente del contexto de la conversación. Solo se leen los últimos
+    `lookback_days` días (0 = toda la tabla).
+    """
+    if DISABLE_BIGQUERY:
+        logger.info("BigQuery disabled. Returning no first turns for endpoint=%s.", endpoint_source)
+        return []
+
+    filters = ["endpoint_source = @endpoint_source"]
+    outer_filters = ""
+    params = [
+        _param("endpoint_source", "STRING", endpoint_source),
+        _param("assistant_name", "STRING", assistant_name),
+        _param("limit", "INT64", limit),
+    ]
+    if lookback_days > 0:
+        # Filtro sobre la columna de partición: solo se leen los días de la ventana
+        since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=lookback_days)
+        filters.append("timestamp >= @since")
+        params.append(_param("since", "TIMESTAMP", since))
+        # El primer turno dentro de la ventana de un hilo que empezó antes no es el primero
+        # del hilo: se descartan los que la tabla de resumen sabe que empezaron antes
+        if fresh_summary_watermark() is not None:
+            outer_filters = f"""
+          AND thread_id NOT IN (
+              SELECT thread_id FROM `{thread_summary_table_id()}` WHERE first_timestamp < @since
+          )"""
+
+    table_fqn = _build_table_fqn()
+    query = f"""
+        SELECT thread_id, timestamp, user_message, assistant_response
+        FROM (
+            SELECT
+                thread_id,
+                timestamp,
+                user_message,
+                assistant_response,
+                assistant_name,
+                ROW_NUMBER() OVER (PARTITION BY thread_id ORDER BY timestamp ASC) AS turn_index
+            FROM {table_fqn}
+            WHERE {" AND ".join(filters)}
+        )
+        WHERE turn_index = 1
+          AND assistant_name = @assistant_name
+          AND user_message IS NOT NULL
+          AND assistant_response IS NOT NULL{outer_filters}
+        ORDER BY timestamp DESC
+        LIMIT @limit
+    """
+
+    try:
+        rows = _run_query("first_turns", query, params)
+    except Exception:
+        logger.error("BigQuery: Failed to fetch first turns for endpoint=%s.", endpoint_source, exc_info=True)
+        raise
+
+    return [
+        {
+            "thread_id": row.get("thread_id"),
+            "timestamp": _normalize_timestamp(row.get("timestamp")),
+            "user_message": row.get("user_message"),
+            "assistant_response": row.get("assistant_response"),
+        }
+        for row in rows
+    ]
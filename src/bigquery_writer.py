@@ -0,0 +1,265 @@
+# src/bigquery_writer.py
+import atexit
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.config import bq_client, logger, BIGQUERY_DATASET_ID, BIGQUERY_TABLE_ID
+from src.metrics import register_stats
+from src.timing import timed
+
+# Escritura de turnos en BigQuery fuera del camino de la petición. Los handlers encolan la
+# fila y responden; un hilo de fondo agrupa las filas y las envía en lotes con
+# `insert_rows_json` cuando hay BIGQUERY_BATCH_SIZE filas o han pasado
+# BIGQUERY_FLUSH_SECONDS desde la primera del lote. Cada fila lleva un `insertId` (el
+# run_id del turno si lo hay), así que reenviar un lote tras un error no duplica filas
+# (deduplicación best effort de BigQuery).
+#
+# Dos modos de cola:
+#   - en memoria (por defecto): cola acotada; se vacía al terminar el proceso tras el
+#     SIGTERM de Cloud Run (gunicorn y uvicorn salen de forma ordenada) dentro de
+#     BIGQUERY_DRAIN_SECONDS. Si se llena, la fila se escribe de forma síncrona.
+#   - spool en disco (BIGQUERY_SPOOL_DIR): cada turno se guarda antes en SQLite (ver
+#     src/turn_spool.py) y solo se borra cuando BigQuery lo acepta. Una caída larga de
+#     BigQuery no bloquea las respuestas ni pierde turnos: se reintentan sin límite.
+
+BIGQUERY_ASYNC_WRITES = os.getenv("BIGQUERY_ASYNC_WRITES", "1") == "1"
+BIGQUERY_BATCH_SIZE = int(os.getenv("BIGQUERY_BATCH_SIZE", "200"))
+BIGQUERY_FLUSH_SECONDS = float(os.getenv("BIGQUERY_FLUSH_SECONDS", "2"))
+BIGQUERY_QUEUE_MAX = int(os.getenv("BIGQUERY_QUEUE_MAX", "10000"))
+BIGQUERY_WRITE_RETRIES = int(os.getenv("BIGQUERY_WRITE_RETRIES", "5"))
+# Cloud Run concede 10 s entre SIGTERM y SIGKILL
+BIGQUERY_DRAIN_SECONDS = float(os.getenv("BIGQUERY_DRAIN_SECONDS", "8"))
+BIGQUERY_SPOOL_DIR = os.getenv("BIGQUERY_SPOOL_DIR", "")
+BIGQUERY_RETRY_MAX_SECONDS = float(os.getenv("BIGQUERY_RETRY_MAX_SECONDS", "60"))
+
+# Motivos de error por fila que se pueden reintentar (el resto, p. ej. "invalid", no)
+_RETRYABLE_REASONS = {"stopped", "timeout", "backendError", "internalError", "rateLimitExceeded"}
+
+
+def _retryable(row_errors: List[Dict[str, Any]]) -> bool:
+    return all(error.get("reason") in _RETRYABLE_REASONS for error in row_errors)
+
+
+def _backoff(attempt: int) -> float:
+    """Espera exponencial con jitter antes del reintento número `attempt` (desde 0)."""
+    return min(2 ** attempt, BIGQUERY_RETRY_MAX_SECONDS) * random.uniform(0.5, 1.0)
+
+
+class BigQueryBatchWriter:
+    """Cola (en memoria o en disco) + hilo de fondo que inserta filas en lotes con reintentos."""
+
+    def __init__(
+        self,
+        batch_size: int = BIGQUERY_BATCH_SIZE,
+        flush_seconds: float = BIGQUERY_FLUSH_SECONDS,
+        max_queue: int = BIGQUERY_QUEUE_MAX,
+        retries: int = BIGQUERY_WRITE_RETRIES,
+        spool=None,
+        client=None,
+    ):
+        self.client = client or bq_client
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.retries = retries
+        self.spool = spool
+        self._queue: "queue.Queue[tuple]" = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._table_ref = None
+        self._failures = 0
+        self._stats = {"queued": 0, "written": 0, "batches": 0, "retries": 0, "dropped": 0, "overflow": 0}
+
+    # -- API pública --------------------------------------------------------------
+    def submit(self, row: Dict[str, Any], insert_id: Optional[str] = None):
+        """Encola una fila. En modo memoria, si la cola está llena la escribe de inmediato."""
+        item = (insert_id or str(uuid.uuid4()), row)
+        self._ensure_worker()
+        if self.spool is not None:
+            self.spool.append(*item)
+            self._count("queued")
+            self._wake.set()
+            return
+        try:
+            self._queue.put_nowait(item)
+            self._count("queued")
+        except queue.Full:
+            self._count("overflow")
+            logger.warning("BigQuery: write queue full; inserting row synchronously.")
+            self._write_batch([item])
+
+    def flush(self, timeout: float = BIGQUERY_DRAIN_SECONDS) -> bool:
+        """Detiene el hilo de fondo tras vaciar la cola. Devuelve False si no dio tiempo."""
+        self._stop.set()
+        self._wake.set()
+        worker = self._worker
+        if worker is not None and worker.is_alive() and self._pid == os.getpid():
+            worker.join(timeout)
+            drained = not worker.is_alive()
+        elif self.spool is None:
+            deadline = time.monotonic() + timeout
+            while not self._queue.empty() and time.monotonic() < deadline:
+                self._write_batch(self._take_batch(time.monotonic()))
+            drained = self._queue.empty()
+        else:
+            drained = False
+        pending = self.spool.pending() if self.spool is not None else self._queue.qsize()
+        if pending and self.spool is not None:
+            logger.warning("BigQuery: %d rows left in the spool %s; they will be sent on restart.", pending, self.spool.path)
+        elif pending:
+            logger.error("BigQuery: %d rows still pending at shutdown.", pending)
+        return drained and not pending
+
+    def replay_pending(self):
+        """Arranca el hilo de fondo si el spool tiene turnos de una ejecución anterior."""
+        if self.spool is not None and self.spool.pending():
+            self._ensure_worker()
+
+    def stats(self) -> Dict[str, Any]:
+        pending = self.spool.pending() if self.spool is not None else self._queue.qsize()
+        with self._lock:
+            return dict(self._stats, pending=pending)
+
+    # -- Hilo de fondo ------------------------------------------------------------
+    def _ensure_worker(self):
+        # Tras un fork (gunicorn --preload) el hilo del padre no existe en el hijo
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            target = self._run_spool if self.spool is not None else self._run
+            self._worker = threading.Thread(target=target, name="bigquery-writer", daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                first = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            # Al parar no se espera a completar el lote por tiempo
+            deadline = time.monotonic() if self._stop.is_set() else time.monotonic() + self.flush_seconds
+            self._write_batch([first] + self._take_batch(deadline, self.batch_size - 1))
+
+    def _run_spool(self):
+        # Al arrancar se reenvía lo que quedó en el spool (de este u otro proceso)
+        self._wake.set()
+        while True:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            if not self._stop.is_set() and self.spool.ready() < self.batch_size:
+                # Deja que se acumule un lote; el spool ya protege las filas
+                self._stop.wait(self.flush_seconds)
+            while True:
+                batch = self.spool.claim(self.batch_size)
+                if not batch:
+                    break
+                if not self._write_spooled(batch):
+                    break
+            if self._stop.is_set():
+                return
+
+    def _take_batch(self, deadline: float, limit: Optional[int] = None) -> List[tuple]:
+        limit = self.batch_size if limit is None else limit
+        batch = []
+        while len(batch) < limit:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    # -- Escritura ------------------------------------------------------------------
+    @timed("bq_insert", "bigquery")
+    def _insert(self, batch: List[Tuple[str, Dict[str, Any]]]) -> Tuple[List[int], List[int]]:
+        """Un intento de inserción. Devuelve (índices a reintentar, índices descartados)."""
+        if self._table_ref is None:
+            self._table_ref = self.client.dataset(BIGQUERY_DATASET_ID).table(BIGQUERY_TABLE_ID)
+        errors = self.client.insert_rows_json(
+            self._table_ref,
+            [row for _, row in batch],
+            row_ids=[insert_id for insert_id, _ in batch],
+        )
+        failed = {error["index"]: error.get("errors", []) for error in errors or []}
+        retry = [index for index, row_errors in failed.items() if _retryable(row_errors)]
+        invalid = [index for index in failed if index not in retry]
+        if invalid:
+            logger.error("BigQuery: dropping %d invalid rows: %s", len(invalid), errors)
+            self._count("dropped", len(invalid))
+        self._count("written", len(batch) - len(failed))
+        self._count("batches")
+        return retry, invalid
+
+    def _write_batch(self, batch: List[tuple]):
+        if not batch:
+            return
+        for attempt in range(self.retries):
+            try:
+                retry, _ = self._insert(batch)
+            except Exception as e:
+                logger.warning("BigQuery: batch insert of %d rows failed (attempt %d): %s", len(batch), attempt + 1, e)
+            else:
+                if not retry:
+                    return
+                batch = [batch[index] for index in retry]
+
+            if attempt + 1 < self.retries:
+                self._count("retries")
+                # Al parar no hay tiempo para esperas largas
+                delay = _backoff(attempt)
+                time.sleep(min(delay, 0.5) if self._stop.is_set() else delay)
+
+        logger.error("BigQuery: giving up on %d rows after %d attempts.", len(batch), self.retries)
+        self._count("dropped", len(batch))
+
+    def _write_spooled(self, batch: List[tuple]) -> bool:
+        """Envía un lote reclamado del spool. Devuelve False si BigQuery falló (hay que esperar)."""
+        seqs = [seq for seq, _, _ in batch]
+        try:
+            retry, _ = self._insert([(insert_id, row) for _, insert_id, row in batch])
+        except Exception as e:
+            self._failures += 1
+            delay = _backoff(self._failures - 1)
+            logger.warning("BigQuery: batch insert of %d spooled rows failed; retrying in %.1fs: %s", len(batch), delay, e)
+            self._count("retries")
+            self.spool.release(seqs, delay)
+            return False
+
+        self._failures = 0
+        retry_seqs = {seqs[index] for index in retry}
+        self.spool.ack([seq for seq in seqs if seq not in retry_seqs])
+        if retry_seqs:
+            self._count("retries")
+            self.spool.release(sorted(retry_seqs), _backoff(0))
+        return True
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._stats[name] += amount
+
+
+def _build_writer() -> BigQueryBatchWriter:
+    spool = None
+    if BIGQUERY_SPOOL_DIR:
+        from src.turn_spool import TurnSpool
+
+        spool = TurnSpool(BIGQUERY_SPOOL_DIR)
+        logger.info("BigQuery: spooling turns under %s.", BIGQUERY_SPOOL_DIR)
+    # Los turnos que quedaron sin enviar en una ejecución anterior no se reenvían aquí sino
+    # desde `start_worker()` (app.py): con gunicorn --preload este import ocurre en el master,
+    # y un hilo lanzado en él podría tener tomado un lock del writer o del spool al hacer fork
+    return BigQueryBatchWriter(spool=spool)
+
+
+bigquery_writer = _build_writer()
+atexit.register(bigquery_writer.flush)
+register_stats("bigquery_writer", bigquery_writer.stats)
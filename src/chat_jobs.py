@@ -0,0 +1,210 @@
+# src/chat_jobs.py
+import datetime
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP
+
+from src.config import logger
+from src.metrics import register_stats
+from src.timing import span
+
+# Turnos de chat en segundo plano ("jobs"). `POST /chat_auditor/jobs` responde enseguida
+# con un job_id y el run sigue en un pool de hilos del worker, así que la duración del
+# run ya no depende de la conexión HTTP ni del `--timeout 120` de gunicorn, y el worker
+# queda libre para otras peticiones mientras tanto. El cliente recoge el resultado con
+# `GET /jobs/<id>` (con `?wait=N` hace long-poll) o con `GET /jobs/<id>/events` (SSE).
+#
+# El estado de cada job vive en Firestore (`chat_jobs/{job_id}`, junto a
+# `audit_progress`): queued -> running -> done | failed. Cualquier worker o instancia
+# puede responder a la consulta. Los hilos que esperan a un job de su propio proceso se
+# despiertan sin volver a leer Firestore.
+#
+# Si el proceso muere con un job a medias, el documento se queda en queued/running. Pasado
+# su `deadline_at` (plazo del turno + margen) se devuelve como `failed` ("lost").
+
+CHAT_JOB_COLLECTION = os.getenv("CHAT_JOB_COLLECTION", "chat_jobs")
+CHAT_JOB_WORKERS = int(os.getenv("CHAT_JOB_WORKERS", "4"))
+# Plazo de un turno en segundo plano (ya no está atado al timeout de gunicorn)
+CHAT_JOB_DEADLINE_SECONDS = float(os.getenv("CHAT_JOB_DEADLINE_SECONDS", "600"))
+CHAT_JOB_TTL_SECONDS = float(os.getenv("CHAT_JOB_TTL_SECONDS", "604800"))
+# Las esperas de `?wait=N` y de /events ocupan un worker síncrono de gunicorn (hay 4) y
+# este no avisa al master mientras escribe la respuesta: pasado el `--timeout 120` lo
+# mata, y con él los jobs de su pool. Por eso ambas son cortas y es el cliente quien
+# vuelve a preguntar.
+# Máximo que una petición de long-poll espera antes de responder con el estado actual
+CHAT_JOB_MAX_WAIT_SECONDS = float(os.getenv("CHAT_JOB_MAX_WAIT_SECONDS", "5"))
+# Duración máxima de una conexión a /jobs/<id>/events; al cerrarse el cliente se reconecta
+CHAT_JOB_SSE_WINDOW_SECONDS = float(os.getenv("CHAT_JOB_SSE_WINDOW_SECONDS", "25"))
+CHAT_JOB_SSE_RETRY_MS = int(os.getenv("CHAT_JOB_SSE_RETRY_MS", "1000"))
+CHAT_JOB_POLL_SECONDS = float(os.getenv("CHAT_JOB_POLL_SECONDS", "1.0"))
+
+# Margen sobre el plazo del turno para persistir el resultado antes de darlo por perdido
+_LOST_MARGIN_SECONDS = 60.0
+
+TERMINAL_STATUSES = {"done", "failed"}
+
+
+class ChatJobError(Exception):
+    """Error de un job con el estado HTTP con el que se informa al cliente."""
+
+    def __init__(self, message: str, status: int = 500, **details):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.details = details
+
+
+def _iso(value: Any) -> Optional[str]:
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.astimezone(datetime.timezone.utc).isoformat()
+    return value
+
+
+def job_payload(job_id: str, doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Estado público de un job (sin uid)."""
+    payload = {
+        "job_id": job_id,
+        "status": doc.get("status"),
+        "thread_id": doc.get("thread_id"),
+        "endpoint": doc.get("endpoint"),
+        "created_at": _iso(doc.get("created_at")),
+        "started_at": _iso(doc.get("started_at")),
+        "finished_at": _iso(doc.get("finished_at")),
+    }
+    if doc.get("result") is not None:
+        payload["result"] = doc["result"]
+        payload["meta"] = doc.get("meta") or {}
+    if doc.get("error") is not None:
+        payload["error"] = doc["error"]
+    return payload
+
+
+class ChatJobs:
+    """Pool de turnos en segundo plano con su estado en Firestore."""
+
+    def __init__(self, workers: int = CHAT_JOB_WORKERS, deadline_seconds: float = CHAT_JOB_DEADLINE_SECONDS):
+        self.workers = workers
+        self.deadline_seconds = deadline_seconds
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_pid: Optional[int] = None
+        # job_id -> Event de los jobs que corren en este proceso
+        self._events: Dict[str, threading.Event] = {}
+        self._db = None
+        self._stats = {"submitted": 0, "running": 0, "done": 0, "failed": 0, "lost": 0}
+
+    # -- API pública --------------------------------------------------------------
+    def submit(self, uid: str, thread_id: str, endpoint: str, work: Callable[[], Tuple[Dict, Dict]]) -> str:
+        """Registra el job y lo lanza. `work` devuelve (data, meta) o lanza ChatJobError."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with span("fs_job", "firestore"):
+            self._ref(job_id).set(
+                {
+                    "uid": uid,
+                    "thread_id": thread_id,
+                    "endpoint": endpoint,
+                    "status": "queued",
+                    "created_at": SERVER_TIMESTAMP,
+                    "deadline_at": now + self.deadline_seconds + _LOST_MARGIN_SECONDS,
+                    "expires_at": datetime.datetime.fromtimestamp(now + CHAT_JOB_TTL_SECONDS, datetime.timezone.utc),
+                }
+            )
+        with self._lock:
+            self._events[job_id] = threading.Event()
+            self._stats["submitted"] += 1
+        self._pool().submit(self._run, job_id, work)
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Documento del job (None si no existe). Los jobs huérfanos vuelven como `failed`."""
+        with span("fs_job", "firestore"):
+            snap = self._ref(job_id).get()
+        if not snap.exists:
+            return None
+        doc = snap.to_dict() or {}
+        if doc.get("status") not in TERMINAL_STATUSES and float(doc.get("deadline_at") or 0) < time.time():
+            # Murió el proceso que lo ejecutaba
+            self._count("lost")
+            doc = dict(doc, status="failed", error={"message": "lost", "status": 500})
+        return doc
+
+    def wait(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Espera hasta `timeout` segundos a que el job termine. Devuelve el documento en ese momento."""
+        deadline = time.monotonic() + max(0.0, timeout)
+        while True:
+            doc = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if doc is None or doc.get("status") in TERMINAL_STATUSES or remaining <= 0:
+                return doc
+            with self._lock:
+                event = self._events.get(job_id)
+            if event is not None:
+                # Job de este proceso: se despierta al terminar, sin más lecturas
+                event.wait(remaining)
+            else:
+                time.sleep(min(CHAT_JOB_POLL_SECONDS, remaining))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, local_jobs=len(self._events))
+
+    # -- Internos -------------------------------------------------------------------
+    def _run(self, job_id: str, work: Callable[[], Tuple[Dict, Dict]]):
+        self._count("running")
+        try:
+            with span("fs_job", "firestore"):
+                self._ref(job_id).update({"status": "running", "started_at": SERVER_TIMESTAMP})
+            try:
+                data, meta = work()
+                update = {"status": "done", "result": data, "meta": meta}
+                self._count("done")
+            except ChatJobError as e:
+                update = {"status": "failed", "error": dict(e.details, message=e.message, status=e.status)}
+                self._count("failed")
+            except Exception as e:
+                logger.error(f"ChatJobs: error en el job {job_id}: {e}", exc_info=True)
+                update = {"status": "failed", "error": {"message": "Internal server error", "status": 500}}
+                self._count("failed")
+            update["finished_at"] = SERVER_TIMESTAMP
+            with span("fs_job", "firestore"):
+                self._ref(job_id).update(update)
+        except Exception as e:
+            # Sin poder escribir el estado, el job acabará como `lost` tras su deadline_at
+            logger.error(f"ChatJobs: no se pudo guardar el estado del job {job_id}: {e}", exc_info=True)
+        finally:
+            self._count("running", -1)
+            with self._lock:
+                event = self._events.pop(job_id, None)
+            if event is not None:
+                event.set()
+
+    def _pool(self) -> ThreadPoolExecutor:
+        # Tras un fork (gunicorn --preload) los hilos del pool del padre no existen en el hijo
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor_pid = os.getpid()
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="chat-job")
+            return self._executor
+
+    def _ref(self, job_id: str):
+        if self._db is None:
+            from firebase_admin import firestore
+
+            self._db = firestore.client()
+        return self._db.collection(CHAT_JOB_COLLECTION).document(job_id)
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._stats[name] += amount
+
+
+chat_jobs = ChatJobs()
+register_stats("chat_jobs", chat_jobs.stats)
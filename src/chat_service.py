@@ -0,0 +1,199 @@
+# src/chat_service.py
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from src.config import logger
+from src.openai_service import process_assistant_message_without_citations
+from src.run_poller import (
+    async_create_and_wait,
+    async_submit_tool_outputs_and_wait,
+    create_and_wait,
+    new_polling_metrics,
+    submit_tool_outputs_and_wait,
+    RunPollTimeout,
+)
+from src.timing import span
+from src.tool_executor import TOOL_CALL_TIMEOUT_SECONDS, arun_tool_calls, run_tool_calls
+
+# Un turno de chat = añadir el mensaje del usuario, ejecutar el run (sirviendo todas
+# las rondas de herramientas que pida) y extraer la respuesta. Se comparte entre el
+# servidor Flask (síncrono) y el modo ASGI (asyncio), de ahí las dos variantes.
+#
+# `turn` es un dict que el llamante pasa vacío y que aquí se rellena con el run en
+# curso (para que los handlers puedan persistir el run_id aunque el turno falle), con
+# las métricas de polling del turno en `turn["polling"]` y con los tiempos de cada
+# tool call en `turn["tools"]`. Las etapas (mensaje, run, herramientas, lectura de la
+# respuesta) se miden con `span` para la cabecera Server-Timing (src/timing.py).
+
+# Presupuesto total del turno (polling + herramientas). Debe quedar por debajo del
+# `--timeout 120` de gunicorn para que el handler responda antes de que maten al worker.
+TURN_DEADLINE_SECONDS = float(os.getenv("TURN_DEADLINE_SECONDS", "100"))
+# Límite de rondas `requires_action` por turno (evita bucles del orquestador)
+MAX_TOOL_ROUNDS = int(os.getenv("MAX_TOOL_ROUNDS", "8"))
+
+
+class TurnBudget:
+    """Plazo único de un turno, compartido entre las esperas de runs y las herramientas."""
+
+    def __init__(self, seconds: float = TURN_DEADLINE_SECONDS):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def tool_timeout(self) -> float:
+        return min(TOOL_CALL_TIMEOUT_SECONDS, self.remaining())
+
+
+def _run_error(run) -> Exception:
+    return Exception(f"Run ended with status={run.status}. Details: {getattr(run, 'last_error', None)}")
+
+
+def _too_many_rounds(run) -> Exception:
+    return Exception(f"Run {run.id} superó el máximo de {MAX_TOOL_ROUNDS} rondas de herramientas.")
+
+
+def _cancel_pending_run(openai_client, run, thread_id: str):
+    """Un run que se queda en `requires_action` bloquea el hilo hasta que expira: se cancela."""
+    try:
+        openai_client.beta.threads.runs.cancel(run_id=run.id, thread_id=thread_id)
+    except Exception as cancel_err:
+        logger.warning(f"No se pudo cancelar el run {run.id}: {cancel_err}")
+
+
+async def _acancel_pending_run(openai_client, run, thread_id: str):
+    try:
+        await openai_client.beta.threads.runs.cancel(run_id=run.id, thread_id=thread_id)
+    except Exception as cancel_err:
+        logger.warning(f"No se pudo cancelar el run {run.id}: {cancel_err}")
+
+
+def run_assistant_turn(
+    openai_client,
+    thread_id: str,
+    user_message: str,
+    assistant_id: str,
+    endpoint_name: str,
+    tool_handler: Optional[Callable[[Any, str, float], Optional[Dict[str, str]]]] = None,
+    turn: Optional[Dict[str, Any]] = None,
+    budget: Optional[TurnBudget] = None,
+) -> str:
+    """Ejecuta un turno completo de forma bloqueante y devuelve el texto de la respuesta."""
+    turn = turn if turn is not None else {}
+    budget = budget or TurnBudget()
+    polling = turn.setdefault("polling", new_polling_metrics())
+    turn.setdefault("tools", [])
+
+    with span("message_create", "openai"):
+        openai_client.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=user_message,
+        )
+
+    try:
+        with span("run", "openai"):
+            run = create_and_wait(openai_client, thread_id, assistant_id, budget.remaining(), polling)
+        turn["run"] = run
+
+        # Sirve herramientas (en paralelo) hasta que el run deje de pedirlas
+        rounds = 0
+        while run.status == "requires_action" and tool_handler is not None:
+            rounds += 1
+            if rounds > MAX_TOOL_ROUNDS:
+                break
+            with span("tools"):
+                tool_outputs, timings = run_tool_calls(
+                    run.required_action.submit_tool_outputs.tool_calls,
+                    thread_id,
+                    tool_handler,
+                    timeout=budget.tool_timeout(),
+                )
+            turn["tools"].extend(dict(timing, round=rounds) for timing in timings)
+            if not tool_outputs:
+                break
+            with span("run", "openai"):
+                run = submit_tool_outputs_and_wait(
+                    openai_client, run, thread_id, tool_outputs, budget.remaining(), polling
+                )
+            turn["run"] = run
+    except RunPollTimeout as exc:
+        turn["run"] = exc.run
+        raise
+
+    if run.status == "requires_action":
+        _cancel_pending_run(openai_client, run, thread_id)
+        raise _too_many_rounds(run) if rounds > MAX_TOOL_ROUNDS else _run_error(run)
+    if run.status != "completed":
+        raise _run_error(run)
+    logger.info(f"{endpoint_name}: run {run.id} rounds={rounds} polling={polling}")
+
+    with span("message_list", "openai"):
+        messages = openai_client.beta.threads.messages.list(thread_id=thread_id, run_id=run.id, order="desc")
+    return process_assistant_message_without_citations(messages.data, run.id, endpoint_name)
+
+
+async def arun_assistant_turn(
+    openai_client,
+    thread_id: str,
+    user_message: str,
+    assistant_id: str,
+    endpoint_name: str,
+    tool_handler: Optional[Callable[[Any, str, float], Awaitable[Optional[Dict[str, str]]]]] = None,
+    turn: Optional[Dict[str, Any]] = None,
+    budget: Optional[TurnBudget] = None,
+) -> str:
+    """Variante asyncio de `run_assistant_turn` para `openai.AsyncOpenAI`."""
+    turn = turn if turn is not None else {}
+    budget = budget or TurnBudget()
+    polling = turn.setdefault("polling", new_polling_metrics())
+    turn.setdefault("tools", [])
+
+    with span("message_create", "openai"):
+        await openai_client.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=user_message,
+        )
+
+    try:
+        with span("run", "openai"):
+            run = await async_create_and_wait(openai_client, thread_id, assistant_id, budget.remaining(), polling)
+        turn["run"] = run
+
+        rounds = 0
+        while run.status == "requires_action" and tool_handler is not None:
+            rounds += 1
+            if rounds > MAX_TOOL_ROUNDS:
+                break
+            with span("tools"):
+                tool_outputs, timings = await arun_tool_calls(
+                    run.required_action.submit_tool_outputs.tool_calls,
+                    thread_id,
+                    tool_handler,
+                    timeout=budget.tool_timeout(),
+                )
+            turn["tools"].extend(dict(timing, round=rounds) for timing in timings)
+            if not tool_outputs:
+                break
+            with span("run", "openai"):
+                run = await async_submit_tool_outputs_and_wait(
+                    openai_client, run, thread_id, tool_outputs, budget.remaining(), polling
+                )
+            turn["run"] = run
+    except RunPollTimeout as exc:
+        turn["run"] = exc.run
+        raise
+
+    if run.status == "requires_action":
+        await _acancel_pending_run(openai_client, run, thread_id)
+        raise _too_many_rounds(run) if rounds > MAX_TOOL_ROUNDS else _run_error(run)
+    if run.status != "completed":
+        raise _run_error(run)
+    logger.info(f"{endpoint_name}: run {run.id} rounds={rounds} polling={polling}")
+
+    with span("message_list", "openai"):
+        messages = await openai_client.beta.threads.messages.list(thread_id=thread_id, run_id=run.id, order="desc")
+    return process_assistant_message_without_citations(messages.data, run.id, endpoint_name)
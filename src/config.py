@@ -1,16 +1,12 @@
 # config.py
 import os
 import logging
-import openai
+import threading
+import time
 from flask import Flask
-from flask_cors import CORS
-from google.cloud import bigquery
-from packaging import version
-from httpx import Timeout
 
-# --- 1. Inicialización de Flask y CORS ---
+# --- 1. Inicialización de Flask (CORS se configura en app.py) ---
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True, methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"], allow_headers=["Content-Type", "Authorization", "X-Requested-With"])
 
 # --- 2. Configuración Centralizada de Logging ---
 logger = logging.getLogger(__name__)
@@ -51,20 +47,220 @@ if not all([BIGQUERY_DATASET_ID, BIGQUERY_TABLE_ID]):
 
 logger.info("All environment variables loaded successfully.")
 
-# --- 4. Inicialización de Clientes Externos ---
-try:
-    # Cliente de OpenAI
-    client = openai.OpenAI(
+# --- 4. Clientes Externos (perezosos) ---
+# Construir los clientes (credenciales, metadata server, canales gRPC) al importar retrasaba
+# el arranque de cada worker y la primera respuesta de /health. Cada cliente se crea en su
+# primer uso, una vez por proceso; `warm_clients()` los crea a la vez en segundo plano nada
+# más arrancar el worker para que la primera petición tampoco lo pague.
+#
+# Fork safety (gunicorn --preload): un cliente creado en el master no se reutiliza en los
+# workers (sus canales gRPC no sobreviven al fork); tras el fork cada proceso crea el suyo.
+class LazyClient:
+    """Cliente que se construye en el primer uso. Se usa igual que el cliente real."""
+
+    def __init__(self, name: str, factory, warmup=None):
+        self._name = name
+        self._factory = factory
+        # Opcional: qué hacer con el cliente recién creado en `warm_clients` (p. ej. abrir conexiones)
+        self._warmup = warmup
+        self._instance = None
+        self._pid = None
+        self._lock = threading.Lock()
+        _lazy_clients.append(self)
+
+    def get(self):
+        instance = self._instance
+        if instance is not None and self._pid == os.getpid():
+            return instance
+        with self._lock:
+            if self._instance is None or self._pid != os.getpid():
+                started = time.perf_counter()
+                try:
+                    self._instance = self._factory()
+                except Exception as e:
+                    logger.critical(f"Failed to initialize {self._name} client: {e}", exc_info=True)
+                    raise
+                self._pid = os.getpid()
+                logger.info(f"{self._name} client initialized in {(time.perf_counter() - started) * 1000:.0f} ms.")
+            return self._instance
+
+    def _reset_after_fork(self):
+        # Si el fork llegó a mitad de un `get` el lock heredado estaría tomado para siempre
+        self._lock = threading.Lock()
+        self._instance = None
+        self._pid = None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __repr__(self):
+        return f"<LazyClient {self._name}>"
+
+
+_lazy_clients = []
+
+
+def _reset_clients_after_fork():
+    for lazy in _lazy_clients:
+        lazy._reset_after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_clients_after_fork)
+
+
+def warm_clients(*clients: LazyClient):
+    """Crea en paralelo, en hilos de fondo, los clientes indicados que aún no existen en este proceso."""
+    for lazy in clients:
+        threading.Thread(target=_warm, args=(lazy,), name=f"warm-{lazy._name}", daemon=True).start()
+
+
+def _warm(lazy: LazyClient):
+    try:
+        instance = lazy.get()
+    except Exception:
+        # Ya registrado en `get`; el primer uso real lo volverá a intentar
+        return
+    if lazy._warmup is not None:
+        try:
+            lazy._warmup(instance)
+        except Exception as e:
+            logger.warning(f"{lazy._name} client warm-up failed: {e}")
+
+
+# --- 5. Transporte HTTP de OpenAI ---
+# Un pool httpx por cliente (y por proceso), compartido por todas las llamadas: las copias
+# de `with_options` reutilizan el mismo pool. Los límites acotan las conexiones abiertas
+# con la API; con más peticiones a la vez que OPENAI_MAX_CONNECTIONS, esperan turno en el
+# pool. OPENAI_KEEPALIVE_EXPIRY mantiene abiertas las conexiones ociosas entre turnos del
+# mismo usuario (el valor por defecto de httpx, 5 s, obligaba a repetir TCP + TLS en cada
+# turno). OPENAI_HTTP2=1 multiplexa las peticiones en una conexión (requiere `h2`).
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "50"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "30"))
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "0") == "1"
+# Conexiones que `warm_clients` abre con la API al arrancar el worker (0 = ninguna)
+OPENAI_PREWARM_CONNECTIONS = int(os.getenv("OPENAI_PREWARM_CONNECTIONS", "2"))
+# Timeout de las llamadas de los endpoints de chat (antes `with_options(timeout=60.0)` en cada petición)
+OPENAI_CHAT_TIMEOUT_SECONDS = float(os.getenv("OPENAI_CHAT_TIMEOUT_SECONDS", "60"))
+
+
+def openai_transport_options() -> dict:
+    """Argumentos del pool httpx de los clientes de OpenAI (`DefaultHttpxClient(**...)`)."""
+    import httpx
+
+    http2 = OPENAI_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("OPENAI_HTTP2=1 but the h2 package is missing (pip install 'httpx[http2]'); using HTTP/1.1.")
+            http2 = False
+    return {
+        "limits": httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        "http2": http2,
+    }
+
+
+# Los SDK (openai ~0,5 s, google.cloud.bigquery ~0,2 s de import) se importan dentro de
+# las fábricas: solo los carga el proceso que llega a usar el cliente (o `warm_clients`).
+def _openai_client():
+    import openai
+    from httpx import Timeout
+
+    return openai.OpenAI(
         api_key=OPENAI_API_KEY,
         timeout=Timeout(60.0, read=60.0, write=60.0, connect=10.0),
         max_retries=3,
+        http_client=openai.DefaultHttpxClient(**openai_transport_options()),
     )
-    logger.info("OpenAI client initialized.")
 
-    # Cliente de BigQuery
-    bq_client = bigquery.Client()
-    logger.info("BigQuery client initialized.")
 
-except Exception as e:
-    logger.critical(f"Failed to initialize external clients: {e}", exc_info=True)
-    raise
+def _async_openai_client():
+    import openai
+    from httpx import Timeout
+
+    return openai.AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        timeout=Timeout(60.0, read=60.0, write=60.0, connect=10.0),
+        max_retries=3,
+        http_client=openai.DefaultAsyncHttpxClient(**openai_transport_options()),
+    )
+
+
+def _prewarm_connections() -> int:
+    # Con HTTP/2 todas las peticiones comparten una conexión
+    return min(OPENAI_PREWARM_CONNECTIONS, 1) if OPENAI_HTTP2 else OPENAI_PREWARM_CONNECTIONS
+
+
+def prewarm_openai(openai_client):
+    """
+    Abre conexiones (TCP + TLS) con la API y las deja en el pool para que la primera
+    petición no pague el handshake. Usa GET /models: no consume tokens.
+    """
+    count = _prewarm_connections()
+    if count <= 0:
+        return
+    probe = openai_client.with_options(max_retries=0, timeout=10.0)
+    started = time.perf_counter()
+    errors = []
+
+    def open_connection():
+        try:
+            probe.models.list()
+        except Exception as e:
+            errors.append(e)
+
+    # Peticiones simultáneas: con HTTP/1.1 cada una abre su propia conexión
+    threads = [threading.Thread(target=open_connection, daemon=True) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    logger.info(f"OpenAI: {count} connection(s) pre-warmed in {(time.perf_counter() - started) * 1000:.0f} ms.")
+
+
+async def aprewarm_openai(openai_client):
+    """`prewarm_openai` para el cliente asyncio (debe ejecutarse en el event loop que lo usa)."""
+    import asyncio
+
+    count = _prewarm_connections()
+    if count <= 0:
+        return
+    started = time.perf_counter()
+    try:
+        probe = openai_client.with_options(max_retries=0, timeout=10.0)
+        await asyncio.gather(*(probe.models.list() for _ in range(count)))
+    except Exception as e:
+        logger.warning(f"OpenAI async client warm-up failed: {e}")
+        return
+    logger.info(f"OpenAI async: {count} connection(s) pre-warmed in {(time.perf_counter() - started) * 1000:.0f} ms.")
+
+
+def _bigquery_client():
+    from google.cloud import bigquery
+
+    return bigquery.Client()
+
+
+# Cliente de OpenAI
+client = LazyClient("OpenAI", _openai_client, warmup=prewarm_openai)
+
+# Cliente asyncio de OpenAI (modo de servicio ASGI, ver asgi.py). Sus conexiones se abren
+# desde el event loop del worker (`aprewarm_openai` en el lifespan de asgi.py).
+async_client = LazyClient("OpenAI async", _async_openai_client)
+
+# Copias con el timeout de los endpoints de chat. `with_options` construye un cliente nuevo
+# (que comparte el pool): se hace una vez por proceso en lugar de en cada petición.
+chat_client = LazyClient("OpenAI chat", lambda: client.get().with_options(timeout=OPENAI_CHAT_TIMEOUT_SECONDS))
+async_chat_client = LazyClient(
+    "OpenAI async chat", lambda: async_client.get().with_options(timeout=OPENAI_CHAT_TIMEOUT_SECONDS)
+)
+
+# Cliente de BigQuery (no se importa ni se crea con DISABLE_BIGQUERY=1)
+bq_client = LazyClient("BigQuery", _bigquery_client)
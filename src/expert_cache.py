@@ -0,0 +1,236 @@
+# src/expert_cache.py
+import datetime
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from src.config import client, logger, ASISTENTE_ID
+from src.metrics import register_stats
+from src.timing import span
+
+# Caché de respuestas de `invoke_sustainability_expert`. Usuarios de empresas distintas
+# hacen al orquestador las mismas preguntas normativas, y cada una cuesta un run RAG
+# completo. Dos niveles:
+#   1) LRU en memoria por proceso (sin latencia de red),
+#   2) colección de Firestore compartida entre workers e instancias.
+# La clave incluye una huella de la configuración del assistant y de sus vector stores:
+# si cambian las instrucciones, el modelo o los ficheros indexados, la clave cambia y
+# las respuestas antiguas dejan de servirse sin tener que borrarlas.
+
+EXPERT_CACHE_ENABLED = os.getenv("EXPERT_CACHE_ENABLED", "1") == "1"
+EXPERT_CACHE_SHARED = os.getenv("EXPERT_CACHE_SHARED", "firestore")  # "firestore" | "none"
+EXPERT_CACHE_TTL_SECONDS = int(os.getenv("EXPERT_CACHE_TTL_SECONDS", str(24 * 3600)))
+EXPERT_CACHE_MAX_ENTRIES = int(os.getenv("EXPERT_CACHE_MAX_ENTRIES", "512"))
+# Cada cuánto se recalcula la huella del assistant (una llamada a OpenAI por vector store).
+# El cálculo va en un hilo de fondo: las consultas siguen usando la huella anterior y la
+# llamada a la herramienta no espera a OpenAI ni gasta su plazo.
+EXPERT_CACHE_FINGERPRINT_TTL_SECONDS = int(os.getenv("EXPERT_CACHE_FINGERPRINT_TTL_SECONDS", "300"))
+_FINGERPRINT_TIMEOUT_SECONDS = 15.0
+EXPERT_CACHE_COLLECTION = os.getenv("EXPERT_CACHE_COLLECTION", "expert_cache")
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]", re.UNICODE)
+
+
+def normalize_query(query: str) -> str:
+    """Normaliza una consulta: sin tildes, minúsculas, sin puntuación y espacios colapsados."""
+    text = unicodedata.normalize("NFKD", query or "")
+    text = "".join(ch for ch in text if not unicodedata.combining(ch)).casefold()
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return " ".join(text.split())
+
+
+def _assistant_fingerprint(assistant_id: str) -> str:
+    """Huella de la configuración del assistant y del estado de sus vector stores."""
+    openai_client = client.with_options(timeout=_FINGERPRINT_TIMEOUT_SECONDS, max_retries=1)
+    assistant = openai_client.beta.assistants.retrieve(assistant_id)
+    parts: Dict[str, Any] = {
+        "model": assistant.model,
+        "instructions": assistant.instructions,
+        "tools": sorted(tool.type for tool in assistant.tools or []),
+        "vector_stores": {},
+    }
+    file_search = getattr(assistant.tool_resources, "file_search", None) if assistant.tool_resources else None
+    for vs_id in sorted(getattr(file_search, "vector_store_ids", None) or []):
+        vector_store = openai_client.vector_stores.retrieve(vs_id)
+        counts = vector_store.file_counts
+        parts["vector_stores"][vs_id] = [counts.completed, counts.total, vector_store.usage_bytes]
+    raw = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+class ExpertCache:
+    """Caché de dos niveles (LRU en memoria + Firestore) para respuestas del experto."""
+
+    def __init__(self, assistant_id: str, max_entries: int, ttl_seconds: int, shared: str):
+        self.assistant_id = assistant_id
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._fingerprint: Optional[str] = None
+        self._fingerprint_at = 0.0
+        self._refreshing = False
+        self._collection = None
+        self._stats = {"hits_memory": 0, "hits_shared": 0, "misses": 0, "stores": 0, "errors": 0}
+
+    # -- Clave ------------------------------------------------------------------
+    def fingerprint(self) -> Optional[str]:
+        """
+        Huella vigente del assistant; None mientras no se haya podido calcular (la caché se
+        omite). Si está caducada se recalcula en segundo plano y se devuelve la anterior.
+        """
+        with self._lock:
+            stale = self._fingerprint is None or time.monotonic() - self._fingerprint_at > EXPERT_CACHE_FINGERPRINT_TTL_SECONDS
+            if stale and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(target=self._refresh_fingerprint, name="expert-cache-fingerprint", daemon=True).start()
+            return self._fingerprint
+
+    def _refresh_fingerprint(self):
+        fingerprint = None
+        try:
+            with span("expert_fingerprint", "openai"):
+                fingerprint = _assistant_fingerprint(self.assistant_id)
+        except Exception as e:
+            logger.warning(f"ExpertCache: no se pudo calcular la huella del assistant: {e}")
+            self._count("errors")
+        changed = False
+        with self._lock:
+            if fingerprint is not None:
+                changed = self._fingerprint is not None and fingerprint != self._fingerprint
+                self._fingerprint = fingerprint
+            # Incluso si falla, no se reintenta en cada consulta
+            self._fingerprint_at = time.monotonic()
+            self._refreshing = False
+        if changed:
+            logger.info(f"ExpertCache: el assistant {self.assistant_id} ha cambiado; se invalida la caché.")
+            self.clear_local()
+
+    def _key(self, query: str) -> Optional[str]:
+        normalized = normalize_query(query)
+        fingerprint = self.fingerprint()
+        if not normalized or not fingerprint:
+            return None
+        raw = f"{self.assistant_id}|{fingerprint}|{normalized}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    # -- Nivel compartido ---------------------------------------------------------
+    def _shared_collection(self):
+        if self.shared != "firestore":
+            return None
+        if self._collection is None:
+            from firebase_admin import firestore
+
+            self._collection = firestore.client().collection(EXPERT_CACHE_COLLECTION)
+        return self._collection
+
+    def _shared_get(self, key: str) -> Optional[str]:
+        collection = self._shared_collection()
+        if collection is None:
+            return None
+        with span("fs_expert_cache", "firestore"):
+            snap = collection.document(key).get()
+        if not snap.exists:
+            return None
+        data = snap.to_dict() or {}
+        expires_at = data.get("expires_at")
+        if expires_at and expires_at <= datetime.datetime.now(datetime.timezone.utc):
+            return None
+        return data.get("answer")
+
+    def _shared_put(self, key: str, query: str, answer: str):
+        collection = self._shared_collection()
+        if collection is None:
+            return
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with span("fs_expert_cache", "firestore"):
+            collection.document(key).set(
+                {
+                    "assistant_id": self.assistant_id,
+                    "fingerprint": self._fingerprint,
+                    "query": normalize_query(query),
+                    "answer": answer,
+                    "created_at": now,
+                    # Campo pensado para la política TTL de Firestore
+                    "expires_at": now + datetime.timedelta(seconds=self.ttl_seconds),
+                }
+            )
+
+    # -- API pública --------------------------------------------------------------
+    def get(self, query: str) -> Optional[str]:
+        key = self._key(query)
+        if key is None:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self._stats["hits_memory"] += 1
+                return entry[0]
+            if entry:
+                del self._entries[key]
+
+        try:
+            answer = self._shared_get(key)
+        except Exception as e:
+            logger.warning(f"ExpertCache: fallo leyendo la caché compartida: {e}")
+            self._count("errors")
+            answer = None
+
+        if answer is None:
+            self._count("misses")
+            return None
+        self._remember(key, answer)
+        self._count("hits_shared")
+        return answer
+
+    def put(self, query: str, answer: str):
+        key = self._key(query)
+        if key is None or not answer:
+            return
+        self._remember(key, answer)
+        self._count("stores")
+        try:
+            self._shared_put(key, query, answer)
+        except Exception as e:
+            logger.warning(f"ExpertCache: fallo escribiendo la caché compartida: {e}")
+            self._count("errors")
+
+    def clear_local(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._entries))
+        lookups = stats["hits_memory"] + stats["hits_shared"] + stats["misses"]
+        stats["hit_ratio"] = round((stats["hits_memory"] + stats["hits_shared"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+    def _remember(self, key: str, answer: str):
+        with self._lock:
+            self._entries[key] = (answer, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+
+expert_cache = ExpertCache(
+    ASISTENTE_ID,
+    max_entries=EXPERT_CACHE_MAX_ENTRIES,
+    ttl_seconds=EXPERT_CACHE_TTL_SECONDS,
+    shared=EXPERT_CACHE_SHARED,
+)
+register_stats("expert_cache", expert_cache.stats)
@@ -0,0 +1,294 @@
+# src/history_store.py
+import datetime
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional
+
+from src.bigquery_service import TurnCursor, turn_messages, user_has_other_threads
+from src.config import logger
+from src.timing import timed
+
+# Almacén "caliente" del historial de chat en Firestore, actualizado en cada turno, para
+# que /chat_history no lance un job de BigQuery por cada carga de la barra lateral.
+# BigQuery sigue siendo la fuente para analítica y para el backfill
+# (scripts/backfill_history_store.py).
+#
+#   threads/{thread_id}                     resumen del hilo (el mismo documento que
+#                                           registra la propiedad del hilo): uid,
+#                                           endpoint_source, summary, last_timestamp,
+#                                           turn_count, history_complete
+#   threads/{thread_id}/turns/{turn_id}     cada turno (pregunta + respuesta)
+#   users/{uid}/recent_threads/{thread_id}  índice de hilos recientes del usuario
+#
+# `turn_id` es el run_id (o un hash estable del turno si no hay run), así que el backfill
+# y las escrituras en vivo no duplican turnos.
+#
+# Un hilo anterior al almacén que recibe un turno nuevo tiene resumen pero solo los turnos
+# posteriores. Por eso el detalle de un hilo solo se sirve desde aquí si su documento tiene
+# `history_complete`. Lo fijan el backfill, que copia el hilo entero, y el registro de los
+# hilos que crea el propio servicio (src/thread_ownership.py), que tienen aquí todos sus
+# turnos desde el primero. El resto se lee de BigQuery. A un hilo así tampoco se le fija
+# aquí el resumen, que sería el turno nuevo y no su primer mensaje.
+#
+# Lo mismo con los recientes: un usuario con hilos anteriores al almacén tiene en su
+# índice solo los hilos nuevos. El índice se usa solo si `users/{uid}` tiene
+# `history_complete`: lo fija a true el backfill completo del usuario, y el registro de su
+# primer hilo en el servicio, a true o false según tenga o no hilos en BigQuery.
+
+HISTORY_STORE = os.getenv("HISTORY_STORE", "firestore")  # "firestore" | "bigquery"
+THREADS_COLLECTION = "threads"
+USERS_COLLECTION = "users"
+HISTORY_COMPLETE_FIELD = "history_complete"
+
+_SUMMARY_MAX_CHARS = 160
+
+# Un único hilo conserva el orden de las escrituras de cada proceso
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-store")
+
+
+def summarize(text: Optional[str]) -> str:
+    """Resumen de un hilo a partir de su primer mensaje (mismo criterio que la consulta de BigQuery)."""
+    return " ".join((text or "").split())[:_SUMMARY_MAX_CHARS] or "Conversacion previa"
+
+
+def turn_id_for(thread_id: str, run_id: Optional[str], timestamp: Any, user_message: Optional[str]) -> str:
+    if run_id:
+        return run_id
+    # El timestamp llega como texto ISO (escritura en vivo) o como datetime (BigQuery)
+    raw = f"{thread_id}|{_iso(timestamp)}|{user_message or ''}"
+    return "turn_" + hashlib.sha1(raw.encode("utf-8")).hexdigest()[:24]
+
+
+def _as_datetime(value: Any) -> datetime.datetime:
+    if isinstance(value, datetime.datetime):
+        return value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+    parsed = datetime.datetime.fromisoformat(str(value))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=datetime.timezone.utc)
+
+
+def _iso(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    return _as_datetime(value).astimezone(datetime.timezone.utc).isoformat()
+
+
+class HistoryStore:
+    """Lecturas y escrituras del historial en Firestore."""
+
+    def __init__(self):
+        self._db = None
+
+    def db(self):
+        if self._db is None:
+            from firebase_admin import firestore
+
+            self._db = firestore.client()
+        return self._db
+
+    # -- Escritura ------------------------------------------------------------------
+    def record_turn(self, row: Dict[str, Any]):
+        """Programa la escritura de un turno (fila con el formato de BigQuery). No bloquea."""
+        if not row.get("uid") or not row.get("thread_id"):
+            return
+        _writer.submit(self._record_turn_safe, dict(row))
+
+    def _record_turn_safe(self, row: Dict[str, Any]):
+        try:
+            self.write_turn(row)
+        except Exception as e:
+            logger.error(f"HistoryStore: no se pudo guardar el turno del hilo {row.get('thread_id')}: {e}", exc_info=True)
+
+    def thread_ref(self, thread_id: str):
+        return self.db().collection(THREADS_COLLECTION).document(thread_id)
+
+    def user_ref(self, uid: str):
+        return self.db().collection(USERS_COLLECTION).document(uid)
+
+    def recent_ref(self, uid: str, thread_id: str):
+        return self.user_ref(uid).collection("recent_threads").document(thread_id)
+
+    def turn_document(self, row: Dict[str, Any]):
+        """(referencia, datos) del documento de un turno."""
+        thread_id = row["thread_id"]
+        turn_id = turn_id_for(thread_id, row.get("run_id"), row["timestamp"], row.get("user_message"))
+        data = {
+            "timestamp": _as_datetime(row["timestamp"]),
+            "user_message": row.get("user_message"),
+            "assistant_response": row.get("assistant_response"),
+            "endpoint_source": row.get("endpoint_source"),
+            "run_id": row.get("run_id"),
+            "assistant_name": row.get("assistant_name"),
+        }
+        return self.thread_ref(thread_id).collection("turns").document(turn_id), data
+
+    def set_thread_summary(
+        self, batch, uid: str, thread_id: str, last_row: Dict[str, Any], summary: Optional[str], turn_count,
+        complete: bool = False,
+    ):
+        """
+        Añade al batch el resumen del hilo y su entrada en el índice del usuario. `complete`
+        marca que el almacén tiene todos los turnos del hilo (solo el backfill lo sabe).
+        """
+        thread_summary = {
+            "uid": uid,
+            "endpoint_source": last_row.get("endpoint_source"),
+            "last_timestamp": _as_datetime(last_row["timestamp"]),
+        }
+        if summary is not None:
+            thread_summary["summary"] = summary
+        thread_data = dict(thread_summary, turn_count=turn_count)
+        if complete:
+            thread_data[HISTORY_COMPLETE_FIELD] = True
+        batch.set(self.thread_ref(thread_id), thread_data, merge=True)
+        batch.set(self.recent_ref(uid, thread_id), dict(thread_summary, thread_id=thread_id), merge=True)
+
+    @timed("fs_history_write", "firestore")
+    def write_turn(self, row: Dict[str, Any]):
+        """Guarda un turno y actualiza el resumen del hilo y el índice del usuario en un solo commit."""
+        from google.cloud.firestore_v1 import Increment
+
+        thread_id, uid = row["thread_id"], row["uid"]
+        # El resumen es el primer mensaje del hilo: solo se fija si aún no existe y el hilo
+        # es nuevo (en un hilo anterior al almacén, este turno no es el primero)
+        snap = self.thread_ref(thread_id).get()
+        data = (snap.to_dict() or {}) if snap.exists else {}
+        summary = None
+        if not data.get("summary") and (not snap.exists or data.get(HISTORY_COMPLETE_FIELD)):
+            summary = summarize(row.get("user_message") or row.get("assistant_response"))
+
+        batch = self.db().batch()
+        batch.set(*self.turn_document(row))
+        self.set_thread_summary(batch, uid, thread_id, row, summary, Increment(1))
+        batch.commit()
+
+    def mark_user_coverage(self, uid: str, new_thread_id: str):
+        """
+        Primer hilo del usuario registrado por el servicio: fija `history_complete` en
+        `users/{uid}` según tenga o no hilos anteriores en BigQuery. No pisa el valor que
+        ya tenga (p. ej. el del backfill).
+        """
+        from firebase_admin import firestore
+
+        ref = self.user_ref(uid)
+        snap = ref.get()
+        if snap.exists and HISTORY_COMPLETE_FIELD in (snap.to_dict() or {}):
+            return
+        complete = not user_has_other_threads(uid, new_thread_id)
+
+        @firestore.transactional
+        def mark(transaction):
+            current = ref.get(transaction=transaction)
+            if current.exists and HISTORY_COMPLETE_FIELD in (current.to_dict() or {}):
+                return
+            transaction.set(ref, {HISTORY_COMPLETE_FIELD: complete}, merge=True)
+
+        mark(self.db().transaction())
+
+    # -- Lectura --------------------------------------------------------------------
+    @timed("history_read", "firestore")
+    def recent_threads(self, uid: str, limit: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        Hilos recientes del usuario según su índice; None si el índice no tiene todos sus
+        hilos (`users/{uid}` sin `history_complete`) o está vacío: se consulta BigQuery.
+        """
+        from google.cloud.firestore_v1 import Query
+
+        user = self.user_ref(uid).get()
+        if not (user.exists and (user.to_dict() or {}).get(HISTORY_COMPLETE_FIELD)):
+            return None
+        docs = (
+            self.user_ref(uid)
+            .collection("recent_threads")
+            .order_by("last_timestamp", direction=Query.DESCENDING)
+            .limit(limit)
+            .stream()
+        )
+        conversations: List[Dict[str, Any]] = []
+        for doc in docs:
+            data = doc.to_dict() or {}
+            conversations.append({
+                "thread_id": data.get("thread_id") or doc.id,
+                "endpoint_source": data.get("endpoint_source"),
+                "last_timestamp": _iso(data.get("last_timestamp")),
+                "summary": data.get("summary") or "Conversacion previa",
+            })
+        return conversations or None
+
+    @timed("history_read", "firestore")
+    def thread_summary(self, uid: str, thread_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Resumen de un hilo del usuario; None si el almacén no tiene todos sus turnos (hilo
+        anterior al almacén sin backfill, aunque haya recibido turnos nuevos).
+        """
+        snap = self.thread_ref(thread_id).get()
+        data = (snap.to_dict() or {}) if snap.exists else {}
+        if not data.get("last_timestamp") or data.get("uid") != uid or not data.get(HISTORY_COMPLETE_FIELD):
+            return None
+        return data
+
+    def iter_turns(
+        self,
+        thread_id: str,
+        before: Optional[TurnCursor] = None,
+        after: Optional[TurnCursor] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """Turnos en orden cronológico; misma semántica de cursores que `iter_conversation_turns`."""
+        from google.cloud.firestore_v1 import Query
+
+        newest_first = limit is not None and after is None
+        direction = Query.DESCENDING if newest_first else Query.ASCENDING
+        # El id del documento (turn_id = run_id) desempata los turnos con el mismo timestamp
+        query = (
+            self.thread_ref(thread_id).collection("turns")
+            .order_by("timestamp", direction=direction)
+            .order_by("__name__", direction=direction)
+        )
+        for cursor, op in ((before, "<"), (after, ">")):
+            if cursor is None:
+                continue
+            timestamp, key = cursor
+            if key is None:
+                query = query.where("timestamp", op, timestamp)
+            elif not key:
+                # Cursor de un turno sin run leído de BigQuery: ningún id de documento es menor que ""
+                query = query.where("timestamp", op if op == "<" else ">=", timestamp)
+            elif op == "<" and not newest_first:
+                query = query.end_before({"timestamp": timestamp, "__name__": key})
+            else:
+                query = query.start_after({"timestamp": timestamp, "__name__": key})
+        if limit is not None:
+            query = query.limit(limit)
+
+        turns = (
+            {
+                "timestamp": _iso(turn.get("timestamp")),
+                "turn_key": doc.id,
+                "user_message": turn.get("user_message"),
+                "assistant_response": turn.get("assistant_response"),
+                "endpoint_source": turn.get("endpoint_source"),
+            }
+            for doc, turn in ((doc, doc.to_dict() or {}) for doc in query.stream())
+        )
+        if newest_first:
+            turns = reversed(list(turns))
+        yield from turns
+
+    def thread(self, uid: str, thread_id: str) -> Optional[Dict[str, Any]]:
+        """Detalle completo de un hilo; None si el almacén no lo tiene."""
+        summary = self.thread_summary(uid, thread_id)
+        if summary is None:
+            return None
+        messages: List[Dict[str, Any]] = []
+        for turn in self.iter_turns(thread_id):
+            messages.extend(turn_messages(turn["timestamp"], turn["user_message"], turn["assistant_response"]))
+        return {
+            "thread_id": thread_id,
+            "endpoint_source": summary.get("endpoint_source"),
+            "messages": messages,
+            "total_messages": len(messages),
+        }
+
+
+history_store = HistoryStore()
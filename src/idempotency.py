@@ -0,0 +1,327 @@
+# src/idempotency.py
+import asyncio
+import datetime
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from src.config import logger
+from src.metrics import register_stats
+from src.timing import timed
+
+# Respuestas de los endpoints de chat por (uid, cabecera `Idempotency-Key`). Los clientes
+# móviles (WebView) reintentan la petición cuando se corta la red, y cada reintento
+# lanzaba otro run completo del orquestador: se pagaban dos veces los tokens y la espera.
+#
+#   - primera petición con una clave: se apunta "en curso" y se atiende normalmente;
+#   - reintento mientras la primera sigue en curso: espera su respuesta (409 con
+#     Retry-After si no llega a tiempo). En el servidor ASGI la espera no ocupa nada y dura
+#     hasta IDEMPOTENCY_WAIT_SECONDS; en Flask cada espera bloquea uno de los pocos workers
+#     síncronos de gunicorn, así que se corta a los IDEMPOTENCY_SYNC_WAIT_SECONDS y es el
+#     cliente quien reintenta tras el Retry-After. La consulta se repite con backoff (de
+#     IDEMPOTENCY_POLL_SECONDS a IDEMPOTENCY_POLL_MAX_SECONDS) para no lanzar una
+#     transacción de Firestore cada medio segundo;
+#   - reintento con la primera ya respondida: recibe la misma respuesta sin lanzar nada;
+#   - misma clave con otro mensaje u otro hilo: 422 (la clave no se puede reutilizar).
+#
+# Solo se guardan las respuestas correctas. Si la primera petición falla, su marca "en
+# curso" se borra y el reintento vuelve a intentarlo. Un worker que muere a medias deja
+# la marca, pero esta caduca a los IDEMPOTENCY_PENDING_SECONDS. Las respuestas guardadas
+# duran IDEMPOTENCY_TTL_SECONDS; el campo `expires_at` sirve para una política TTL de
+# Firestore sobre la colección. Como la clave es del cliente, el documento se identifica
+# por un hash de uid y clave: otro usuario con la misma clave no ve la respuesta.
+
+IDEMPOTENCY_BACKEND = os.getenv("IDEMPOTENCY_BACKEND", "firestore")  # "firestore" | "local" | "none"
+IDEMPOTENCY_COLLECTION = os.getenv("IDEMPOTENCY_COLLECTION", "idempotency_keys")
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_PENDING_SECONDS = float(os.getenv("IDEMPOTENCY_PENDING_SECONDS", "150"))
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "90"))
+IDEMPOTENCY_SYNC_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_SYNC_WAIT_SECONDS", "3"))
+IDEMPOTENCY_POLL_SECONDS = float(os.getenv("IDEMPOTENCY_POLL_SECONDS", "0.5"))
+IDEMPOTENCY_POLL_MAX_SECONDS = float(os.getenv("IDEMPOTENCY_POLL_MAX_SECONDS", "5"))
+IDEMPOTENCY_LOCAL_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_LOCAL_MAX_ENTRIES", "10000"))
+IDEMPOTENCY_MAX_KEY_LENGTH = 255
+
+# Resultados de un intento de apuntar la clave
+STARTED = "started"
+REPLAY = "replay"
+PENDING = "pending"
+MISMATCH = "mismatch"
+
+
+class IdempotencyInProgress(Exception):
+    """La petición original con esta clave sigue en curso."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("petición en curso")
+        self.retry_after = retry_after
+
+
+class IdempotencyMismatch(Exception):
+    """La clave ya se usó con otra petición."""
+
+
+class IdempotentRequest:
+    """Petición con clave. `replay` es la respuesta guardada si no hay que atenderla de nuevo."""
+
+    def __init__(self, doc_id: Optional[str], owner: Optional[str], replay: Optional[Dict[str, Any]] = None):
+        self.doc_id = doc_id
+        self.owner = owner
+        self.replay = replay
+        self.response: Optional[Dict[str, Any]] = None
+
+    def complete(
+        self,
+        data: Dict[str, Any],
+        meta: Optional[Dict[str, Any]] = None,
+        status: int = 200,
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        """Apunta la respuesta correcta, que se guardará al cerrar la petición (`settle`)."""
+        self.response = {"data": data, "meta": meta or {}, "status": status, "headers": headers or {}}
+
+
+def request_fingerprint(scope: str, thread_id: Optional[str], message: str) -> str:
+    """Huella de lo que pide la petición, para detectar una clave reutilizada con otro mensaje."""
+    raw = f"{scope}\0{thread_id or ''}\0{message}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _doc_id(uid: str, key: str) -> str:
+    return hashlib.sha256(f"{uid}\0{key}".encode("utf-8")).hexdigest()
+
+
+def _decide(current: Optional[Dict[str, Any]], now: float, fingerprint: str) -> Tuple[str, Any]:
+    """Qué hacer con el registro actual de la clave. Devuelve (resultado, respuesta | segundos de espera)."""
+    if not current or float(current.get("expires_epoch") or 0) <= now:
+        return STARTED, None
+    if current.get("fingerprint") != fingerprint:
+        return MISMATCH, None
+    if current.get("state") == "done":
+        return REPLAY, current.get("response")
+    pending_until = float(current.get("pending_until") or 0)
+    if pending_until <= now:
+        # El worker que la atendía murió a medias: se vuelve a atender
+        return STARTED, None
+    return PENDING, max(1, int(pending_until - now))
+
+
+def _pending_document(uid: str, scope: str, fingerprint: str, owner: str, now: float, pending_seconds: float):
+    return {
+        "uid": uid,
+        "scope": scope,
+        "fingerprint": fingerprint,
+        "state": "pending",
+        "owner": owner,
+        "pending_until": now + pending_seconds,
+        "expires_epoch": now + pending_seconds,
+        "expires_at": datetime.datetime.fromtimestamp(now + pending_seconds, datetime.timezone.utc),
+    }
+
+
+def _done_document(response: Dict[str, Any], now: float, ttl_seconds: float):
+    return {
+        "state": "done",
+        "response": response,
+        "completed_at": now,
+        "expires_epoch": now + ttl_seconds,
+        "expires_at": datetime.datetime.fromtimestamp(now + ttl_seconds, datetime.timezone.utc),
+    }
+
+
+class IdempotencyStore:
+    """Registro de claves de idempotencia en Firestore (o en memoria) con espera de duplicados."""
+
+    def __init__(
+        self,
+        backend: str = IDEMPOTENCY_BACKEND,
+        ttl_seconds: float = IDEMPOTENCY_TTL_SECONDS,
+        pending_seconds: float = IDEMPOTENCY_PENDING_SECONDS,
+        wait_seconds: float = IDEMPOTENCY_WAIT_SECONDS,
+        sync_wait_seconds: float = IDEMPOTENCY_SYNC_WAIT_SECONDS,
+        poll_seconds: float = IDEMPOTENCY_POLL_SECONDS,
+        poll_max_seconds: float = IDEMPOTENCY_POLL_MAX_SECONDS,
+        max_local_entries: int = IDEMPOTENCY_LOCAL_MAX_ENTRIES,
+    ):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.pending_seconds = pending_seconds
+        self.wait_seconds = wait_seconds
+        self.sync_wait_seconds = sync_wait_seconds
+        self.poll_seconds = poll_seconds
+        self.poll_max_seconds = poll_max_seconds
+        self.max_local_entries = max_local_entries
+        self._lock = threading.Lock()
+        self._local: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._db = None
+        self._stats = {"started": 0, "replayed": 0, "waited": 0, "timeouts": 0, "mismatches": 0, "stored": 0, "errors": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend != "none"
+
+    # -- API pública --------------------------------------------------------------
+    def begin(self, uid: str, key: str, scope: str, fingerprint: str) -> IdempotentRequest:
+        """Apunta la clave o devuelve la respuesta ya guardada, esperando si la original sigue en curso.
+
+        La espera bloquea el worker, así que dura solo `sync_wait_seconds`. Lanza
+        IdempotencyMismatch o IdempotencyInProgress.
+        """
+        deadline = time.monotonic() + self.sync_wait_seconds
+        attempt = 0
+        while True:
+            owner = uuid.uuid4().hex
+            try:
+                outcome, value = self._try_begin(uid, key, scope, fingerprint, owner)
+            except Exception as e:
+                return self._unavailable(e)
+            record = self._handle(outcome, value, uid, key, owner, deadline, attempt > 0)
+            if record is not None:
+                return record
+            time.sleep(self._pause(deadline, attempt))
+            attempt += 1
+
+    async def abegin(self, uid: str, key: str, scope: str, fingerprint: str) -> IdempotentRequest:
+        """Versión asyncio de `begin`: la espera no bloquea el bucle de eventos y dura hasta `wait_seconds`."""
+        deadline = time.monotonic() + self.wait_seconds
+        attempt = 0
+        while True:
+            owner = uuid.uuid4().hex
+            try:
+                outcome, value = await asyncio.to_thread(self._try_begin, uid, key, scope, fingerprint, owner)
+            except Exception as e:
+                return self._unavailable(e)
+            record = self._handle(outcome, value, uid, key, owner, deadline, attempt > 0)
+            if record is not None:
+                return record
+            await asyncio.sleep(self._pause(deadline, attempt))
+            attempt += 1
+
+    def settle(self, record: IdempotentRequest):
+        """Cierra la petición: guarda la respuesta apuntada o, si falló, libera la clave. No lanza excepciones."""
+        if record.owner is None:
+            return
+        try:
+            if self.backend == "local":
+                self._settle_local(record)
+            else:
+                self._settle_firestore(record)
+            if record.response is not None:
+                self._count("stored")
+        except Exception as e:
+            # Sin guardar la respuesta, el reintento volverá a atenderse tras IDEMPOTENCY_PENDING_SECONDS
+            self._count("errors")
+            logger.error(f"Idempotency: no se pudo cerrar la clave {record.doc_id}: {e}", exc_info=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, local_entries=len(self._local))
+
+    # -- Internos -------------------------------------------------------------------
+    def _handle(self, outcome, value, uid, key, owner, deadline, waited) -> Optional[IdempotentRequest]:
+        """Convierte un intento en petición, en espera (None) o en excepción."""
+        if outcome in (STARTED, REPLAY) and waited:
+            self._count("waited")
+        if outcome == STARTED:
+            self._count("started")
+            return IdempotentRequest(_doc_id(uid, key), owner)
+        if outcome == REPLAY:
+            self._count("replayed")
+            return IdempotentRequest(_doc_id(uid, key), None, replay=value)
+        if outcome == MISMATCH:
+            self._count("mismatches")
+            raise IdempotencyMismatch()
+        if time.monotonic() >= deadline:
+            self._count("timeouts")
+            raise IdempotencyInProgress(value)
+        return None
+
+    def _unavailable(self, error: Exception) -> IdempotentRequest:
+        # Fail open: sin almacén la petición se atiende como si no trajera clave
+        self._count("errors")
+        logger.warning(f"Idempotency: almacén no disponible, se atiende sin clave: {error}")
+        return IdempotentRequest(None, None)
+
+    def _pause(self, deadline: float, attempt: int) -> float:
+        # Backoff exponencial: 0.5 s, 1 s, 2 s... hasta poll_max_seconds, sin pasar del plazo
+        pause = min(self.poll_seconds * (2 ** attempt), self.poll_max_seconds)
+        return max(0.0, min(pause, deadline - time.monotonic()))
+
+    def _try_begin(self, uid, key, scope, fingerprint, owner) -> Tuple[str, Any]:
+        if self.backend == "local":
+            doc_id = _doc_id(uid, key)
+            with self._lock:
+                now = time.time()
+                outcome, value = _decide(self._local.get(doc_id), now, fingerprint)
+                if outcome == STARTED:
+                    self._local[doc_id] = _pending_document(uid, scope, fingerprint, owner, now, self.pending_seconds)
+                    self._local.move_to_end(doc_id)
+                    while len(self._local) > self.max_local_entries:
+                        self._local.popitem(last=False)
+                return outcome, value
+        return self._try_begin_firestore(uid, key, scope, fingerprint, owner)
+
+    def _settle_local(self, record: IdempotentRequest):
+        with self._lock:
+            current = self._local.get(record.doc_id)
+            if not current or current.get("owner") != record.owner:
+                return
+            if record.response is None:
+                del self._local[record.doc_id]
+            else:
+                current.update(_done_document(record.response, time.time(), self.ttl_seconds))
+
+    def _client(self):
+        if self._db is None:
+            from firebase_admin import firestore
+
+            self._db = firestore.client()
+        return self._db
+
+    @timed("fs_idempotency", "firestore")
+    def _try_begin_firestore(self, uid, key, scope, fingerprint, owner) -> Tuple[str, Any]:
+        from firebase_admin import firestore
+
+        ref = self._client().collection(IDEMPOTENCY_COLLECTION).document(_doc_id(uid, key))
+
+        @firestore.transactional
+        def attempt(transaction):
+            snap = ref.get(transaction=transaction)
+            now = time.time()
+            outcome, value = _decide(snap.to_dict() if snap.exists else None, now, fingerprint)
+            if outcome == STARTED:
+                transaction.set(ref, _pending_document(uid, scope, fingerprint, owner, now, self.pending_seconds))
+            return outcome, value
+
+        return attempt(self._client().transaction())
+
+    @timed("fs_idempotency", "firestore")
+    def _settle_firestore(self, record: IdempotentRequest):
+        from firebase_admin import firestore
+
+        ref = self._client().collection(IDEMPOTENCY_COLLECTION).document(record.doc_id)
+
+        @firestore.transactional
+        def settle(transaction):
+            snap = ref.get(transaction=transaction)
+            # Si la marca caducó y la tomó un reintento, la respuesta la guardará él
+            if not snap.exists or (snap.to_dict() or {}).get("owner") != record.owner:
+                return
+            if record.response is None:
+                transaction.delete(ref)
+            else:
+                transaction.update(ref, _done_document(record.response, time.time(), self.ttl_seconds))
+
+        settle(self._client().transaction())
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._stats[name] += amount
+
+
+idempotency_store = IdempotencyStore()
+register_stats("idempotency", idempotency_store.stats)
@@ -0,0 +1,214 @@
+# src/metrics.py
+import hmac
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from src.config import logger
+
+# Métricas de Prometheus en `GET /metrics`. Con PROMETHEUS_MULTIPROC_DIR definido (el
+# Dockerfile lo define) cada worker de gunicorn/uvicorn escribe sus valores en ficheros de
+# ese directorio y `/metrics` suma los de todos, responda el worker que responda. Sin la
+# variable (desarrollo) solo se ven los del proceso que atiende la petición.
+#
+#   - recava_http_request_duration_seconds{route,method,status}: latencia por ruta;
+#   - recava_http_requests_in_flight: peticiones en curso (para fijar la concurrencia de
+#     Cloud Run);
+#   - recava_rate_limited_total{route}: peticiones rechazadas con 429 por el limitador;
+#   - recava_stage_duration_seconds{stage,upstream} y recava_stage_errors_total: cada etapa
+#     medida con `src.timing.span`, con `upstream` = firestore | bigquery | openai cuando
+#     la etapa es una llamada a ese servicio;
+#   - recava_openai_run_duration_seconds{assistant,phase,status} y
+#     recava_openai_run_polls_total{assistant,phase}: runs de OpenAI por assistant;
+#   - recava_tool_call_duration_seconds{tool,status}: tool calls del orquestador;
+#   - recava_component_stat{component,key,stat}: los contadores `stats()` de cachés,
+#     leases, idempotencia, jobs, escritor de BigQuery... (aciertos y fallos de caché,
+#     errores, reintentos). Cada worker los vuelca como mucho cada METRICS_SYNC_SECONDS.
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# Si se define, `/metrics` exige `Authorization: Bearer <METRICS_TOKEN>`
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+METRICS_SYNC_SECONDS = float(os.getenv("METRICS_SYNC_SECONDS", "10"))
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+if PROMETHEUS_MULTIPROC_DIR:
+    # prometheus_client escribe ahí desde la primera métrica: el directorio debe existir
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+from prometheus_client import (  # noqa: E402  (después de preparar el directorio)
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# De 10 ms a 5 min: cubre desde lecturas cacheadas hasta jobs en segundo plano
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120, 300)
+
+REQUEST_SECONDS = Histogram(
+    "recava_http_request_duration_seconds",
+    "Latencia de las peticiones HTTP por ruta.",
+    ["route", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "recava_http_requests_in_flight",
+    "Peticiones HTTP en curso.",
+    multiprocess_mode="livesum",
+)
+RATE_LIMITED = Counter(
+    "recava_rate_limited_total",
+    "Peticiones rechazadas por el rate limiting.",
+    ["route"],
+)
+STAGE_SECONDS = Histogram(
+    "recava_stage_duration_seconds",
+    "Duración de cada etapa medida con src.timing.span.",
+    ["stage", "upstream"],
+    buckets=LATENCY_BUCKETS,
+)
+STAGE_ERRORS = Counter(
+    "recava_stage_errors_total",
+    "Etapas que terminaron con una excepción.",
+    ["stage", "upstream"],
+)
+RUN_SECONDS = Histogram(
+    "recava_openai_run_duration_seconds",
+    "Espera de los runs de OpenAI hasta su estado final.",
+    ["assistant", "phase", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+RUN_POLLS = Counter(
+    "recava_openai_run_polls_total",
+    "Consultas de estado hechas a los runs de OpenAI.",
+    ["assistant", "phase"],
+)
+TOOL_SECONDS = Histogram(
+    "recava_tool_call_duration_seconds",
+    "Duración de las tool calls.",
+    ["tool", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+COMPONENT_STAT = Gauge(
+    "recava_component_stat",
+    "Contadores stats() de los componentes del proceso (suma de los workers vivos).",
+    ["component", "key", "stat"],
+    multiprocess_mode="livesum",
+)
+
+# Valores de stats() que no tiene sentido sumar entre workers (se calculan en la consulta)
+_NOT_SUMMABLE_SUFFIXES = ("_ratio", "_rate", "_avg", "_max")
+_NOT_SUMMABLE = {"threshold", "expected_ms"}
+
+_sources: Dict[str, Callable[[], Dict[str, Any]]] = {}
+_sync_lock = threading.Lock()
+_last_sync = 0.0
+
+
+# -- Observaciones ----------------------------------------------------------------
+def request_started():
+    if METRICS_ENABLED:
+        REQUESTS_IN_FLIGHT.inc()
+
+
+def request_finished(route: str, method: str, status: int, seconds: float):
+    """Cierra una petición: latencia por ruta, 429 y volcado periódico de stats()."""
+    if not METRICS_ENABLED:
+        return
+    REQUESTS_IN_FLIGHT.dec()
+    REQUEST_SECONDS.labels(route, method, str(status)).observe(seconds)
+    if status == 429:
+        RATE_LIMITED.labels(route).inc()
+    sync_component_stats()
+
+
+def observe_stage(stage: str, upstream: Optional[str], seconds: float, error: bool = False):
+    if not METRICS_ENABLED:
+        return
+    STAGE_SECONDS.labels(stage, upstream or "").observe(seconds)
+    if error:
+        STAGE_ERRORS.labels(stage, upstream or "").inc()
+
+
+def observe_run(assistant: str, phase: str, status: str, seconds: float, polls: int):
+    if not METRICS_ENABLED:
+        return
+    RUN_SECONDS.labels(assistant, phase, status).observe(seconds)
+    RUN_POLLS.labels(assistant, phase).inc(polls)
+
+
+def observe_tool(tool: str, status: str, seconds: float):
+    if METRICS_ENABLED:
+        TOOL_SECONDS.labels(tool, status).observe(seconds)
+
+
+# -- stats() de los componentes -----------------------------------------------------
+def register_stats(component: str, source: Callable[[], Dict[str, Any]]):
+    """Publica los contadores de `source()` como recava_component_stat{component=...}."""
+    _sources[component] = source
+
+
+def _flatten(stats: Dict[str, Any]) -> Iterator[Tuple[str, str, float]]:
+    """(key, stat, valor) de un stats() plano o anidado un nivel (p. ej. por assistant)."""
+    for name, value in stats.items():
+        if isinstance(value, dict):
+            for stat, inner in value.items():
+                yield name, stat, inner
+        else:
+            yield "", name, value
+
+
+def sync_component_stats(force: bool = False):
+    """Vuelca los stats() de este proceso en las gauges (como mucho cada METRICS_SYNC_SECONDS)."""
+    global _last_sync
+    if not METRICS_ENABLED:
+        return
+    now = time.monotonic()
+    if not force and now - _last_sync < METRICS_SYNC_SECONDS:
+        return
+    if not _sync_lock.acquire(blocking=False):
+        return
+    try:
+        _last_sync = now
+        for component, source in list(_sources.items()):
+            try:
+                stats = source()
+            except Exception as e:
+                logger.warning(f"Metrics: no se pudieron leer los stats de {component}: {e}")
+                continue
+            for key, stat, value in _flatten(stats):
+                if stat in _NOT_SUMMABLE or stat.endswith(_NOT_SUMMABLE_SUFFIXES):
+                    continue
+                if isinstance(value, (bool, int, float)):
+                    COMPONENT_STAT.labels(component, key, stat).set(float(value))
+    finally:
+        _sync_lock.release()
+
+
+# -- Exposición -------------------------------------------------------------------
+def authorized(authorization: Optional[str]) -> bool:
+    if not METRICS_TOKEN:
+        return True
+    return hmac.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}")
+
+
+def render() -> Tuple[bytes, str]:
+    """Cuerpo y Content-Type de `/metrics` (agregando todos los workers si hay multiproceso)."""
+    sync_component_stats(force=True)
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    from prometheus_client import REGISTRY
+
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid: int):
+    """Hook `child_exit` de gunicorn: quita las gauges `livesum` del worker que ha muerto."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
@@ -1,38 +1,147 @@
 # src/openai_service.py
+import asyncio
 import json
-from src.config import client, logger, ASISTENTE_ID
+import time
+from typing import Optional
 
-def execute_invoke_sustainability_expert(query: str, original_thread_id: str) -> str:
+from src.config import client, async_client, logger, ASISTENTE_ID
+from src.run_poller import RunPollTimeout, async_wait_for_run, wait_for_run
+from src.expert_cache import EXPERT_CACHE_ENABLED, expert_cache
+from src.scratch_threads import scratch_thread_payload, scratch_threads
+
+# Plazo máximo para que el experto responda a una consulta de herramienta. Dentro de un
+# turno manda el plazo de la tool call (ver `_expert_wait_seconds`).
+EXPERT_RUN_TIMEOUT_SECONDS = 120.0
+EXPERT_RUN_INSTRUCTIONS = "Please address the user's query based on your knowledge. Provide a concise, focused answer."
+EXPERT_TIMEOUT_OUTPUT = "ERROR_EXPERT_TIMEOUT: El experto en sostenibilidad no respondió a tiempo."
+
+def _expert_wait_seconds(deadline: Optional[float]) -> float:
+    """
+    Espera del run del experto: EXPERT_RUN_TIMEOUT_SECONDS, recortada al plazo de la tool
+    call. Al agotarse, RunPoller cancela el run en lugar de dejarlo corriendo (y facturando)
+    cuando el turno ya se ha rendido.
+    """
+    if deadline is None:
+        return EXPERT_RUN_TIMEOUT_SECONDS
+    return min(EXPERT_RUN_TIMEOUT_SECONDS, max(0.0, deadline - time.monotonic()))
+
+def execute_invoke_sustainability_expert(query: str, original_thread_id: str, deadline: Optional[float] = None) -> str:
     """Ejecuta una consulta al Asistente de Sostenibilidad como una herramienta."""
     tool_name = "invoke_sustainability_expert"
     logger.info(f"Tool ({tool_name}): Executing for query on thread {original_thread_id}")
-    temp_thread = None
+    scratch_thread_id = None
     error_message = "ERROR_EXPERT: No se pudo obtener respuesta del experto en sostenibilidad."
 
+    if EXPERT_CACHE_ENABLED:
+        cached = expert_cache.get(query)
+        if cached is not None:
+            logger.info(f"Tool ({tool_name}): Cache hit for query on thread {original_thread_id}")
+            return cached
+
+    if _expert_wait_seconds(deadline) <= 0:
+        logger.warning(f"Tool ({tool_name}): plazo agotado antes de consultar al experto (thread {original_thread_id}).")
+        return EXPERT_TIMEOUT_OUTPUT
+
     try:
-        temp_thread = client.beta.threads.create()
-        client.beta.threads.messages.create(thread_id=temp_thread.id, role="user", content=query)
-        run = client.beta.threads.runs.create_and_poll(
-            thread_id=temp_thread.id,
+        # Hilo, mensaje y run en una sola llamada; el hilo se borra en segundo plano
+        run = client.beta.threads.create_and_run(
             assistant_id=ASISTENTE_ID,
-            instructions="Please address the user's query based on your knowledge. Provide a concise, focused answer."
+            thread=scratch_thread_payload(query, original_thread_id, "expert"),
+            instructions=EXPERT_RUN_INSTRUCTIONS,
         )
+        scratch_thread_id = run.thread_id
+        scratch_threads.track(scratch_thread_id)
+        run = wait_for_run(client, run, _expert_wait_seconds(deadline))
         if run.status == 'completed':
-            messages = client.beta.threads.messages.list(thread_id=temp_thread.id, run_id=run.id, order='desc', limit=1)
+            messages = client.beta.threads.messages.list(thread_id=scratch_thread_id, run_id=run.id, order='desc', limit=1)
             if messages.data and messages.data[0].content:
-                return "\n".join([block.text.value for block in messages.data[0].content if block.type == 'text']).strip()
+                answer = "\n".join([block.text.value for block in messages.data[0].content if block.type == 'text']).strip()
+                if EXPERT_CACHE_ENABLED and answer:
+                    expert_cache.put(query, answer)
+                return answer
         
         logger.error(f"Tool ({tool_name}): Run failed with status {run.status}. Details: {run.last_error or 'N/A'}")
         return error_message
+    except RunPollTimeout as e:
+        # RunPoller ya ha cancelado el run del experto
+        logger.warning(f"Tool ({tool_name}): {e.message}")
+        return EXPERT_TIMEOUT_OUTPUT
     except Exception as e:
         logger.error(f"Tool ({tool_name}): Exception: {e}", exc_info=True)
         return error_message
     finally:
-        if temp_thread:
-            try:
-                client.beta.threads.delete(temp_thread.id)
-            except Exception as delete_err:
-                logger.error(f"Tool ({tool_name}): Failed to delete temp thread {temp_thread.id}. Error: {delete_err}")
+        if scratch_thread_id:
+            scratch_threads.release(scratch_thread_id)
+
+async def aexecute_invoke_sustainability_expert(
+    query: str, original_thread_id: str, deadline: Optional[float] = None
+) -> str:
+    """Variante asyncio de `execute_invoke_sustainability_expert` (modo ASGI)."""
+    tool_name = "invoke_sustainability_expert"
+    logger.info(f"Tool ({tool_name}): Executing (async) for query on thread {original_thread_id}")
+    scratch_thread_id = None
+    error_message = "ERROR_EXPERT: No se pudo obtener respuesta del experto en sostenibilidad."
+
+    if EXPERT_CACHE_ENABLED:
+        cached = await asyncio.to_thread(expert_cache.get, query)
+        if cached is not None:
+            logger.info(f"Tool ({tool_name}): Cache hit for query on thread {original_thread_id}")
+            return cached
+
+    if _expert_wait_seconds(deadline) <= 0:
+        logger.warning(f"Tool ({tool_name}): plazo agotado antes de consultar al experto (thread {original_thread_id}).")
+        return EXPERT_TIMEOUT_OUTPUT
+
+    try:
+        run = await async_client.beta.threads.create_and_run(
+            assistant_id=ASISTENTE_ID,
+            thread=scratch_thread_payload(query, original_thread_id, "expert"),
+            instructions=EXPERT_RUN_INSTRUCTIONS,
+        )
+        scratch_thread_id = run.thread_id
+        scratch_threads.track(scratch_thread_id)
+        run = await async_wait_for_run(async_client, run, _expert_wait_seconds(deadline))
+        if run.status == 'completed':
+            messages = await async_client.beta.threads.messages.list(thread_id=scratch_thread_id, run_id=run.id, order='desc', limit=1)
+            if messages.data and messages.data[0].content:
+                answer = "\n".join([block.text.value for block in messages.data[0].content if block.type == 'text']).strip()
+                if EXPERT_CACHE_ENABLED and answer:
+                    await asyncio.to_thread(expert_cache.put, query, answer)
+                return answer
+
+        logger.error(f"Tool ({tool_name}): Run failed with status {run.status}. Details: {run.last_error or 'N/A'}")
+        return error_message
+    except RunPollTimeout as e:
+        # RunPoller ya ha cancelado el run del experto
+        logger.warning(f"Tool ({tool_name}): {e.message}")
+        return EXPERT_TIMEOUT_OUTPUT
+    except Exception as e:
+        logger.error(f"Tool ({tool_name}): Exception: {e}", exc_info=True)
+        return error_message
+    finally:
+        if scratch_thread_id:
+            scratch_threads.release(scratch_thread_id)
+
+def execute_orchestrator_tool_call(tool_call, thread_id: str, deadline: Optional[float] = None):
+    """
+    Ejecuta una tool call del orquestador y devuelve el tool_output (o None si no se
+    reconoce). `deadline` (`time.monotonic()`) es el plazo de la llamada dentro del turno.
+    """
+    if tool_call.function.name == "invoke_sustainability_expert":
+        args = json.loads(tool_call.function.arguments or "{}")
+        output = execute_invoke_sustainability_expert(args.get("query"), thread_id, deadline)
+        return {"tool_call_id": tool_call.id, "output": output}
+    logger.warning(f"Tool call no soportada: {tool_call.function.name}")
+    return None
+
+async def aexecute_orchestrator_tool_call(tool_call, thread_id: str, deadline: Optional[float] = None):
+    """Variante asyncio de `execute_orchestrator_tool_call`."""
+    if tool_call.function.name == "invoke_sustainability_expert":
+        args = json.loads(tool_call.function.arguments or "{}")
+        output = await aexecute_invoke_sustainability_expert(args.get("query"), thread_id, deadline)
+        return {"tool_call_id": tool_call.id, "output": output}
+    logger.warning(f"Tool call no soportada: {tool_call.function.name}")
+    return None
 
 def process_assistant_message_without_citations(messages_data, final_run_id, endpoint_name):
     """Extrae el último mensaje de texto del asistente de una lista de mensajes."""
@@ -1,13 +1,16 @@
 # src/persistence_service.py
 from src.config import logger
 from src.bigquery_service import insert_chat_turn_to_bigquery
+from src.history_store import HISTORY_STORE, history_store
+from src.timing import timed
 
+@timed("persist")
 def persist_conversation_turn(thread_id: str, user_message: str, assistant_response: str, endpoint_source: str, **kwargs):
-    """Persiste un turno de conversación en BigQuery, consolidando todo el historial."""
+    """Persiste un turno de conversación en BigQuery (y en el historial de Firestore que sirve /chat_history)."""
     logger.info(f"Persisting turn for thread {thread_id} from {endpoint_source} via BigQuery...")
 
     try:
-        insert_chat_turn_to_bigquery(
+        row = insert_chat_turn_to_bigquery(
             thread_id=thread_id,
             user_message=user_message,
             assistant_response=assistant_response,
@@ -20,5 +23,7 @@ def persist_conversation_turn(thread_id: str, user_message: str, assistant_respo
             email_verified=kwargs.get('email_verified'),
         )
         logger.info("BigQuery: Successfully stored turn.")
+        if HISTORY_STORE == "firestore":
+            history_store.record_turn(row)
     except Exception:
         logger.error(f"BigQuery: Failed to store turn for thread {thread_id}.", exc_info=True)
@@ -0,0 +1,139 @@
+# src/rate_limit.py
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from limits import parse_many
+from limits.storage import MemoryStorage, storage_from_string
+from limits.strategies import STRATEGIES
+
+from src.auth_cache import token_cache
+from src.config import logger
+from src.metrics import register_stats
+from src.timing import span
+
+# Límites de peticiones compartidos entre workers e instancias. Con almacenamiento en
+# memoria cada worker de cada instancia cuenta por separado, así que el límite real era N
+# veces el configurado. Con RATE_LIMIT_STORAGE_URI=redis://... (p. ej. Memorystore) todos
+# cuentan sobre las mismas claves con una ventana deslizante. La clave es el uid de
+# Firebase: detrás del proxy de Cloud Run todas las peticiones llegan desde la misma IP.
+#
+# Si el almacenamiento no responde, los límites se aplican en memoria por proceso (fail
+# open con respaldo local) y se vuelve a probar el almacenamiento compartido pasados
+# RATE_LIMIT_RETRY_SECONDS. Flask usa la misma configuración a través de Flask-Limiter;
+# `SharedRateLimiter` cubre las rutas nativas del modo ASGI.
+
+RATE_LIMIT_STORAGE_URI = os.getenv("RATE_LIMIT_STORAGE_URI", "memory://")
+# "sliding-window-counter" | "moving-window" | "fixed-window"
+RATE_LIMIT_STRATEGY = os.getenv("RATE_LIMIT_STRATEGY", "sliding-window-counter")
+RATE_LIMIT_DEFAULT = os.getenv("RATE_LIMIT_DEFAULT", "120/minute")
+RATE_LIMIT_RETRY_SECONDS = float(os.getenv("RATE_LIMIT_RETRY_SECONDS", "30"))
+RATE_LIMIT_KEY_PREFIX = os.getenv("RATE_LIMIT_KEY_PREFIX", "recava")
+
+# Límites de los endpoints de chat (Flask y ASGI)
+AUDITOR_RATE_LIMIT = "12/minute; 2/second"
+ASSISTANT_RATE_LIMIT = "20/minute; 3/second"
+
+
+def rate_limit_key(authorization: Optional[str], forwarded_for: Optional[str], remote_addr: Optional[str]) -> str:
+    """`uid:<uid>` si el token es válido; si no, la IP del cliente (la petición acabará en 401)."""
+    if authorization and authorization.startswith("Bearer "):
+        try:
+            # El handler vuelve a verificar el token, pero ya desde la caché
+            with span("auth"):
+                return "uid:" + token_cache.verify(authorization.split(" ", 1)[1])["uid"]
+        except Exception:
+            pass
+    # Cloud Run añade la IP real del cliente al principio de X-Forwarded-For
+    client_ip = (forwarded_for or "").split(",")[0].strip() or remote_addr or "unknown"
+    return "ip:" + client_ip
+
+
+def flask_rate_limit_key() -> str:
+    """`key_func` de Flask-Limiter."""
+    from flask import request
+
+    return rate_limit_key(
+        request.headers.get("Authorization"),
+        request.headers.get("X-Forwarded-For"),
+        request.remote_addr,
+    )
+
+
+class SharedRateLimiter:
+    """Límites de `limits` sobre el almacenamiento compartido, con respaldo en memoria."""
+
+    def __init__(
+        self,
+        storage_uri: str = RATE_LIMIT_STORAGE_URI,
+        strategy: str = RATE_LIMIT_STRATEGY,
+        key_prefix: str = RATE_LIMIT_KEY_PREFIX,
+        retry_seconds: float = RATE_LIMIT_RETRY_SECONDS,
+        **storage_options: Any,
+    ):
+        strategy_cls = STRATEGIES[strategy]
+        self.storage_uri = storage_uri
+        self.key_prefix = key_prefix
+        self.retry_seconds = retry_seconds
+        self._shared = strategy_cls(storage_from_string(storage_uri, **storage_options))
+        self._local = strategy_cls(MemoryStorage())
+        self._down_until = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"allowed": 0, "limited": 0, "fallbacks": 0, "storage_errors": 0}
+
+    def hit(self, limits: str, key: str, scope: str) -> Tuple[bool, int]:
+        """Cuenta una petición. Devuelve (permitida, segundos hasta poder reintentar)."""
+        items = parse_many(limits)
+        identifiers = (self.key_prefix, scope, key)
+        limiter = self._local if time.monotonic() < self._down_until else self._shared
+        try:
+            allowed, retry_after = self._hit(limiter, items, identifiers)
+        except Exception as e:
+            # Fail open: el almacenamiento compartido no responde, se limita en local
+            with self._lock:
+                self._down_until = time.monotonic() + self.retry_seconds
+                self._stats["storage_errors"] += 1
+            logger.warning(f"RateLimit: almacenamiento {self.storage_uri} no disponible, límites en memoria: {e}")
+            limiter = self._local
+            allowed, retry_after = self._hit(limiter, items, identifiers)
+
+        with self._lock:
+            self._stats["allowed" if allowed else "limited"] += 1
+            if limiter is self._local:
+                self._stats["fallbacks"] += 1
+        return allowed, retry_after
+
+    @staticmethod
+    def _hit(limiter, items, identifiers) -> Tuple[bool, int]:
+        for item in items:
+            if not limiter.hit(item, *identifiers):
+                reset_at = limiter.get_window_stats(item, *identifiers).reset_time
+                return False, max(1, math.ceil(reset_at - time.time()))
+        return True, 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, degraded=time.monotonic() < self._down_until)
+
+
+_shared_limiter: Optional[SharedRateLimiter] = None
+_shared_limiter_lock = threading.Lock()
+
+
+def shared_rate_limiter() -> SharedRateLimiter:
+    """Instancia del proceso (se crea al primer uso: la conexión no se abre al importar)."""
+    global _shared_limiter
+    with _shared_limiter_lock:
+        if _shared_limiter is None:
+            _shared_limiter = SharedRateLimiter()
+        return _shared_limiter
+
+
+def _shared_limiter_stats() -> Dict[str, Any]:
+    # Solo si el proceso ya lo ha creado (modo ASGI); Flask-Limiter lleva su propia cuenta
+    return _shared_limiter.stats() if _shared_limiter is not None else {}
+
+
+register_stats("shared_rate_limiter", _shared_limiter_stats)
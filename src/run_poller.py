@@ -0,0 +1,260 @@
+# src/run_poller.py
+import asyncio
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple, Type
+
+from src.config import logger
+from src.metrics import observe_run, register_stats
+
+# Sustituye a `create_and_poll` / `submit_tool_outputs_and_poll`, que consultan el run a
+# intervalo fijo (1 s por defecto). Aquí el intervalo se adapta a lo que suele tardar
+# cada assistant: mientras queda lejos la duración esperada se espera la mitad de lo que
+# falta, y a partir de ahí se consulta rápido con backoff exponencial. La cabecera
+# `openai-poll-after-ms` del servidor actúa siempre como mínimo.
+
+RUN_POLL_MIN_MS = int(os.getenv("RUN_POLL_MIN_MS", "250"))
+RUN_POLL_MAX_MS = int(os.getenv("RUN_POLL_MAX_MS", "2000"))
+RUN_POLL_BACKOFF = float(os.getenv("RUN_POLL_BACKOFF", "1.5"))
+# Peso de la última observación en la media móvil exponencial de duraciones
+RUN_POLL_EWMA_ALPHA = float(os.getenv("RUN_POLL_EWMA_ALPHA", "0.3"))
+
+# Timeout HTTP de cada consulta: como mucho lo que quede de plazo, acotado a [2 s, 30 s]
+RUN_POLL_MIN_REQUEST_TIMEOUT = 2.0
+RUN_POLL_MAX_REQUEST_TIMEOUT = 30.0
+
+TERMINAL_STATES = {"requires_action", "cancelled", "completed", "failed", "expired", "incomplete"}
+
+_POLL_HEADERS = {"X-Stainless-Poll-Helper": "true"}
+
+
+class RunPollTimeout(Exception):
+    """El run no llegó a un estado terminal antes del plazo. Se trata como cualquier timeout de OpenAI."""
+
+    def __init__(self, run, waited_s: float):
+        self.run = run
+        # `run` es None si el stream no llegó a anunciar el run antes del plazo
+        self.message = (
+            f"Run {getattr(run, 'id', None)} seguía en estado {getattr(run, 'status', None)} tras {waited_s:.1f}s de espera."
+        )
+        super().__init__(self.message)
+
+
+def timeout_errors() -> Tuple[Type[BaseException], ...]:
+    """
+    Excepciones que cuentan como timeout de OpenAI, para `except timeout_errors() as exc:`.
+    Heredar de `openai.APITimeoutError` obligaba a importar openai al cargar este módulo; así
+    el import solo ocurre al evaluar el `except` (ya con openai cargado por la llamada que falló).
+    """
+    from openai import APITimeoutError
+
+    return (APITimeoutError, RunPollTimeout)
+
+
+def _request_timeout(deadline: float) -> float:
+    remaining = deadline - time.monotonic()
+    return min(max(remaining, RUN_POLL_MIN_REQUEST_TIMEOUT), RUN_POLL_MAX_REQUEST_TIMEOUT)
+
+
+def new_polling_metrics() -> Dict[str, int]:
+    """Acumulador por turno: consultas realizadas, tiempo esperando y latencia añadida estimada."""
+    return {"polls": 0, "wait_ms": 0, "added_ms": 0}
+
+
+class RunPoller:
+    """Espera runs de OpenAI con un intervalo ajustado a la duración observada por assistant."""
+
+    def __init__(
+        self,
+        min_interval: float = RUN_POLL_MIN_MS / 1000,
+        max_interval: float = RUN_POLL_MAX_MS / 1000,
+        backoff: float = RUN_POLL_BACKOFF,
+        alpha: float = RUN_POLL_EWMA_ALPHA,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._expected: Dict[str, float] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    # -- Modelo de duraciones -------------------------------------------------
+    def expected_duration(self, key: str) -> Optional[float]:
+        with self._lock:
+            return self._expected.get(key)
+
+    def _observe(self, key: str, duration: float, metrics: Dict[str, int], timed_out: bool = False):
+        with self._lock:
+            # Un run cortado por el plazo no dice cuánto habría tardado: no entra en la media
+            if not timed_out:
+                previous = self._expected.get(key)
+                self._expected[key] = duration if previous is None else (
+                    self.alpha * duration + (1 - self.alpha) * previous
+                )
+            stats = self._stats.setdefault(key, {"runs": 0, "timeouts": 0, **new_polling_metrics()})
+            stats["runs"] += 1
+            stats["timeouts"] += int(timed_out)
+            for name, value in metrics.items():
+                stats[name] += value
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Métricas acumuladas por assistant (y fase) desde el arranque del proceso."""
+        with self._lock:
+            return {
+                key: dict(values, expected_ms=int(self._expected.get(key, 0) * 1000))
+                for key, values in self._stats.items()
+            }
+
+    def next_delay(self, key: str, elapsed: float, backoff_delay: float, hint_ms: Optional[str]):
+        """Devuelve (espera, siguiente backoff) para la próxima consulta."""
+        expected = self.expected_duration(key)
+        if expected is not None and elapsed < expected:
+            # Aún lejos del final esperado: esperar la mitad de lo que falta
+            delay = (expected - elapsed) / 2
+        else:
+            delay = backoff_delay
+            backoff_delay = min(backoff_delay * self.backoff, self.max_interval)
+        delay = min(max(delay, self.min_interval), self.max_interval)
+        if hint_ms:
+            try:
+                delay = max(delay, int(hint_ms) / 1000)
+            except ValueError:
+                pass
+        return delay, backoff_delay
+
+    # -- Bucle de espera ------------------------------------------------------
+    def _finish(self, key, run, started, last_gap, polls, metrics, status=None):
+        """Apunta la espera en las métricas. `status="timeout"` para un run cortado por el plazo."""
+        waited = time.monotonic() - started
+        status = status or run.status
+        # El run terminó en algún momento del último intervalo: se estima la mitad
+        added_ms = 0 if status == "timeout" else int(last_gap * 500)
+        turn_metrics = {"polls": polls, "wait_ms": int(waited * 1000), "added_ms": added_ms}
+        self._observe(key, waited, turn_metrics, timed_out=status == "timeout")
+        observe_run(*_split_key(key), status, waited, polls)
+        if metrics is not None:
+            for name, value in turn_metrics.items():
+                metrics[name] = metrics.get(name, 0) + value
+        logger.debug(f"RunPoller: run {run.id} ({key}) -> {status} {turn_metrics}")
+        return run
+
+    def wait(self, openai_client, run, thread_id: str, key: str, timeout: float, metrics=None):
+        """Consulta el run hasta un estado terminal o hasta agotar `timeout` segundos."""
+        started = time.monotonic()
+        deadline = started + timeout
+        backoff_delay, hint_ms, last_gap, polls = self.min_interval, None, 0.0, 0
+        while run.status not in TERMINAL_STATES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"RunPoller: run {run.id} sin terminar tras el plazo; se cancela.")
+                try:
+                    openai_client.beta.threads.runs.cancel(run_id=run.id, thread_id=thread_id)
+                except Exception as cancel_err:
+                    logger.warning(f"RunPoller: no se pudo cancelar el run {run.id}: {cancel_err}")
+                self._finish(key, run, started, last_gap, polls, metrics, status="timeout")
+                raise RunPollTimeout(run, time.monotonic() - started)
+            delay, backoff_delay = self.next_delay(key, time.monotonic() - started, backoff_delay, hint_ms)
+            delay = min(delay, remaining)
+            time.sleep(delay)
+            # Ninguna consulta individual puede alargarse más allá del plazo
+            response = openai_client.beta.threads.runs.with_raw_response.retrieve(
+                run_id=run.id,
+                thread_id=thread_id,
+                extra_headers=_POLL_HEADERS,
+                timeout=_request_timeout(deadline),
+            )
+            run = response.parse()
+            hint_ms = response.headers.get("openai-poll-after-ms")
+            last_gap = delay
+            polls += 1
+        return self._finish(key, run, started, last_gap, polls, metrics)
+
+    async def async_wait(self, openai_client, run, thread_id: str, key: str, timeout: float, metrics=None):
+        """Variante asyncio de `wait` para `openai.AsyncOpenAI`."""
+        started = time.monotonic()
+        deadline = started + timeout
+        backoff_delay, hint_ms, last_gap, polls = self.min_interval, None, 0.0, 0
+        while run.status not in TERMINAL_STATES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"RunPoller: run {run.id} sin terminar tras el plazo; se cancela.")
+                try:
+                    await openai_client.beta.threads.runs.cancel(run_id=run.id, thread_id=thread_id)
+                except Exception as cancel_err:
+                    logger.warning(f"RunPoller: no se pudo cancelar el run {run.id}: {cancel_err}")
+                self._finish(key, run, started, last_gap, polls, metrics, status="timeout")
+                raise RunPollTimeout(run, time.monotonic() - started)
+            delay, backoff_delay = self.next_delay(key, time.monotonic() - started, backoff_delay, hint_ms)
+            delay = min(delay, remaining)
+            await asyncio.sleep(delay)
+            # Ninguna consulta individual puede alargarse más allá del plazo
+            response = await openai_client.beta.threads.runs.with_raw_response.retrieve(
+                run_id=run.id,
+                thread_id=thread_id,
+                extra_headers=_POLL_HEADERS,
+                timeout=_request_timeout(deadline),
+            )
+            run = response.parse()
+            hint_ms = response.headers.get("openai-poll-after-ms")
+            last_gap = delay
+            polls += 1
+        return self._finish(key, run, started, last_gap, polls, metrics)
+
+
+run_poller = RunPoller()
+register_stats("run_poller", run_poller.stats)
+
+
+def _key(assistant_id: str, phase: str) -> str:
+    return assistant_id if phase == "run" else f"{assistant_id}:{phase}"
+
+
+def _split_key(key: str):
+    """(assistant_id, fase) de una clave de `_key`."""
+    assistant_id, _, phase = key.partition(":")
+    return assistant_id, phase or "run"
+
+
+def create_and_wait(openai_client, thread_id: str, assistant_id: str, timeout: float, metrics=None, **run_kwargs):
+    """Equivalente a `runs.create_and_poll` con el intervalo adaptativo."""
+    run = openai_client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id, **run_kwargs)
+    return run_poller.wait(openai_client, run, thread_id, _key(assistant_id, "run"), timeout, metrics)
+
+
+def submit_tool_outputs_and_wait(openai_client, run, thread_id: str, tool_outputs, timeout: float, metrics=None):
+    """Equivalente a `runs.submit_tool_outputs_and_poll` con el intervalo adaptativo."""
+    run = openai_client.beta.threads.runs.submit_tool_outputs(
+        thread_id=thread_id, run_id=run.id, tool_outputs=tool_outputs
+    )
+    return run_poller.wait(openai_client, run, thread_id, _key(run.assistant_id, "tool_outputs"), timeout, metrics)
+
+
+async def async_create_and_wait(
+    openai_client, thread_id: str, assistant_id: str, timeout: float, metrics=None, **run_kwargs
+):
+    run = await openai_client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id, **run_kwargs)
+    return await run_poller.async_wait(openai_client, run, thread_id, _key(assistant_id, "run"), timeout, metrics)
+
+
+async def async_submit_tool_outputs_and_wait(
+    openai_client, run, thread_id: str, tool_outputs, timeout: float, metrics=None
+):
+    run = await openai_client.beta.threads.runs.submit_tool_outputs(
+        thread_id=thread_id, run_id=run.id, tool_outputs=tool_outputs
+    )
+    return await run_poller.async_wait(
+        openai_client, run, thread_id, _key(run.assistant_id, "tool_outputs"), timeout, metrics
+    )
+
+
+def wait_for_run(openai_client, run, timeout: float, metrics=None):
+    """Espera un run ya creado (p. ej. con `threads.create_and_run`) con el intervalo adaptativo."""
+    return run_poller.wait(openai_client, run, run.thread_id, _key(run.assistant_id, "run"), timeout, metrics)
+
+
+async def async_wait_for_run(openai_client, run, timeout: float, metrics=None):
+    return await run_poller.async_wait(
+        openai_client, run, run.thread_id, _key(run.assistant_id, "run"), timeout, metrics
+    )
@@ -0,0 +1,204 @@
+# src/scratch_threads.py
+import atexit
+import datetime
+import heapq
+import os
+import queue
+import socket
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from src.config import client, logger
+from src.metrics import register_stats
+
+# Hilos temporales ("scratch") de las consultas al experto. Cada tool call crea el hilo,
+# el mensaje y el run de una vez con `threads.create_and_run`; el borrado del hilo sale
+# del camino crítico y lo hace un hilo de fondo con reintentos.
+#
+# La API de Assistants no permite listar hilos, así que cada hilo temporal se apunta en
+# una colección de Firestore y se desapunta al borrarlo. Si un worker muere con hilos
+# pendientes, el barrido periódico (`sweep`) borra los apuntados hace más de
+# SCRATCH_THREAD_ORPHAN_AGE_SECONDS, vengan del worker que vengan.
+
+SCRATCH_THREAD_REGISTRY = os.getenv("SCRATCH_THREAD_REGISTRY", "firestore")  # "firestore" | "none"
+SCRATCH_THREAD_COLLECTION = os.getenv("SCRATCH_THREAD_COLLECTION", "scratch_threads")
+SCRATCH_THREAD_DELETE_RETRIES = int(os.getenv("SCRATCH_THREAD_DELETE_RETRIES", "5"))
+SCRATCH_THREAD_ORPHAN_AGE_SECONDS = int(os.getenv("SCRATCH_THREAD_ORPHAN_AGE_SECONDS", "1800"))
+SCRATCH_THREAD_SWEEP_INTERVAL_SECONDS = int(os.getenv("SCRATCH_THREAD_SWEEP_INTERVAL_SECONDS", "900"))
+# Tiempo máximo que se dedica a borrar pendientes al salir el proceso
+SCRATCH_THREAD_DRAIN_SECONDS = float(os.getenv("SCRATCH_THREAD_DRAIN_SECONDS", "5"))
+
+_SWEEP_BATCH = 200
+
+
+def scratch_thread_payload(content: str, parent_thread_id: Optional[str], purpose: str) -> Dict[str, Any]:
+    """Parámetro `thread` de `threads.create_and_run` para un hilo temporal."""
+    metadata = {"scratch": purpose}
+    if parent_thread_id:
+        metadata["parent_thread_id"] = parent_thread_id
+    return {"messages": [{"role": "user", "content": content}], "metadata": metadata}
+
+
+class ScratchThreadReaper:
+    """Apunta, borra en segundo plano y barre los hilos temporales de OpenAI."""
+
+    def __init__(self, registry: str = SCRATCH_THREAD_REGISTRY, retries: int = SCRATCH_THREAD_DELETE_RETRIES):
+        self.registry = registry
+        self.retries = retries
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        # Reintentos de borrado pendientes: heap de (no_antes_de, intento, thread_id)
+        self._delayed: List[tuple] = []
+        self._lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._collection = None
+        self._stats = {"tracked": 0, "deleted": 0, "retries": 0, "failed": 0, "swept": 0}
+
+    # -- API pública --------------------------------------------------------------
+    def track(self, thread_id: str):
+        """Apunta un hilo recién creado (la escritura en Firestore se hace en segundo plano)."""
+        self._count("tracked")
+        self._submit(("track", thread_id))
+
+    def release(self, thread_id: str):
+        """Programa el borrado del hilo. No bloquea."""
+        self._submit(("delete", thread_id))
+
+    def sweep(self, older_than_seconds: int = SCRATCH_THREAD_ORPHAN_AGE_SECONDS) -> int:
+        """Borra los hilos apuntados hace más de `older_than_seconds` (huérfanos de workers caídos)."""
+        collection = self._registry_collection()
+        if collection is None:
+            return 0
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=older_than_seconds)
+        swept = 0
+        for snap in collection.where("created_at", "<", cutoff).limit(_SWEEP_BATCH).stream():
+            if self._delete_thread(snap.id):
+                swept += 1
+        if swept:
+            logger.info(f"ScratchThreads: {swept} hilos huérfanos borrados.")
+        self._count("swept", swept)
+        return swept
+
+    def drain(self, timeout: float = SCRATCH_THREAD_DRAIN_SECONDS):
+        """Intenta vaciar la cola antes de que termine el proceso."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                action, thread_id = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if action == "track":
+                self._register(thread_id)
+            else:
+                self._delete_thread(thread_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, pending=self._queue.qsize() + len(self._delayed))
+
+    # -- Hilo de fondo ------------------------------------------------------------
+    def _submit(self, item: tuple):
+        self._ensure_worker()
+        self._queue.put(item)
+
+    def _ensure_worker(self):
+        # Tras un fork (gunicorn --preload) el hilo del padre no existe en el hijo
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._worker = threading.Thread(target=self._run, name="scratch-thread-reaper", daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        next_sweep = time.monotonic()
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, attempt, thread_id = heapq.heappop(self._delayed)
+                self._delete(thread_id, attempt)
+
+            wait = min(1.0, self._delayed[0][0] - now) if self._delayed else 1.0
+            try:
+                action, thread_id = self._queue.get(timeout=max(wait, 0.01))
+                if action == "track":
+                    self._register(thread_id)
+                else:
+                    self._delete(thread_id, 0)
+            except queue.Empty:
+                pass
+
+            if SCRATCH_THREAD_SWEEP_INTERVAL_SECONDS > 0 and time.monotonic() >= next_sweep:
+                next_sweep = time.monotonic() + SCRATCH_THREAD_SWEEP_INTERVAL_SECONDS
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.warning(f"ScratchThreads: fallo en el barrido de huérfanos: {e}")
+
+    def _delete(self, thread_id: str, attempt: int):
+        last_attempt = attempt + 1 >= self.retries
+        if self._delete_thread(thread_id, log_errors=last_attempt):
+            return
+        if last_attempt:
+            # Queda apuntado en Firestore: lo recogerá el barrido
+            self._count("failed")
+            return
+        self._count("retries")
+        heapq.heappush(self._delayed, (time.monotonic() + min(2 ** attempt, 60), attempt + 1, thread_id))
+
+    def _delete_thread(self, thread_id: str, log_errors: bool = True) -> bool:
+        from openai import NotFoundError
+
+        try:
+            client.beta.threads.delete(thread_id)
+        except NotFoundError:
+            pass
+        except Exception as e:
+            if log_errors:
+                logger.error(f"ScratchThreads: Failed to delete temp thread {thread_id}. Error: {e}")
+            return False
+        self._count("deleted")
+        self._unregister(thread_id)
+        return True
+
+    # -- Registro en Firestore ----------------------------------------------------
+    def _registry_collection(self):
+        if self.registry != "firestore":
+            return None
+        if self._collection is None:
+            from firebase_admin import firestore
+
+            self._collection = firestore.client().collection(SCRATCH_THREAD_COLLECTION)
+        return self._collection
+
+    def _register(self, thread_id: str):
+        try:
+            collection = self._registry_collection()
+            if collection is not None:
+                collection.document(thread_id).set(
+                    {
+                        "created_at": datetime.datetime.now(datetime.timezone.utc),
+                        "host": socket.gethostname(),
+                        "pid": os.getpid(),
+                    }
+                )
+        except Exception as e:
+            logger.warning(f"ScratchThreads: no se pudo apuntar el hilo {thread_id}: {e}")
+
+    def _unregister(self, thread_id: str):
+        try:
+            collection = self._registry_collection()
+            if collection is not None:
+                collection.document(thread_id).delete()
+        except Exception as e:
+            logger.warning(f"ScratchThreads: no se pudo desapuntar el hilo {thread_id}: {e}")
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._stats[name] += amount
+
+
+scratch_threads = ScratchThreadReaper()
+register_stats("scratch_threads", scratch_threads.stats)
+atexit.register(scratch_threads.drain)
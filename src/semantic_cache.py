@@ -0,0 +1,223 @@
+# src/semantic_cache.py
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from src.config import client, logger
+from src.metrics import register_stats
+
+# Caché semántica (opcional) delante de /chat_assistant: muchas preguntas son paráfrasis
+# de otras anteriores. Se calcula el embedding del mensaje, se busca por similitud coseno
+# (fuerza bruta sobre una matriz NumPy normalizada) entre las preguntas ya respondidas y,
+# si la mejor supera el umbral, se devuelve la respuesta guardada sin lanzar un run.
+#
+# Solo aplica al primer mensaje de una conversación (sin thread_id): dentro de un hilo
+# la respuesta depende del contexto previo. Se siembra con los primeros turnos del
+# historial de BigQuery de los últimos SEMANTIC_CACHE_SEED_LOOKBACK_DAYS días.
+#
+# Cada worker siembra su índice al arrancar, pero la consulta y los embeddings se hacen una
+# vez por instancia: el primer worker los guarda en SEMANTIC_CACHE_SEED_FILE (bajo un
+# flock) y los demás, y los que gunicorn recicle después, los leen de ahí mientras el
+# fichero tenga menos de SEMANTIC_CACHE_SEED_MAX_AGE_SECONDS.
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "0") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.93"))
+SEMANTIC_CACHE_MODEL = os.getenv("SEMANTIC_CACHE_MODEL", "text-embedding-3-small")
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+SEMANTIC_CACHE_SEED_LIMIT = int(os.getenv("SEMANTIC_CACHE_SEED_LIMIT", "2000"))
+SEMANTIC_CACHE_SEED_LOOKBACK_DAYS = int(os.getenv("SEMANTIC_CACHE_SEED_LOOKBACK_DAYS", "90"))
+SEMANTIC_CACHE_SEED_FILE = os.getenv(
+    "SEMANTIC_CACHE_SEED_FILE", os.path.join(tempfile.gettempdir(), "recava_semantic_cache_seed.npz")
+)
+SEMANTIC_CACHE_SEED_MAX_AGE_SECONDS = float(os.getenv("SEMANTIC_CACHE_SEED_MAX_AGE_SECONDS", "21600"))
+
+# Nombre con el que se persisten los turnos servidos desde la caché (no se re-siembran)
+SEMANTIC_CACHE_ASSISTANT_NAME = "SemanticCache"
+
+_EMBED_BATCH = 256
+
+
+def embed_texts(texts: List[str], openai_client=None):
+    """Embeddings normalizados (norma 1) como matriz float32 de forma (len(texts), dim)."""
+    import numpy as np
+
+    openai_client = openai_client or client
+    vectors = []
+    for start in range(0, len(texts), _EMBED_BATCH):
+        batch = texts[start:start + _EMBED_BATCH]
+        response = openai_client.embeddings.create(model=SEMANTIC_CACHE_MODEL, input=batch)
+        vectors.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class SemanticCache:
+    """Índice en memoria de (embedding de la pregunta, respuesta) con búsqueda por coseno."""
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._matrix = None
+        self._questions: List[str] = []
+        self._answers: List[str] = []
+        self._stats = {"hits": 0, "misses": 0, "errors": 0, "seeded": 0}
+
+    def __len__(self):
+        return len(self._answers)
+
+    def add_many(self, questions: List[str], answers: List[str], embeddings):
+        import numpy as np
+
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = embeddings
+            else:
+                self._matrix = np.vstack([self._matrix, embeddings])
+            self._questions.extend(questions)
+            self._answers.extend(answers)
+            overflow = len(self._answers) - self.max_entries
+            if overflow > 0:
+                # Se descartan las entradas más antiguas
+                self._matrix = self._matrix[overflow:]
+                del self._questions[:overflow]
+                del self._answers[:overflow]
+
+    def search(self, embedding) -> Dict[str, Any]:
+        """Mejor coincidencia para un embedding normalizado: {"score", "question", "answer"}."""
+        with self._lock:
+            if self._matrix is None or not len(self._answers):
+                return {"score": 0.0, "question": None, "answer": None}
+            scores = self._matrix @ embedding
+            best = int(scores.argmax())
+            return {"score": float(scores[best]), "question": self._questions[best], "answer": self._answers[best]}
+
+    def lookup(self, message: str, openai_client=None) -> Optional[Dict[str, Any]]:
+        """
+        Busca una respuesta para `message`. Devuelve None si no se pudo consultar; si no,
+        un dict con `answer` (None si no supera el umbral), `score`, `embedding` y `ms`.
+        """
+        started = time.monotonic()
+        try:
+            embedding = embed_texts([message], openai_client)[0]
+        except Exception as e:
+            logger.warning(f"SemanticCache: no se pudo calcular el embedding: {e}")
+            self._count("errors")
+            return None
+        match = self.search(embedding)
+        hit = match["answer"] is not None and match["score"] >= self.threshold
+        self._count("hits" if hit else "misses")
+        return {
+            "answer": match["answer"] if hit else None,
+            "score": round(match["score"], 4),
+            "embedding": embedding,
+            "ms": int((time.monotonic() - started) * 1000),
+        }
+
+    def remember(self, message: str, answer: str, embedding):
+        if not answer or embedding is None:
+            return
+        self.add_many([message], [answer], embedding.reshape(1, -1))
+
+    def seed_from_history(self, limit: int = SEMANTIC_CACHE_SEED_LIMIT):
+        """Carga los primeros turnos de /chat_assistant guardados en BigQuery (o en el fichero de la instancia)."""
+        import fcntl
+
+        with open(SEMANTIC_CACHE_SEED_FILE + ".lock", "a") as lock:
+            # Un solo worker de la instancia consulta BigQuery; el resto espera y lee el fichero
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                seed, source = _read_seed_file(), "fichero"
+                if seed is None:
+                    seed, source = _seed_from_bigquery(limit), "BigQuery"
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        questions, answers, embeddings = seed
+        if not questions:
+            return 0
+        self.add_many(questions, answers, embeddings)
+        self._count("seeded", len(questions))
+        logger.info(f"SemanticCache: {len(questions)} preguntas cargadas desde {source}.")
+        return len(questions)
+
+    def start_seeding(self):
+        """Siembra en segundo plano para no retrasar el arranque."""
+
+        def _seed():
+            try:
+                self.seed_from_history()
+            except Exception as e:
+                logger.error(f"SemanticCache: fallo sembrando desde BigQuery: {e}", exc_info=True)
+
+        threading.Thread(target=_seed, name="semantic-cache-seed", daemon=True).start()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, entries=len(self._answers), threshold=self.threshold)
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._stats[name] += amount
+
+
+def _seed_from_bigquery(limit: int):
+    """(preguntas, respuestas, embeddings) de los primeros turnos recientes; se guardan en el fichero."""
+    from src.bigquery_service import fetch_first_turns_for_endpoint
+
+    rows = fetch_first_turns_for_endpoint(
+        "/chat_assistant", "SustainabilityExpert", limit=limit, lookback_days=SEMANTIC_CACHE_SEED_LOOKBACK_DAYS
+    )
+    rows = [row for row in reversed(rows) if row["user_message"] and row["assistant_response"]]
+    if not rows:
+        return [], [], None
+    questions = [row["user_message"] for row in rows]
+    answers = [row["assistant_response"] for row in rows]
+    embeddings = embed_texts(questions)
+    try:
+        _write_seed_file(questions, answers, embeddings)
+    except OSError as e:
+        logger.warning(f"SemanticCache: no se pudo guardar la siembra en {SEMANTIC_CACHE_SEED_FILE}: {e}")
+    return questions, answers, embeddings
+
+
+def _write_seed_file(questions: List[str], answers: List[str], embeddings):
+    import numpy as np
+
+    texts = json.dumps({"questions": questions, "answers": answers}).encode("utf-8")
+    partial = SEMANTIC_CACHE_SEED_FILE + ".tmp"
+    with open(partial, "wb") as f:
+        np.savez(f, embeddings=embeddings, texts=np.frombuffer(texts, dtype=np.uint8))
+    os.replace(partial, SEMANTIC_CACHE_SEED_FILE)
+
+
+def _read_seed_file():
+    """Siembra guardada por otro worker de la instancia; None si no hay o ha caducado."""
+    import numpy as np
+
+    try:
+        if time.time() - os.path.getmtime(SEMANTIC_CACHE_SEED_FILE) > SEMANTIC_CACHE_SEED_MAX_AGE_SECONDS:
+            return None
+        with np.load(SEMANTIC_CACHE_SEED_FILE) as data:
+            texts = json.loads(data["texts"].tobytes().decode("utf-8"))
+            embeddings = data["embeddings"]
+    except (OSError, ValueError, KeyError) as e:
+        if not isinstance(e, FileNotFoundError):
+            logger.warning(f"SemanticCache: fichero de siembra ilegible, se vuelve a consultar BigQuery: {e}")
+        return None
+    return texts["questions"], texts["answers"], embeddings
+
+
+semantic_cache = SemanticCache()
+register_stats("semantic_cache", semantic_cache.stats)
+
+
+def thread_messages_for_cached_answer(user_message: str, answer: str) -> List[Dict[str, str]]:
+    """Mensajes con los que se crea el hilo de OpenAI para que los turnos siguientes tengan contexto."""
+    return [
+        {"role": "user", "content": user_message},
+        {"role": "assistant", "content": answer},
+    ]
@@ -0,0 +1,166 @@
+# src/streaming_service.py
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from src.config import logger
+from src.chat_service import MAX_TOOL_ROUNDS, TurnBudget, _cancel_pending_run
+from src.run_poller import RunPollTimeout
+from src.tool_executor import run_tool_calls
+
+# Cada cuánto se envía un comentario SSE mientras se ejecutan herramientas,
+# para que los proxies (Cloud Run / LB) no cierren una conexión "muda".
+SSE_HEARTBEAT_SECONDS = 10.0
+
+# Solo espera a cada lote de herramientas (que se reparte en el pool de src/tool_executor)
+_tool_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="sse-tools")
+
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """Serializa un evento Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def format_sse_comment(text: str = "ping") -> str:
+    """Comentario SSE (ignorado por EventSource) útil como heartbeat."""
+    return f": {text}\n\n"
+
+
+def format_sse_retry(milliseconds: int) -> str:
+    """Campo `retry:`: milisegundos que espera EventSource antes de reconectarse."""
+    return f"retry: {milliseconds}\n\n"
+
+
+def _text_from_content(content) -> str:
+    return "\n".join([block.text.value for block in (content or []) if block.type == "text"]).strip()
+
+
+_TERMINAL_STATUSES = ("completed", "failed", "cancelled", "expired", "incomplete")
+
+
+def stream_assistant_run(
+    openai_client,
+    thread_id: str,
+    assistant_id: str,
+    tool_handler: Optional[Callable[[Any, str, float], Optional[Dict[str, str]]]] = None,
+    budget: Optional[TurnBudget] = None,
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Lanza un run en modo streaming y genera tuplas (evento, payload) a medida que llegan.
+
+    Eventos emitidos: `run` (id/estado), `delta` (texto incremental), `tool` (estado de
+    herramientas), `heartbeat` (mientras se ejecutan herramientas) y `done` al final con
+    la respuesta completa. Si el run no termina en `completed` se lanza una excepción;
+    si se agota el presupuesto del turno, se cancela el run y se lanza `RunPollTimeout`
+    (se trata como un timeout).
+
+    El `timeout` de httpx solo limita cada lectura: un stream que sigue recibiendo deltas
+    no lo agota nunca. Por eso el plazo del turno se comprueba en cada evento y, si el
+    stream se queda esperando, un temporizador lo cierra al llegar el plazo.
+    """
+    budget = budget or TurnBudget()
+    manager = openai_client.beta.threads.runs.stream(
+        thread_id=thread_id,
+        assistant_id=assistant_id,
+        timeout=budget.remaining(),
+    )
+    response_text = ""
+    run = None
+    rounds = 0
+
+    while manager is not None:
+        pending_calls: List[Any] = []
+        with manager as stream:
+            watchdog = threading.Timer(budget.remaining(), stream.close)
+            watchdog.daemon = True
+            watchdog.start()
+            try:
+                for event in stream:
+                    if budget.remaining() <= 0:
+                        break
+                    kind = event.event
+                    if kind in ("thread.run.created", "thread.run.queued", "thread.run.in_progress"):
+                        run = event.data
+                        yield "run", {"run_id": run.id, "status": run.status}
+                    elif kind == "thread.message.delta":
+                        for block in event.data.delta.content or []:
+                            if block.type == "text" and block.text and block.text.value:
+                                yield "delta", {"text": block.text.value}
+                    elif kind == "thread.message.completed":
+                        text = _text_from_content(event.data.content)
+                        if text:
+                            response_text = text
+                    elif kind == "thread.run.requires_action":
+                        run = event.data
+                        pending_calls = list(run.required_action.submit_tool_outputs.tool_calls)
+                    elif kind in (
+                        "thread.run.completed",
+                        "thread.run.failed",
+                        "thread.run.cancelled",
+                        "thread.run.expired",
+                        "thread.run.incomplete",
+                    ):
+                        run = event.data
+            except Exception:
+                # Lectura cortada por el temporizador (o por httpx) con el plazo agotado
+                if budget.remaining() > 0:
+                    raise
+            finally:
+                watchdog.cancel()
+            timed_out = budget.remaining() <= 0 and (run is None or run.status not in _TERMINAL_STATUSES)
+
+        if timed_out:
+            if run is not None:
+                _cancel_pending_run(openai_client, run, thread_id)
+            raise RunPollTimeout(run, budget.seconds)
+
+        manager = None
+        if not pending_calls:
+            break
+        rounds += 1
+        if rounds > MAX_TOOL_ROUNDS:
+            openai_client.beta.threads.runs.cancel(run_id=run.id, thread_id=thread_id)
+            raise Exception(f"Run {run.id} superó el máximo de {MAX_TOOL_ROUNDS} rondas de herramientas.")
+
+        for tc in pending_calls:
+            yield "tool", {"tool_call_id": tc.id, "name": tc.function.name, "status": "started"}
+        tool_outputs = []
+        if tool_handler is not None:
+            # Las herramientas se ejecutan en paralelo; aquí solo se espera enviando heartbeats
+            future = _tool_executor.submit(
+                run_tool_calls, pending_calls, thread_id, tool_handler, budget.tool_timeout()
+            )
+            while True:
+                done, _ = wait([future], timeout=SSE_HEARTBEAT_SECONDS)
+                if done:
+                    break
+                yield "heartbeat", {}
+            tool_outputs, timings = future.result()
+            for timing in timings:
+                status = "completed" if timing["status"] == "ok" else timing["status"]
+                yield "tool", dict(timing, status=status, round=rounds)
+
+        if not tool_outputs:
+            # Sin salidas que enviar el run se quedaría en `requires_action`, bloqueando el hilo
+            _cancel_pending_run(openai_client, run, thread_id)
+            break
+        if budget.remaining() <= 0:
+            openai_client.beta.threads.runs.cancel(run_id=run.id, thread_id=thread_id)
+            raise RunPollTimeout(run, budget.seconds)
+        manager = openai_client.beta.threads.runs.submit_tool_outputs_stream(
+            thread_id=thread_id,
+            run_id=run.id,
+            tool_outputs=tool_outputs,
+            timeout=budget.remaining(),
+        )
+
+    if run is None or run.status != "completed":
+        status = getattr(run, "status", None)
+        raise Exception(f"Run ended with status={status}. Details: {getattr(run, 'last_error', None)}")
+
+    if not response_text:
+        logger.warning(f"SSE: No new response from assistant found for run {run.id}.")
+        response_text = "No se pudo obtener una nueva respuesta del asistente."
+
+    yield "done", {"response": response_text, "thread_id": thread_id, "run_id": run.id, "run_status": run.status}
@@ -0,0 +1,241 @@
+# src/thread_lease.py
+import asyncio
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, Optional, Tuple
+
+from src.config import logger
+from src.metrics import register_stats
+from src.timing import timed
+
+# Un solo turno a la vez por hilo. OpenAI no admite añadir un mensaje a un hilo con un run
+# activo, así que un doble envío sobre el mismo `thread_id` acababa en error tras una ida y
+# vuelta inútil o, peor, en dos runs compitiendo. Antes de lanzar el run se toma un
+# "lease" del hilo en Firestore (`thread_leases/{thread_id}`) dentro de una transacción:
+#
+#   - hilo libre (o lease caducado): se toma y se lanza el run;
+#   - hilo ocupado: con THREAD_BUSY_MODE=reject se responde 409 enseguida; con "queue"
+#     la petición espera hasta THREAD_QUEUE_WAIT_SECONDS a que se libere.
+#
+# Los reintentos del mismo mensaje (misma `Idempotency-Key`) no llegan hasta aquí: los
+# resuelve antes src/idempotency.py con la respuesta del run original.
+#
+# El lease caduca a los THREAD_LEASE_SECONDS (más que el plazo de un turno), así que un
+# worker que muere con el hilo tomado no lo bloquea para siempre.
+# THREAD_LEASE_BACKEND=local aplica lo mismo en memoria (una sola instancia, desarrollo) y
+# "none" lo desactiva.
+
+THREAD_LEASE_BACKEND = os.getenv("THREAD_LEASE_BACKEND", "firestore")  # "firestore" | "local" | "none"
+THREAD_LEASE_COLLECTION = os.getenv("THREAD_LEASE_COLLECTION", "thread_leases")
+THREAD_LEASE_SECONDS = float(os.getenv("THREAD_LEASE_SECONDS", "150"))
+THREAD_BUSY_MODE = os.getenv("THREAD_BUSY_MODE", "reject")  # "reject" | "queue"
+THREAD_QUEUE_WAIT_SECONDS = float(os.getenv("THREAD_QUEUE_WAIT_SECONDS", "30"))
+THREAD_LEASE_POLL_SECONDS = float(os.getenv("THREAD_LEASE_POLL_SECONDS", "0.5"))
+
+# Resultados de un intento de tomar el lease
+ACQUIRED = "acquired"
+BUSY = "busy"
+
+
+class ThreadBusy(Exception):
+    """El hilo tiene otro turno en curso."""
+
+    def __init__(self, thread_id: str, retry_after: int):
+        super().__init__(f"hilo {thread_id} ocupado")
+        self.thread_id = thread_id
+        self.retry_after = retry_after
+
+
+class ThreadLease:
+    """Turno tomado sobre un hilo."""
+
+    def __init__(self, thread_id: Optional[str], holder: Optional[str]):
+        self.thread_id = thread_id
+        self.holder = holder
+
+    @classmethod
+    def unguarded(cls) -> "ThreadLease":
+        """Turno sin lease (hilo recién creado por esta misma petición)."""
+        return cls(None, None)
+
+
+def _decide(current: Optional[Dict[str, Any]], now: float) -> Tuple[str, Optional[int]]:
+    """Qué hacer con el lease actual del hilo. Devuelve (resultado, segundos hasta que caduque)."""
+    current = current or {}
+    if current.get("holder") and float(current.get("expires_at") or 0) > now:
+        return BUSY, max(1, int(float(current["expires_at"]) - now))
+    return ACQUIRED, None
+
+
+def _lease_document(holder: str, uid: str, now: float, ttl: float) -> Dict[str, Any]:
+    return {"holder": holder, "uid": uid, "acquired_at": now, "expires_at": now + ttl}
+
+
+def _released_document(now: float) -> Dict[str, Any]:
+    return {"holder": None, "released_at": now}
+
+
+class ThreadLeases:
+    """Leases de hilos en Firestore (o en memoria) con espera opcional."""
+
+    def __init__(
+        self,
+        backend: str = THREAD_LEASE_BACKEND,
+        ttl_seconds: float = THREAD_LEASE_SECONDS,
+        busy_mode: str = THREAD_BUSY_MODE,
+        wait_seconds: float = THREAD_QUEUE_WAIT_SECONDS,
+        poll_seconds: float = THREAD_LEASE_POLL_SECONDS,
+    ):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.busy_mode = busy_mode
+        self.wait_seconds = wait_seconds
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._local: Dict[str, Dict[str, Any]] = {}
+        self._db = None
+        self._stats = {"acquired": 0, "waited": 0, "rejected": 0, "released": 0, "errors": 0}
+
+    # -- API pública --------------------------------------------------------------
+    def acquire(self, thread_id: str, uid: str, ttl_seconds: Optional[float] = None) -> ThreadLease:
+        """Toma el turno del hilo, esperando si procede. Lanza ThreadBusy si no se consigue.
+
+        `ttl_seconds` alarga el lease para turnos con más plazo que el normal (jobs en segundo plano).
+        """
+        deadline = time.monotonic() + self.wait_seconds
+        waited = False
+        while True:
+            holder = uuid.uuid4().hex
+            try:
+                outcome, value = self._try_acquire(thread_id, uid, holder, ttl_seconds or self.ttl_seconds)
+            except Exception as e:
+                return self._unavailable(thread_id, e)
+            lease = self._handle(outcome, value, thread_id, holder, deadline, waited)
+            if lease is not None:
+                return lease
+            waited = True
+            time.sleep(self._pause(deadline))
+
+    async def aacquire(self, thread_id: str, uid: str) -> ThreadLease:
+        """Versión asyncio de `acquire`: la espera no bloquea el bucle de eventos."""
+        deadline = time.monotonic() + self.wait_seconds
+        waited = False
+        while True:
+            holder = uuid.uuid4().hex
+            try:
+                outcome, value = await asyncio.to_thread(
+                    self._try_acquire, thread_id, uid, holder, self.ttl_seconds
+                )
+            except Exception as e:
+                return self._unavailable(thread_id, e)
+            lease = self._handle(outcome, value, thread_id, holder, deadline, waited)
+            if lease is not None:
+                return lease
+            waited = True
+            await asyncio.sleep(self._pause(deadline))
+
+    def release(self, lease: ThreadLease):
+        """Libera el turno. No lanza excepciones."""
+        if lease.holder is None or self.backend == "none":
+            return
+        try:
+            if self.backend == "local":
+                with self._lock:
+                    current = self._local.get(lease.thread_id)
+                    if current and current.get("holder") == lease.holder:
+                        current.update(_released_document(time.time()))
+            else:
+                self._release_firestore(lease)
+            self._count("released")
+        except Exception as e:
+            # El lease caducará solo a los THREAD_LEASE_SECONDS
+            self._count("errors")
+            logger.error(f"ThreadLease: no se pudo liberar el hilo {lease.thread_id}: {e}", exc_info=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats)
+
+    # -- Internos -------------------------------------------------------------------
+    def _handle(self, outcome, value, thread_id, holder, deadline, waited) -> Optional[ThreadLease]:
+        """Convierte un intento en lease, en espera (None) o en ThreadBusy."""
+        if outcome == ACQUIRED:
+            self._count("acquired")
+            if waited:
+                self._count("waited")
+            return ThreadLease(thread_id, holder)
+        if self.busy_mode != "queue" or time.monotonic() >= deadline:
+            self._count("rejected")
+            raise ThreadBusy(thread_id, value)
+        return None
+
+    def _unavailable(self, thread_id: str, error: Exception) -> ThreadLease:
+        # Fail open: sin Firestore el turno sigue adelante sin protección (como antes)
+        self._count("errors")
+        logger.warning(f"ThreadLease: no se pudo tomar el hilo {thread_id}, se sigue sin lease: {error}")
+        return ThreadLease.unguarded()
+
+    def _pause(self, deadline: float) -> float:
+        return max(0.0, min(self.poll_seconds, deadline - time.monotonic()))
+
+    def _try_acquire(self, thread_id: str, uid: str, holder: str, ttl_seconds: float) -> Tuple[str, Optional[int]]:
+        if self.backend == "none":
+            return ACQUIRED, None
+        if self.backend == "local":
+            with self._lock:
+                now = time.time()
+                current = self._local.get(thread_id)
+                outcome, value = _decide(current, now)
+                if outcome == ACQUIRED:
+                    self._local[thread_id] = _lease_document(holder, uid, now, ttl_seconds)
+                return outcome, value
+        return self._try_acquire_firestore(thread_id, uid, holder, ttl_seconds)
+
+    def _client(self):
+        if self._db is None:
+            from firebase_admin import firestore
+
+            self._db = firestore.client()
+        return self._db
+
+    @timed("fs_lease", "firestore")
+    def _try_acquire_firestore(self, thread_id, uid, holder, ttl_seconds) -> Tuple[str, Optional[int]]:
+        from firebase_admin import firestore
+
+        ref = self._client().collection(THREAD_LEASE_COLLECTION).document(thread_id)
+
+        @firestore.transactional
+        def attempt(transaction):
+            snap = ref.get(transaction=transaction)
+            now = time.time()
+            outcome, value = _decide(snap.to_dict() if snap.exists else None, now)
+            if outcome == ACQUIRED:
+                transaction.set(ref, _lease_document(holder, uid, now, ttl_seconds))
+            return outcome, value
+
+        return attempt(self._client().transaction())
+
+    @timed("fs_lease", "firestore")
+    def _release_firestore(self, lease: ThreadLease):
+        from firebase_admin import firestore
+
+        ref = self._client().collection(THREAD_LEASE_COLLECTION).document(lease.thread_id)
+
+        @firestore.transactional
+        def release(transaction):
+            snap = ref.get(transaction=transaction)
+            # Si el lease caducó y lo tomó otra petición, ya no es nuestro
+            if snap.exists and (snap.to_dict() or {}).get("holder") == lease.holder:
+                transaction.update(ref, _released_document(time.time()))
+
+        release(self._client().transaction())
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._stats[name] += amount
+
+
+thread_leases = ThreadLeases()
+register_stats("thread_leases", thread_leases.stats)
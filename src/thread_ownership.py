@@ -0,0 +1,105 @@
+# src/thread_ownership.py
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP
+
+from src.config import logger
+from src.history_store import HISTORY_COMPLETE_FIELD, history_store
+from src.metrics import register_stats
+from src.timing import span
+
+# Propiedad de los hilos (`threads/{thread_id}.uid`). Una vez fijado, el dueño de un hilo
+# no cambia, así que cada worker recuerda los dueños ya leídos durante
+# THREAD_OWNER_CACHE_TTL_SECONDS y las comprobaciones siguientes no leen Firestore. Los
+# hilos que crea el propio servicio se registran sin lectura previa (el id acaba de
+# generarlo OpenAI) y la escritura sale del camino de la respuesta.
+
+THREAD_OWNER_CACHE_TTL_SECONDS = float(os.getenv("THREAD_OWNER_CACHE_TTL_SECONDS", "600"))
+THREAD_OWNER_CACHE_MAX_ENTRIES = int(os.getenv("THREAD_OWNER_CACHE_MAX_ENTRIES", "20000"))
+
+_registrar = ThreadPoolExecutor(max_workers=2, thread_name_prefix="thread-owner")
+
+
+def owner_from_snapshot(snap) -> Optional[str]:
+    if snap is None or not snap.exists:
+        return None
+    return (snap.to_dict() or {}).get("uid")
+
+
+class ThreadOwnerCache:
+    """LRU de thread_id -> uid con caducidad."""
+
+    def __init__(self, ttl_seconds: float = THREAD_OWNER_CACHE_TTL_SECONDS, max_entries: int = THREAD_OWNER_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "registered": 0, "register_errors": 0}
+
+    def get(self, thread_id: str) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(thread_id)
+            if entry is None or entry[1] <= now:
+                self._entries.pop(thread_id, None)
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(thread_id)
+            self._stats["hits"] += 1
+            return entry[0]
+
+    def put(self, thread_id: str, uid: str):
+        if not uid or self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[thread_id] = (uid, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(thread_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._stats[name] += amount
+
+
+thread_owners = ThreadOwnerCache()
+register_stats("thread_owners", thread_owners.stats)
+
+
+def owner_document(uid: str) -> Dict[str, Any]:
+    """Datos con los que se registra un hilo nuevo."""
+    return {"uid": uid, "created_at": SERVER_TIMESTAMP}
+
+
+def register_new_thread(thread_id: str, uid: str):
+    """Registra un hilo recién creado por este servicio. No lee Firestore ni bloquea."""
+    thread_owners.put(thread_id, uid)
+    _registrar.submit(_write_owner, thread_id, uid)
+
+
+def _write_owner(thread_id: str, uid: str):
+    try:
+        with span("fs_thread_owner", "firestore"):
+            # Hilo nuevo: el almacén de historial recibe todos sus turnos desde el primero
+            data = dict(owner_document(uid), **{HISTORY_COMPLETE_FIELD: True})
+            history_store.thread_ref(thread_id).set(data, merge=True)
+        thread_owners._count("registered")
+    except Exception as e:
+        # Sin el documento, la próxima comprobación (en otro worker) lo vuelve a registrar
+        thread_owners._count("register_errors")
+        logger.error(f"ThreadOwnership: no se pudo registrar el hilo {thread_id}: {e}", exc_info=True)
+        return
+    try:
+        history_store.mark_user_coverage(uid, thread_id)
+    except Exception as e:
+        # Sin la marca, sus recientes se siguen leyendo de BigQuery; se reintenta con su próximo hilo
+        logger.warning(f"ThreadOwnership: no se pudo comprobar el historial del usuario {uid}: {e}")
@@ -0,0 +1,151 @@
+# src/thread_summary.py
+import datetime
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from google.api_core.exceptions import NotFound
+
+from src.config import bq_client, logger
+from src.bigquery_schema import build_thread_summary_table, chat_history_table_id, thread_summary_table_id
+
+# Tabla de resumen por hilo en BigQuery (uid, thread_id, endpoint_source, first_message,
+# last_timestamp, turn_count) para que /chat_history/recents no agregue todos los turnos
+# del usuario en cada llamada. La mantiene un MERGE incremental programado
+# (scripts/refresh_thread_summary.py) que solo lee las particiones recientes de la tabla
+# de turnos. Cada refresco deja en la etiqueta `refreshed_at` de la tabla el instante
+# hasta el que cubre; las lecturas completan el resumen con los turnos posteriores (ver
+# `fetch_recent_conversations_for_user`) y, si el resumen está viejo, usan la consulta
+# original sobre los turnos.
+
+THREAD_SUMMARY_ENABLED = os.getenv("THREAD_SUMMARY_ENABLED", "1") == "1"
+# Más antiguo que esto, el resumen se ignora (el refresco programado no está corriendo)
+THREAD_SUMMARY_MAX_STALENESS_SECONDS = float(os.getenv("THREAD_SUMMARY_MAX_STALENESS_SECONDS", "3600"))
+# Margen para turnos que llegan a BigQuery con retraso (escritura en lote, spool)
+THREAD_SUMMARY_LAG_SECONDS = float(os.getenv("THREAD_SUMMARY_LAG_SECONDS", "300"))
+# Cada proceso consulta la etiqueta `refreshed_at` como mucho una vez por este intervalo
+THREAD_SUMMARY_STATE_TTL_SECONDS = float(os.getenv("THREAD_SUMMARY_STATE_TTL_SECONDS", "60"))
+
+_REFRESHED_AT_LABEL = "refreshed_at"
+
+_state: Dict[str, Any] = {"checked": 0.0, "refreshed_at": None}
+_state_lock = threading.Lock()
+
+
+def summary_refreshed_at() -> Optional[datetime.datetime]:
+    """Instante que cubre el último refresco del resumen (cacheado); None si no hay resumen."""
+    now = time.monotonic()
+    with _state_lock:
+        if now - _state["checked"] < THREAD_SUMMARY_STATE_TTL_SECONDS:
+            return _state["refreshed_at"]
+    refreshed_at = None
+    try:
+        label = (bq_client.get_table(thread_summary_table_id()).labels or {}).get(_REFRESHED_AT_LABEL)
+        if label:
+            refreshed_at = datetime.datetime.fromtimestamp(int(label), tz=datetime.timezone.utc)
+    except NotFound:
+        pass
+    except Exception as e:
+        logger.warning("ThreadSummary: could not read the summary table state: %s", e)
+    with _state_lock:
+        _state.update(checked=now, refreshed_at=refreshed_at)
+    return refreshed_at
+
+
+def fresh_summary_watermark() -> Optional[datetime.datetime]:
+    """Desde cuándo hay que completar el resumen con turnos; None si no se debe usar."""
+    if not THREAD_SUMMARY_ENABLED:
+        return None
+    refreshed_at = summary_refreshed_at()
+    if refreshed_at is None:
+        return None
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if (now - refreshed_at).total_seconds() > THREAD_SUMMARY_MAX_STALENESS_SECONDS:
+        return None
+    return refreshed_at - datetime.timedelta(seconds=THREAD_SUMMARY_LAG_SECONDS)
+
+
+def _merge_query(turns_fqn: str, summary_fqn: str, incremental: bool) -> str:
+    since_filter = "AND d.timestamp >= @since" if incremental else ""
+    # Solo cuentan como turnos nuevos los posteriores al último ya resumido, así que la
+    # ventana de solape no duplica `turn_count`. El primer mensaje se sustituye si llega
+    # un turno más antiguo que el que lo fijó.
+    return f"""
+        MERGE {summary_fqn} AS s
+        USING (
+            SELECT
+                d.uid,
+                d.thread_id,
+                ANY_VALUE(d.endpoint_source) AS endpoint_source,
+                SUBSTR(COALESCE(
+                    ARRAY_AGG(d.user_message IGNORE NULLS ORDER BY d.timestamp ASC LIMIT 1)[SAFE_OFFSET(0)],
+                    ARRAY_AGG(d.assistant_response IGNORE NULLS ORDER BY d.timestamp ASC LIMIT 1)[SAFE_OFFSET(0)]
+                ), 1, 1000) AS first_message,
+                MIN(d.timestamp) AS first_timestamp,
+                MAX(d.timestamp) AS last_timestamp,
+                COUNTIF(p.last_timestamp IS NULL OR d.timestamp > p.last_timestamp) AS new_turns
+            FROM {turns_fqn} AS d
+            LEFT JOIN {summary_fqn} AS p ON p.uid = d.uid AND p.thread_id = d.thread_id
+            WHERE d.uid IS NOT NULL AND d.thread_id IS NOT NULL {since_filter}
+            GROUP BY d.uid, d.thread_id
+        ) AS n
+        ON s.uid = n.uid AND s.thread_id = n.thread_id
+        WHEN MATCHED THEN UPDATE SET
+            endpoint_source = COALESCE(s.endpoint_source, n.endpoint_source),
+            first_message = IF(n.first_timestamp < s.first_timestamp, COALESCE(n.first_message, s.first_message), COALESCE(s.first_message, n.first_message)),
+            first_timestamp = LEAST(IFNULL(s.first_timestamp, n.first_timestamp), n.first_timestamp),
+            last_timestamp = GREATEST(IFNULL(s.last_timestamp, n.last_timestamp), n.last_timestamp),
+            turn_count = s.turn_count + n.new_turns,
+            updated_at = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN
+            INSERT (uid, thread_id, endpoint_source, first_message, first_timestamp, last_timestamp, turn_count, updated_at)
+            VALUES (n.uid, n.thread_id, n.endpoint_source, n.first_message, n.first_timestamp, n.last_timestamp, n.new_turns, CURRENT_TIMESTAMP())
+    """
+
+
+def refresh_thread_summaries(full: bool = False, overlap_hours: float = 24.0, client=None) -> Dict[str, Any]:
+    """
+    Actualiza el resumen con los turnos de las últimas `overlap_hours` horas desde el
+    refresco anterior. `full` (o un resumen sin refrescos previos) lo reconstruye entero
+    en una transacción, sin que los lectores vean la tabla vacía.
+    """
+    from google.cloud import bigquery
+
+    client = client or bq_client
+    summary_id = thread_summary_table_id()
+    turns_fqn, summary_fqn = f"`{chat_history_table_id()}`", f"`{summary_id}`"
+    started = datetime.datetime.now(datetime.timezone.utc)
+
+    table = client.create_table(build_thread_summary_table(summary_id), exists_ok=True)
+    label = (table.labels or {}).get(_REFRESHED_AT_LABEL)
+    incremental = bool(label) and not full
+
+    params = []
+    merge = _merge_query(turns_fqn, summary_fqn, incremental)
+    if incremental:
+        since = datetime.datetime.fromtimestamp(int(label), tz=datetime.timezone.utc) - datetime.timedelta(hours=overlap_hours)
+        params.append(bigquery.ScalarQueryParameter("since", "TIMESTAMP", since))
+        script = merge
+    else:
+        since = None
+        script = f"BEGIN TRANSACTION; DELETE FROM {summary_fqn} WHERE TRUE; {merge}; COMMIT TRANSACTION;"
+
+    job = client.query(script, job_config=bigquery.QueryJobConfig(query_parameters=params))
+    job.result()
+
+    # Se marca el inicio del refresco: los turnos que llegaron durante el MERGE quedan
+    # dentro de la ventana de la lectura y del siguiente refresco
+    table = client.get_table(summary_id)
+    table.labels = dict(table.labels or {}, **{_REFRESHED_AT_LABEL: str(int(started.timestamp()))})
+    client.update_table(table, ["labels"])
+
+    result = {
+        "table": summary_id,
+        "mode": "incremental" if incremental else "full",
+        "since": since.isoformat() if since else None,
+        "bytes_processed": job.total_bytes_processed,
+        "seconds": round((datetime.datetime.now(datetime.timezone.utc) - started).total_seconds(), 1),
+    }
+    logger.info("ThreadSummary: refreshed %s", result)
+    return result
@@ -0,0 +1,161 @@
+# src/timing.py
+import contextvars
+import functools
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.config import logger
+from src.metrics import observe_stage
+
+# Tiempos por etapa de cada petición. El código marca sus etapas con `span("nombre")` y
+# al terminar la petición se emiten:
+#
+#   - en la cabecera `Server-Timing` (visible en las DevTools del navegador), p. ej.
+#     `auth;dur=0.4, ownership;dur=31.0, run;dur=5210.3, total;dur=5290.1`;
+#   - en el log `request_end` (campo `stages`, ms por etapa);
+#   - como spans de OpenTelemetry, si OTEL_EXPORTER_OTLP_ENDPOINT apunta a un colector
+#     (requiere `opentelemetry-sdk` y `opentelemetry-exporter-otlp-proto-http`).
+#
+# La petición en curso se guarda en un contextvar: vale igual para los hilos de Flask y
+# para las tareas asyncio (y `asyncio.to_thread` lo hereda). Las etapas que corren en
+# pools de hilos propios (herramientas, escrituras en segundo plano) no cuentan aquí;
+# las herramientas ya tienen sus tiempos en `meta.tools`. Fuera de una petición `span`
+# solo alimenta las métricas de src/metrics.py (que cuentan todas las etapas, también las
+# de jobs y escrituras en segundo plano).
+
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "1") == "1"
+OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "recava-auditor-backend")
+
+_current: "contextvars.ContextVar[Optional[RequestTiming]]" = contextvars.ContextVar("request_timing", default=None)
+_tracer = None
+
+
+class RequestTiming:
+    """Etapas medidas durante una petición."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.stages: List[Tuple[str, float]] = []
+        self._otel_span = None
+        self._otel_token = None
+
+    def add(self, stage: str, ms: float):
+        self.stages.append((stage, ms))
+
+    def totals(self) -> Dict[str, float]:
+        """ms por etapa (las repetidas se suman), en el orden en que aparecieron."""
+        totals: Dict[str, float] = {}
+        for stage, ms in self.stages:
+            totals[stage] = totals.get(stage, 0.0) + ms
+        return {stage: round(ms, 1) for stage, ms in totals.items()}
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self) -> str:
+        parts = [f"{stage};dur={ms}" for stage, ms in self.totals().items()]
+        parts.append(f"total;dur={round(self.elapsed_ms(), 1)}")
+        return ", ".join(parts)
+
+
+def configure_tracing():
+    """Activa la exportación OTLP si hay colector configurado y el SDK está instalado."""
+    global _tracer
+    if not OTEL_EXPORTER_OTLP_ENDPOINT or _tracer is not None:
+        return
+    try:
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError as e:
+        logger.warning(f"Timing: OTEL_EXPORTER_OTLP_ENDPOINT definido pero falta el SDK de OpenTelemetry: {e}")
+        return
+    provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+    # El exportador lee OTEL_EXPORTER_OTLP_ENDPOINT (y el resto de OTEL_*) del entorno
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer("recava.timing")
+    logger.info(f"Timing: exportando spans a {OTEL_EXPORTER_OTLP_ENDPOINT}")
+
+
+def start_request(name: str, **attributes: Any) -> RequestTiming:
+    """Empieza a medir una petición en el contexto actual."""
+    timing = RequestTiming(name)
+    _current.set(timing)
+    if _tracer is not None:
+        from opentelemetry import context, trace
+
+        timing._otel_span = _tracer.start_span(name, attributes=attributes)
+        timing._otel_token = context.attach(trace.set_span_in_context(timing._otel_span))
+    return timing
+
+
+def end_request(timing: Optional[RequestTiming], status_code: Optional[int] = None):
+    """Cierra la medición (y el span raíz de OpenTelemetry, si lo hay)."""
+    if timing is None:
+        return
+    if timing._otel_span is not None:
+        from opentelemetry import context
+
+        if status_code is not None:
+            timing._otel_span.set_attribute("http.status_code", status_code)
+        timing._otel_span.end()
+        try:
+            context.detach(timing._otel_token)
+        except Exception:
+            # Un stream puede cerrarse en otro contexto que el que lo abrió
+            pass
+        timing._otel_span = None
+    if _current.get() is timing:
+        _current.set(None)
+
+
+def current_request() -> Optional[RequestTiming]:
+    return _current.get()
+
+
+@contextmanager
+def span(stage: str, upstream: Optional[str] = None, **attributes: Any):
+    """Mide una etapa. `upstream` (firestore, bigquery, openai) etiqueta la llamada en /metrics."""
+    timing = _current.get()
+    otel_span = None
+    if timing is not None and _tracer is not None:
+        if upstream:
+            attributes["upstream"] = upstream
+        otel_span = _tracer.start_as_current_span(stage, attributes=attributes)
+    started = time.perf_counter()
+    error = False
+    try:
+        if otel_span is None:
+            yield
+        else:
+            with otel_span:
+                yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        if timing is not None:
+            timing.add(stage, seconds * 1000)
+        observe_stage(stage, upstream, seconds, error)
+
+
+def timed(stage: str, upstream: Optional[str] = None):
+    """Decorador: mide cada llamada a la función como la etapa `stage`."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage, upstream):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,167 @@
+# src/tool_executor.py
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.config import logger
+from src.metrics import observe_tool, register_stats
+
+# Las tool calls de un mismo paso `requires_action` son independientes entre sí (cada
+# consulta al experto usa su propio hilo temporal), así que se ejecutan a la vez. Los
+# tool_outputs se devuelven en el mismo orden que las tool calls.
+#
+# Un handler es `handler(tool_call, thread_id, deadline)`; `deadline` es el instante
+# (`time.monotonic()`) en que vence el plazo de la llamada, que sale del plazo del turno.
+
+TOOL_CALL_MAX_WORKERS = int(os.getenv("TOOL_CALL_MAX_WORKERS", "8"))
+TOOL_CALL_TIMEOUT_SECONDS = float(os.getenv("TOOL_CALL_TIMEOUT_SECONDS", "90"))
+# Margen tras el plazo antes de dar la llamada por perdida: el handler se detiene solo al
+# llegar a su `deadline` (el experto cancela su run) y así le da tiempo a devolver su salida
+# y liberar el hilo del pool.
+TOOL_CALL_GRACE_SECONDS = float(os.getenv("TOOL_CALL_GRACE_SECONDS", "2"))
+
+TOOL_TIMEOUT_OUTPUT = "ERROR_TOOL_TIMEOUT: La herramienta no respondió a tiempo."
+TOOL_ERROR_OUTPUT = "ERROR_TOOL: La herramienta falló al ejecutarse."
+
+_executor = ThreadPoolExecutor(max_workers=TOOL_CALL_MAX_WORKERS, thread_name_prefix="tool-calls")
+
+# "cancelled": llamadas vencidas que aún esperaban en la cola del pool (no llegan a
+# ejecutarse). "abandoned": vencidas ya en ejecución, que no se pueden cancelar y siguen
+# ocupando un hilo del pool hasta que terminan; "abandoned_running" es cuántas siguen así.
+_stats = {"calls": 0, "timeouts": 0, "cancelled": 0, "abandoned": 0}
+_abandoned_running = 0
+_stats_lock = threading.Lock()
+
+
+def _count(name: str):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def _abandon(future):
+    """Registra una llamada vencida que sigue en ejecución hasta que termine por sí misma."""
+    global _abandoned_running
+    with _stats_lock:
+        _stats["abandoned"] += 1
+        _abandoned_running += 1
+    future.add_done_callback(_abandoned_done)
+
+
+def _abandoned_done(_future):
+    global _abandoned_running
+    with _stats_lock:
+        _abandoned_running -= 1
+
+
+def stats() -> Dict[str, Any]:
+    with _stats_lock:
+        return dict(_stats, abandoned_running=_abandoned_running, max_workers=TOOL_CALL_MAX_WORKERS)
+
+
+register_stats("tool_calls", stats)
+
+
+def _settle(tool_call, elapsed: float, status, output) -> Tuple[Optional[Dict[str, str]], Dict[str, Any]]:
+    """Normaliza el resultado de una tool call: (tool_output o None, tiempos)."""
+    if status == "timeout":
+        output = {"tool_call_id": tool_call.id, "output": TOOL_TIMEOUT_OUTPUT}
+    elif status == "error":
+        output = {"tool_call_id": tool_call.id, "output": TOOL_ERROR_OUTPUT}
+    elif output is None:
+        status = "unsupported"
+    timing = {
+        "tool_call_id": tool_call.id,
+        "name": tool_call.function.name,
+        "ms": int(elapsed * 1000),
+        "status": status,
+    }
+    observe_tool(timing["name"], status, elapsed)
+    return output, timing
+
+
+def _timed_call(tool_handler, tool_call, thread_id, deadline):
+    started = time.monotonic()
+    output = tool_handler(tool_call, thread_id, deadline)
+    return output, time.monotonic() - started
+
+
+def run_tool_calls(
+    tool_calls,
+    thread_id: str,
+    tool_handler,
+    timeout: float = TOOL_CALL_TIMEOUT_SECONDS,
+) -> Tuple[List[Dict[str, str]], List[Dict[str, Any]]]:
+    """
+    Ejecuta las tool calls en paralelo. Devuelve (tool_outputs en orden, tiempos por
+    herramienta). Cada handler recibe el plazo absoluto (`time.monotonic()`) para
+    detenerse por sí mismo: un hilo del pool no se puede interrumpir desde fuera.
+    """
+    started = time.monotonic()
+    deadline = started + timeout
+    futures = [_executor.submit(_timed_call, tool_handler, tc, thread_id, deadline) for tc in tool_calls]
+
+    outputs, timings = [], []
+    for tc, future in zip(tool_calls, futures):
+        _count("calls")
+        output, status = None, "ok"
+        try:
+            output, elapsed = future.result(timeout=max(0.0, deadline + TOOL_CALL_GRACE_SECONDS - time.monotonic()))
+        except FutureTimeout:
+            status = "timeout"
+            _count("timeouts")
+            # `cancel()` solo funciona si la llamada no ha empezado
+            if future.cancel():
+                _count("cancelled")
+                logger.warning(f"Tool ({tc.function.name}): sin empezar tras {timeout:.1f}s; cancelada (call {tc.id}).")
+            else:
+                _abandon(future)
+                logger.warning(
+                    f"Tool ({tc.function.name}): sin respuesta tras {timeout:.1f}s; sigue en ejecución y ocupa un "
+                    f"hilo del pool hasta que termine (call {tc.id}, {stats()['abandoned_running']} así)."
+                )
+        except Exception as e:
+            status = "error"
+            logger.error(f"Tool ({tc.function.name}): Exception: {e}", exc_info=True)
+        if status != "ok":
+            elapsed = time.monotonic() - started
+        output, timing = _settle(tc, elapsed, status, output)
+        if output is not None:
+            outputs.append(output)
+        timings.append(timing)
+    return outputs, timings
+
+
+async def arun_tool_calls(
+    tool_calls,
+    thread_id: str,
+    tool_handler,
+    timeout: float = TOOL_CALL_TIMEOUT_SECONDS,
+) -> Tuple[List[Dict[str, str]], List[Dict[str, Any]]]:
+    """Variante asyncio de `run_tool_calls` para handlers asíncronos."""
+
+    deadline = time.monotonic() + timeout
+
+    async def _one(tc):
+        _count("calls")
+        started = time.monotonic()
+        output, status = None, "ok"
+        try:
+            # La corrutina sí se cancela al vencer, pero antes se le deja el margen para que
+            # cancele ella misma su run de OpenAI
+            output = await asyncio.wait_for(tool_handler(tc, thread_id, deadline), timeout=timeout + TOOL_CALL_GRACE_SECONDS)
+        except asyncio.TimeoutError:
+            status = "timeout"
+            _count("timeouts")
+            logger.warning(f"Tool ({tc.function.name}): sin respuesta tras {timeout:.1f}s (call {tc.id}).")
+        except Exception as e:
+            status = "error"
+            logger.error(f"Tool ({tc.function.name}): Exception: {e}", exc_info=True)
+        return _settle(tc, time.monotonic() - started, status, output)
+
+    results = await asyncio.gather(*[_one(tc) for tc in tool_calls])
+    outputs = [output for output, _ in results if output is not None]
+    timings = [timing for _, timing in results]
+    return outputs, timings
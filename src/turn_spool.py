@@ -0,0 +1,112 @@
+# src/turn_spool.py
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+# Cola persistente (write-ahead) de turnos pendientes de escribir en BigQuery: una base
+# SQLite en modo WAL dentro de BIGQUERY_SPOOL_DIR. Añadir un turno es un INSERT local;
+# `src/bigquery_writer.py` los reclama en lotes, los envía y los borra cuando BigQuery
+# los ha aceptado. Si BigQuery falla, los turnos se quedan en disco y se reintentan.
+#
+# Varios workers de gunicorn comparten el mismo fichero. Reclamar un lote no lo borra:
+# solo lo oculta durante `lease_seconds`; si el worker muere antes de confirmarlo, otro
+# lo vuelve a enviar (al menos una vez; el `insert_id` evita duplicados en el spool y
+# BigQuery deduplica los reenvíos cercanos por `insertId`).
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    insert_id TEXT NOT NULL UNIQUE,
+    row TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL
+)
+"""
+
+
+class TurnSpool:
+    """Cola de filas en SQLite (WAL) con reclamación por lease."""
+
+    def __init__(self, directory: str, lease_seconds: float = 60.0):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "turns.db")
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        with self._lock:
+            self._connection()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Una conexión por proceso: no se pueden heredar tras un fork
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # En WAL, NORMAL sobrevive a la caída del proceso sin un fsync por turno
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(_SCHEMA)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def append(self, insert_id: str, row: Dict[str, Any]):
+        """Guarda una fila. Si ya existe otra con el mismo `insert_id`, se ignora."""
+        now = time.time()
+        with self._lock:
+            self._connection().execute(
+                "INSERT OR IGNORE INTO turns (insert_id, row, created_at, available_at) VALUES (?, ?, ?, ?)",
+                (insert_id, json.dumps(row, ensure_ascii=False), now, now),
+            )
+
+    def claim(self, limit: int) -> List[Tuple[int, str, Dict[str, Any]]]:
+        """Reclama hasta `limit` filas disponibles: [(seq, insert_id, row)]."""
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT seq, insert_id, row FROM turns WHERE available_at <= ? ORDER BY seq LIMIT ?",
+                    (now, limit),
+                ).fetchall()
+                if rows:
+                    conn.executemany(
+                        "UPDATE turns SET available_at = ?, attempts = attempts + 1 WHERE seq = ?",
+                        [(now + self.lease_seconds, seq) for seq, _, _ in rows],
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return [(seq, insert_id, json.loads(row)) for seq, insert_id, row in rows]
+
+    def ack(self, seqs: List[int]):
+        """Borra las filas ya escritas (o descartadas)."""
+        if not seqs:
+            return
+        with self._lock:
+            self._connection().executemany("DELETE FROM turns WHERE seq = ?", [(seq,) for seq in seqs])
+
+    def release(self, seqs: List[int], delay: float):
+        """Devuelve filas reclamadas a la cola para reintentarlas dentro de `delay` segundos."""
+        if not seqs:
+            return
+        available_at = time.time() + delay
+        with self._lock:
+            self._connection().executemany(
+                "UPDATE turns SET available_at = ? WHERE seq = ?", [(available_at, seq) for seq in seqs]
+            )
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._connection().execute("SELECT COUNT(*) FROM turns").fetchone()[0]
+
+    def ready(self) -> int:
+        """Filas que se pueden reclamar ya."""
+        with self._lock:
+            return self._connection().execute(
+                "SELECT COUNT(*) FROM turns WHERE available_at <= ?", (time.time(),)
+            ).fetchone()[0]